@@ -2,10 +2,12 @@ from .waiter import wait
 
 from .deployer import Deployment
 from .helpers import (
+    Deadline,
     FAIL,
     PASS,
     SKIP,
     TimeoutError,
+    UnitError,
     default_environment,
     fail_if_timeout,
     raise_status,
@@ -0,0 +1,335 @@
+"""asyncio versions of the deployment waits and remote commands.
+
+This module requires Python 3.5 or later.  Rather than importing it
+directly, use the ``*_async`` methods of
+:class:`~amulet.deployer.Deployment`, :class:`~amulet.sentry.Talisman` and
+:class:`~amulet.sentry.UnitSentry`, which return the coroutines defined
+here::
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(
+        d1.setup_async(timeout=900),
+        d2.setup_async(timeout=900),
+    ))
+    output, code = loop.run_until_complete(
+        d1.sentry['mysql/0'].run_async('hostname'))
+
+Status is fetched with asyncio subprocesses (or from an
+:mod:`~amulet.apiwatcher`, if one is watching the model), so waits never
+block the event loop.  Timeouts are enforced by the event loop and raise
+:class:`amulet.helpers.TimeoutError`, so they work outside the main thread,
+and cancelling a coroutine kills any ``juju`` process it is waiting on.
+
+"""
+import asyncio
+import errno
+import functools
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from path import tempdir
+
+from . import apiwatcher
+from . import debuglog
+from . import helpers
+from . import waiter
+from .poller import wake_sources
+from .sentry import (
+    HOOK_POLL_INTERVAL,
+    SentryError,
+    StatusMessageMatcher,
+    StatusTracker,
+    Talisman,
+    _LastStatus,
+    _hook_activity,
+    _messages_match,
+    _normalize_status,
+    _raise_for_errors,
+    _services_ready,
+    _settle_backoff,
+    _unit_ready,
+    _unit_scope,
+    _watch_backend,
+)
+
+log = logging.getLogger(__name__)
+
+
+async def communicate(cmd, env=None, capture=True):
+    """Run ``cmd`` and return its ``(returncode, stdout, stderr)``.
+
+    If the coroutine is cancelled, e.g. by a timeout, the process is killed.
+
+    :param bool capture: Set to False to let the output go to this
+        process's stdout and stderr instead; both are then returned as None.
+
+    """
+    pipe = subprocess.PIPE if capture else None
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, env=env, stdout=pipe, stderr=pipe)
+    try:
+        stdout, stderr = await proc.communicate()
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return proc.returncode, stdout, stderr
+
+
+async def juju(args, env=None, include_model=True):
+    """Coroutine version of :func:`amulet.helpers.juju`."""
+    if include_model:
+        env = dict(os.environ if env is None else env)
+        env['JUJU_ENV'] = env['JUJU_MODEL'] = helpers.default_environment()
+    try:
+        code, out, err = await communicate(['juju'] + args, env)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise OSError("juju not found, do you have Juju installed?")
+    if code:
+        raise IOError("juju command failed {!r}:\n"
+                      "{}".format(args, helpers._as_text(err)))
+    return helpers._as_text(out) if out else None
+
+
+async def status(juju_env, services=None):
+    """Coroutine version of :func:`amulet.waiter.status`.
+
+    Results are not cached, but a model watched by an
+    :mod:`~amulet.apiwatcher` is answered from memory.
+
+    """
+    watcher = apiwatcher.get_watcher(juju_env)
+    if watcher is not None:
+        return watcher.status(services)
+    for status_format in waiter._status_formats():
+        try:
+            raw_status = await juju(
+                waiter._status_args(juju_env, services, status_format))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            continue
+        waiter._status_format_used(status_format)
+        return waiter._load_status(raw_status)
+    raise Exception('Unable to query status for %s' % juju_env)
+
+
+async def deadline(coro, seconds, report=None):
+    """Await ``coro``, cancelling it and raising
+    :class:`~amulet.helpers.TimeoutError` after ``seconds``.
+
+    Diagnostics are written as by :func:`amulet.helpers.report_timeout`,
+    with ``report``; the optional fresh status is fetched without blocking
+    the event loop.
+
+    """
+    try:
+        return await asyncio.wait_for(coro, seconds)
+    except asyncio.TimeoutError:
+        helpers.report_timeout(seconds, report, fresh_status=False)
+        if os.environ.get('AMULET_TIMEOUT_STATUS'):
+            sys.stderr.write('juju status:\n')
+            try:
+                sys.stderr.write(await asyncio.wait_for(
+                    juju(['status', '--format', 'yaml']),
+                    helpers.TIMEOUT_STATUS_LIMIT) or '')
+            except (asyncio.TimeoutError, IOError, OSError) as e:
+                sys.stderr.write('{}\n'.format(
+                    str(e) or 'juju status timed out'))
+        raise helpers.TimeoutError()
+
+
+# for coroutines with a ``deadline`` argument of their own
+_deadline = deadline
+
+
+async def _poll(juju_env, services, check, backoff, blocking=False,
+                observe=None):
+    """Fetch the status of ``services`` until ``check`` returns true for
+    its normalized form, sleeping according to ``backoff`` in between, and
+    return the raw status which satisfied it.  If given, ``observe`` is
+    called with each raw status first.
+
+    If the model is watched through the API, changes wake the loop early.
+    Set ``blocking`` if ``check`` may block, to run it in the default
+    executor instead of on the event loop.
+
+    """
+    loop = asyncio.get_event_loop()
+    woken = asyncio.Event()
+
+    def wake():
+        loop.call_soon_threadsafe(woken.set)
+
+    watchers = wake_sources(juju_env)
+    for watcher in watchers:
+        watcher.add_listener(wake)
+    try:
+        while True:
+            woken.clear()
+            raw_status = await status(juju_env, services)
+            if observe is not None:
+                observe(raw_status)
+            normalized = _normalize_status(raw_status)
+            if blocking:
+                done = await loop.run_in_executor(None, check, normalized)
+            else:
+                done = check(normalized)
+            if done:
+                return raw_status
+            try:
+                await asyncio.wait_for(woken.wait(), backoff.delay())
+                backoff.reset()
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for watcher in watchers:
+            watcher.remove_listener(wake)
+
+
+async def _wait_for_status(juju_env, services, timeout):
+    tracker = StatusTracker(_unit_ready)
+    backoff = helpers.Backoff()
+
+    def ready(status):
+        if _services_ready(status, tracker, services):
+            return True
+        if tracker.changed:
+            backoff.reset()  # things are moving; keep polling fast
+        return False
+
+    return await deadline(
+        _poll(juju_env, services, ready, backoff), timeout, tracker.report)
+
+
+async def wait_for_status(talisman, juju_env, services, timeout=300):
+    """Coroutine version of :meth:`Talisman.wait_for_status`."""
+    timeout = int(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
+    return await _wait_for_status(juju_env, services, timeout)
+
+
+async def wait(talisman, timeout=300, idle_floor=None, units=None,
+               hook=None, since=None, fail_on_error=True, deadline=None):
+    """Coroutine version of :meth:`Talisman.wait`."""
+    timeout = int(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
+    log.info('Waiting up to %s seconds for deployment to settle...',
+             timeout)
+    start = time.time()
+    seconds = helpers.Deadline.within(timeout, deadline).remaining()
+    services, named, scope = talisman.service_names, (), None
+    if units is not None:
+        services, named, scope = _unit_scope(units)
+    activity = _hook_activity(idle_floor)
+    if hook is None:
+        check = functools.partial(talisman._unit_settled, activity)
+    else:
+        check = functools.partial(
+            talisman._hook_settled, activity, hook,
+            time.time() if since is None else since)
+    tracker = StatusTracker(check)
+    backoff = _settle_backoff(talisman.juju_env)
+    if hook is not None and debuglog.get_watcher(talisman.juju_env) is None:
+        # the hook has to be caught running
+        backoff = helpers.Backoff(ceiling=HOOK_POLL_INTERVAL)
+
+    def settled(status):
+        if fail_on_error:
+            _raise_for_errors(status, services, scope)
+        talisman._agents.update(status, scope)
+        missing = [name for name in named
+                   if name not in status.get(name.split('/')[0], {})]
+        if tracker.update(status, services, scope) and not missing:
+            return True
+        if tracker.changed:
+            backoff.reset()  # things are moving; keep polling fast
+        backoff.poll_at = tracker.ready_at
+        return False
+
+    # agents without agent-status are probed over ssh, so the check may block
+    await _deadline(_poll(talisman.juju_env, services, settled, backoff,
+                          blocking=True, observe=activity.observe),
+                    seconds, tracker.report)
+    log.info('Deployment settled in %s seconds.', time.time() - start)
+
+
+async def wait_for_messages(talisman, messages, timeout=300,
+                            fail_on_error=True):
+    """Coroutine version of :meth:`Talisman.wait_for_messages`."""
+    matcher = StatusMessageMatcher()
+    seen = _LastStatus(list(messages))
+
+    def match(status):
+        seen.status = status
+        if fail_on_error:
+            _raise_for_errors(status, list(messages))
+        return _messages_match(messages, status, matcher)
+
+    await deadline(_poll(talisman.juju_env, list(messages), match,
+                         helpers.Backoff()), timeout, seen.report)
+
+
+async def unit_run(unit_sentry, command):
+    """Coroutine version of :meth:`UnitSentry.run`."""
+    code, stdout, stderr = await communicate(unit_sentry._run_cmd(command))
+    output = stdout if code == 0 else stderr
+    return output.decode('utf8').strip(), code
+
+
+async def unit_ssh(unit_sentry, command, unit=None, raise_on_failure=False,
+                   model=None):
+    """Coroutine version of :meth:`UnitSentry.ssh`."""
+    cmd = unit_sentry._ssh_cmd(command, unit, model)
+    code, stdout, stderr = await communicate(cmd)
+    output = stdout if code == 0 else stderr
+    if code != 0:
+        print(output)
+        if raise_on_failure:
+            raise subprocess.CalledProcessError(code, cmd, output)
+    return output.decode('utf8').strip(), code
+
+
+async def setup(deployment, timeout=600, cleanup=True):
+    """Coroutine version of :meth:`Deployment.setup`."""
+    timeout = int(os.environ.get('AMULET_SETUP_TIMEOUT') or timeout)
+
+    if not deployment.deployer:
+        raise NameError('Path to juju-deployer is not defined.')
+
+    with tempdir(prefix='amulet-juju-deployer-') as tmpdir:
+        schema_json = json.dumps(deployment.schema(), indent=2)
+        deployment.log.debug("Deployer schema\n%s", schema_json)
+
+        schema_file = tmpdir / 'deployer-schema.json'
+        schema_file.write_text(schema_json)
+
+        cmd = deployment._deployer_cmd(schema_file, timeout)
+        code, stdout, stderr = await deadline(
+            communicate(cmd, capture=False), timeout)
+        if code:
+            raise subprocess.CalledProcessError(code, cmd)
+        deployment.deployed = True
+        waiter.invalidate_status()
+
+    # starting a watcher and uploading the unit scripts block, so they are
+    # run in the default executor to let other setups proceed meanwhile
+    loop = asyncio.get_event_loop()
+    juju_env = deployment.juju_env
+    await loop.run_in_executor(None, _watch_backend, juju_env)
+    timeout = int(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
+    status = await _wait_for_status(juju_env, deployment.services, timeout)
+    try:
+        deployment.sentry = await loop.run_in_executor(None, functools.partial(
+            Talisman, deployment.services, juju_env=juju_env, status=status))
+    except SentryError as e:
+        helpers.raise_status(helpers.INFRA_FAIL, msg=e)
+
+    if cleanup is False:
+        tmpdir.makedirs()
+        (tmpdir / 'deployer-schema.json').write_text(schema_json)
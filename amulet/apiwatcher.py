@@ -0,0 +1,538 @@
+"""Event-driven model status from the Juju API.
+
+Instead of forking ``juju status`` for every poll, a :class:`ModelWatcher`
+keeps one long-lived API connection to the controller and consumes its
+AllWatcher delta stream, maintaining an in-memory model of the
+applications, units, machines and relations.  Status queries are then
+answered from memory, and waiters are woken as soon as a delta arrives.
+
+Only Juju 2 controllers are supported.  To use it for a model, either call
+:func:`watch`, or set ``AMULET_STATUS_BACKEND=api`` in the environment, in
+which case every :class:`~amulet.sentry.Talisman` starts one for its model::
+
+    from amulet import apiwatcher
+    apiwatcher.watch('my-model')
+
+Once a watcher is registered for a model, :func:`amulet.waiter.status` for
+that model is served by it.
+
+The connection logs in with the controller password the juju client
+stores, so it is only made to a controller whose certificate verifies
+against the CA certificate the client has for it; without one, Talisman
+falls back to polling ``juju status``.
+
+"""
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import struct
+import threading
+from datetime import datetime
+
+from .helpers import (
+    JUJU_VERSION,
+    UnsupportedError,
+    juju,
+)
+
+try:
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    from urlparse import urlparse
+
+WATCHERS = {}
+_watchers_lock = threading.Lock()
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_OP_CONTINUATION, _OP_TEXT, _OP_BINARY = 0x0, 0x1, 0x2
+_OP_CLOSE, _OP_PING, _OP_PONG = 0x8, 0x9, 0xA
+
+# name in the certificates of controllers, whatever address they are at
+API_SERVER_NAME = 'juju-apiserver'
+
+
+class APIError(Exception):
+    pass
+
+
+class ConnectionClosed(APIError):
+    pass
+
+
+class WebSocket(object):
+    """A minimal client side RFC 6455 websocket, sufficient for the Juju
+    API: text messages only, no extensions.
+
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = b''
+
+    @classmethod
+    def connect(cls, url, ssl_context=None, timeout=None,
+                server_hostname=None):
+        """Open a websocket to ``url`` (ws:// or wss://).
+
+        :param str server_hostname: Name the server certificate must be
+            for, if not the host of ``url``.
+
+        """
+        parts = urlparse(url)
+        secure = parts.scheme == 'wss'
+        port = parts.port or (443 if secure else 80)
+        sock = socket.create_connection((parts.hostname, port), timeout)
+        if secure:
+            if ssl_context is None:
+                ssl_context = ssl.create_default_context()
+            sock = ssl_context.wrap_socket(
+                sock, server_hostname=server_hostname or parts.hostname)
+        ws = cls(sock)
+        ws._handshake(parts.netloc, parts.path or '/')
+        sock.settimeout(None)
+        return ws
+
+    def _handshake(self, host, path):
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = ('GET {} HTTP/1.1\r\n'
+                   'Host: {}\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: {}\r\n'
+                   'Sec-WebSocket-Version: 13\r\n\r\n').format(path, host, key)
+        self.sock.sendall(request.encode('ascii'))
+        while b'\r\n\r\n' not in self._buffer:
+            self._fill()
+        head, self._buffer = self._buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        if lines[0].split()[1:2] != ['101']:
+            raise APIError('Websocket handshake failed: {}'.format(lines[0]))
+        headers = dict((k.strip().lower(), v.strip()) for k, v in
+                       (line.split(':', 1) for line in lines[1:] if ':' in line))
+        accept = base64.b64encode(hashlib.sha1(
+            (key + _WS_GUID).encode('ascii')).digest()).decode('ascii')
+        if headers.get('sec-websocket-accept') != accept:
+            raise APIError('Websocket handshake failed: bad accept key')
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionClosed('Connection closed by server')
+        self._buffer += data
+
+    def _read(self, n):
+        while len(self._buffer) < n:
+            self._fill()
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def _send_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 1 << 16:
+            header.append(0x80 | 126)
+            header.extend(struct.pack('!H', length))
+        else:
+            header.append(0x80 | 127)
+            header.extend(struct.pack('!Q', length))
+        mask = bytearray(os.urandom(4))
+        masked = bytearray(payload)
+        for i in range(length):
+            masked[i] ^= mask[i % 4]
+        self.sock.sendall(bytes(header + mask + masked))
+
+    def _recv_frame(self):
+        b0, b1 = bytearray(self._read(2))
+        fin, opcode = b0 & 0x80, b0 & 0x0F
+        length = b1 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        mask = bytearray(self._read(4)) if b1 & 0x80 else None
+        payload = bytearray(self._read(length))
+        if mask:
+            for i in range(length):
+                payload[i] ^= mask[i % 4]
+        return fin, opcode, bytes(payload)
+
+    def send(self, text):
+        self._send_frame(_OP_TEXT, text.encode('utf-8'))
+
+    def recv(self):
+        """Return the next text message."""
+        message = b''
+        while True:
+            fin, opcode, payload = self._recv_frame()
+            if opcode == _OP_PING:
+                self._send_frame(_OP_PONG, payload)
+                continue
+            if opcode == _OP_PONG:
+                continue
+            if opcode == _OP_CLOSE:
+                raise ConnectionClosed('Connection closed by server')
+            message += payload
+            if fin:
+                return message.decode('utf-8')
+
+    def close(self):
+        try:
+            self._send_frame(_OP_CLOSE, b'')
+        except (socket.error, ssl.SSLError):
+            pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, ssl.SSLError):
+            pass
+        self.sock.close()
+
+
+class APIConnection(object):
+    """A Juju API RPC connection over a :class:`WebSocket`.
+
+    Requests are answered in order, so a connection must only be used by
+    one thread at a time.
+
+    """
+    def __init__(self, ws):
+        self.ws = ws
+        self._request_id = 0
+
+    @classmethod
+    def connect(cls, endpoint, model_uuid, username, password,
+                cacert=None, timeout=30):
+        """Connect and log in to the API of a model.
+
+        The controller's certificate is always verified, so that the
+        password is only ever sent to it.
+
+        :param str endpoint: Controller API address, as 'host:port'.
+        :param str cacert: PEM encoded CA certificate of the controller.
+        :raises: :class:`APIError` if ``cacert`` is missing.
+
+        """
+        if not cacert:
+            raise APIError('No CA certificate for the controller at {}; '
+                           'refusing to connect unverified'.format(endpoint))
+        context = ssl.create_default_context(cadata=cacert)
+        url = 'wss://{}/model/{}/api'.format(endpoint, model_uuid)
+        # controllers present certificates for API_SERVER_NAME, not for
+        # the address we connect to
+        connection = cls(WebSocket.connect(url, context, timeout,
+                                           API_SERVER_NAME))
+        connection.login(username, password)
+        return connection
+
+    def rpc(self, request):
+        """Send ``request`` and return the response, raising
+        :class:`APIError` on errors.
+
+        """
+        self._request_id += 1
+        request = dict(request, **{'request-id': self._request_id})
+        self.ws.send(json.dumps(request))
+        while True:
+            response = json.loads(self.ws.recv())
+            if response.get('request-id') == self._request_id:
+                break
+        if response.get('error'):
+            raise APIError('{} failed: {}'.format(
+                request['request'], response['error']))
+        return response.get('response', {})
+
+    def login(self, username, password):
+        return self.rpc({
+            'type': 'Admin', 'version': 3, 'request': 'Login',
+            'params': {'auth-tag': 'user-{}'.format(username),
+                       'credentials': password},
+        })
+
+    def close(self):
+        self.ws.close()
+
+
+def _cli_time(since):
+    """Convert an API timestamp (RFC 3339) to the format `juju status`
+    uses, e.g. '24 Sep 2015 16:44:44Z'.
+
+    """
+    if not since or 'T' not in since:
+        return since
+    date, clock = since.split('T', 1)
+    zone = 'Z'
+    for sep in ('Z', '+', '-'):
+        if sep in clock:
+            clock, offset = clock.split(sep, 1)
+            zone = sep + offset if sep != 'Z' else 'Z'
+            break
+    clock = clock.split('.')[0]
+    parsed = datetime.strptime(date + ' ' + clock, '%Y-%m-%d %H:%M:%S')
+    return parsed.strftime('%d %b %Y %H:%M:%S') + zone
+
+
+def _status(info):
+    info = info or {}
+    status = dict((k, info[k]) for k in ('current', 'message', 'version')
+                  if info.get(k) is not None)
+    if info.get('since'):
+        status['since'] = _cli_time(info['since'])
+    return status
+
+
+class ModelWatcher(object):
+    """In-memory model of a Juju model, kept up to date from the
+    controller's AllWatcher delta stream on a background thread.
+
+    :ivar int revision: Number of delta batches applied so far.
+    :ivar Exception error: Set if the watcher stopped due to an error.
+
+    """
+    _KEYS = {
+        'application': 'name',
+        'unit': 'name',
+        'machine': 'id',
+        'relation': 'key',
+    }
+
+    def __init__(self, connection, juju_env=None):
+        self.connection = connection
+        self.juju_env = juju_env
+        self.revision = 0
+        self.error = None
+        self.entities = dict((kind, {}) for kind in self._KEYS)
+        self._cond = threading.Condition()
+        self._listeners = []
+        self._thread = None
+        self._stopping = False
+
+    @classmethod
+    def from_juju(cls, juju_env):
+        """Connect to ``juju_env`` using the credentials the juju client
+        has stored for it.
+
+        """
+        if JUJU_VERSION.major != 2:
+            raise UnsupportedError('The API watcher requires Juju 2')
+        model = json.loads(juju(['show-model', juju_env, '--format', 'json'],
+                                include_model=False))
+        model = next(iter(model.values()))
+        controller_name = model['controller-name']
+        controller = json.loads(juju(
+            ['show-controller', controller_name, '--show-password',
+             '--format', 'json'], include_model=False))[controller_name]
+        details, account = controller['details'], controller['account']
+        connection = APIConnection.connect(
+            details['api-endpoints'][0], model['model-uuid'],
+            account['user'], account.get('password'), details.get('ca-cert'))
+        return cls(connection, juju_env)
+
+    def start(self):
+        """Start watching.  The first batch of deltas (the current state of
+        the model) has been applied when this returns.
+
+        """
+        response = self.connection.rpc({
+            'type': 'Client', 'version': 1, 'request': 'WatchAll'})
+        self._watcher_id = response['watcher-id']
+        self.apply(self._next())
+        self._thread = threading.Thread(
+            target=self._run, name='amulet-watcher-{}'.format(self.juju_env))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _next(self):
+        return self.connection.rpc({
+            'type': 'AllWatcher', 'version': 1, 'request': 'Next',
+            'id': self._watcher_id}).get('deltas', [])
+
+    def _run(self):
+        try:
+            while not self._stopping:
+                self.apply(self._next())
+        except Exception as e:
+            with self._cond:
+                if not self._stopping:
+                    self.error = e
+                self._cond.notify_all()
+            self._notify()
+
+    def stop(self):
+        self._stopping = True
+        self.connection.close()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def apply(self, deltas):
+        """Apply a batch of ``[kind, 'change'|'remove', entity]`` deltas."""
+        with self._cond:
+            for kind, op, entity in deltas:
+                if kind not in self._KEYS:
+                    continue
+                key = entity[self._KEYS[kind]]
+                if op == 'remove':
+                    self.entities[kind].pop(key, None)
+                else:
+                    self.entities[kind][key] = entity
+            self.revision += 1
+            self._cond.notify_all()
+        self._notify()
+
+    def add_listener(self, callback):
+        """Call ``callback()`` (on the watcher thread) whenever the model
+        changes.
+
+        """
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def _notify(self):
+        with self._cond:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+    def wait_for_change(self, revision, timeout=None):
+        """Block until :attr:`revision` is past ``revision``, or ``timeout``
+        seconds have passed.  Returns the current revision.
+
+        """
+        with self._cond:
+            if self.revision <= revision and self.error is None:
+                self._cond.wait(timeout)
+            return self.revision
+
+    def status(self, services=None):
+        """Return the model status, in the same form as the parsed output
+        of `juju status --format json` on Juju 2.
+
+        :param list services: If given, only include these services (and
+            the principals of their subordinate units).
+
+        """
+        with self._cond:
+            if self.error is not None:
+                raise self.error
+            entities = dict((kind, dict(table))
+                            for kind, table in self.entities.items())
+
+        machines = {}
+        for machine_id in sorted(entities['machine'], key=len):
+            machine = entities['machine'][machine_id]
+            record = {
+                'juju-status': _status(machine.get('agent-status')),
+                'machine-status': _status(machine.get('instance-status')),
+                'instance-id': machine.get('instance-id'),
+                'series': machine.get('series'),
+            }
+            if '/' in machine_id:
+                host = machines.setdefault(machine_id.split('/')[0], {})
+                host.setdefault('containers', {})[machine_id] = record
+            else:
+                machines.setdefault(machine_id, {}).update(record)
+
+        relations = {}
+        for relation in entities['relation'].values():
+            endpoints = relation.get('endpoints', [])
+            for endpoint in endpoints:
+                name = endpoint['relation']['name']
+                app_relations = relations.setdefault(
+                    endpoint['application-name'], {})
+                remotes = [e['application-name'] for e in endpoints
+                           if e is not endpoint] or \
+                    [endpoint['application-name']]  # peer relation
+                app_relations.setdefault(name, []).extend(remotes)
+
+        applications = {}
+        for name, app in entities['application'].items():
+            record = {
+                'charm': app.get('charm-url'),
+                'exposed': app.get('exposed', False),
+                'application-status': _status(app.get('status')),
+            }
+            if name in relations:
+                record['relations'] = relations[name]
+            if app.get('subordinate'):
+                record['subordinate-to'] = sorted(set(
+                    r for rs in relations.get(name, {}).values() for r in rs))
+            else:
+                record['units'] = {}
+            applications[name] = record
+
+        subordinates = []
+        for name, unit in entities['unit'].items():
+            record = {
+                'workload-status': _status(unit.get('workload-status')),
+                'juju-status': _status(unit.get('agent-status')),
+                'machine': unit.get('machine-id'),
+                'public-address': unit.get('public-address'),
+            }
+            if unit.get('subordinate'):
+                subordinates.append((unit, record))
+                continue
+            app = applications.setdefault(unit['application'], {'units': {}})
+            app.setdefault('units', {})[name] = record
+        for unit, record in subordinates:
+            principal = unit.get('principal', '')
+            app = applications.get(principal.split('/')[0], {})
+            host = app.get('units', {}).get(principal)
+            if host is not None:
+                host.setdefault('subordinates', {})[unit['name']] = record
+
+        if services:
+            wanted = set(services)
+            for unit, record in subordinates:
+                if unit['application'] in wanted:
+                    wanted.add(unit.get('principal', '').split('/')[0])
+            applications = dict((name, app) for name, app in
+                                applications.items() if name in wanted)
+
+        return {
+            'model': {'name': self.juju_env},
+            'machines': machines,
+            'applications': applications,
+            'services': applications,
+        }
+
+
+def watch(juju_env, watcher=None):
+    """Start serving status for ``juju_env`` from a :class:`ModelWatcher`.
+
+    :param watcher: An already started watcher to register; if None, one is
+        created with :meth:`ModelWatcher.from_juju`.
+    :return: The registered watcher.
+
+    """
+    with _watchers_lock:
+        if juju_env in WATCHERS and watcher is None:
+            return WATCHERS[juju_env]
+    if watcher is None:
+        watcher = ModelWatcher.from_juju(juju_env).start()
+    with _watchers_lock:
+        WATCHERS[juju_env] = watcher
+    return watcher
+
+
+def unwatch(juju_env):
+    """Stop and unregister the watcher for ``juju_env``, if any."""
+    with _watchers_lock:
+        watcher = WATCHERS.pop(juju_env, None)
+    if watcher is not None:
+        watcher.stop()
+
+
+def get_watcher(juju_env):
+    """Return the watcher registered for ``juju_env``, or None."""
+    watcher = WATCHERS.get(juju_env)
+    if watcher is not None and watcher.error is not None:
+        return None  # fall back to the CLI
+    return watcher
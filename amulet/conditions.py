@@ -0,0 +1,270 @@
+"""Composable conditions on the status of a deployment.
+
+Conditions describe a state of the deployment and are combined into one
+predicate, so that a single wait (see :meth:`Talisman.wait_for
+<amulet.sentry.Talisman.wait_for>`) and a single poll loop can replace a
+series of waits::
+
+    from amulet.conditions import (
+        agent_idle_for, all_of, message, unit_count)
+
+    d.sentry.wait_for(all_of(
+        agent_idle_for('mysql', 30),
+        message('wordpress', re.compile('ready')),
+        unit_count('haproxy', 3),
+    ))
+
+Conditions can also be combined with ``&``, ``|`` and ``~``.
+
+Each condition is checked against a normalized status, as returned by
+:meth:`Talisman.get_status <amulet.sentry.Talisman.get_status>`, by its
+:meth:`~Condition.evaluate` method, which short-circuits and returns the
+sub-condition which is not met, if any.
+
+"""
+import time
+
+from .helpers import UnsupportedError
+from .sentry import StatusMessageMatcher, since_epoch
+
+_MATCHER = StatusMessageMatcher()
+
+
+def _units(status, target):
+    """Return the units of ``target``, a service or a single unit."""
+    if '/' in target:
+        unit = status.get(target.split('/')[0], {}).get(target)
+        return [] if unit is None else [unit]
+    return list(status.get(target, {}).values())
+
+
+def _matches(expected, actual):
+    return bool(actual) and bool(_MATCHER.check_message(expected, actual))
+
+
+class Condition(object):
+    """Base class of all conditions."""
+    def evaluate(self, status):
+        """Check the condition against the normalized ``status``.
+
+        :return: None if the condition is met, or else the (innermost)
+            condition which is not.
+
+        """
+        raise NotImplementedError()
+
+    def check(self, status):
+        """Return whether the condition is met by ``status``."""
+        return self.evaluate(status) is None
+
+    def services(self):
+        """Return the set of services the condition looks at."""
+        raise NotImplementedError()
+
+    def __and__(self, other):
+        return all_of(self, other)
+
+    def __or__(self, other):
+        return any_of(self, other)
+
+    def __invert__(self):
+        return not_(self)
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self)
+
+
+class AllOf(Condition):
+    def __init__(self, conditions):
+        self.conditions = list(conditions)
+
+    def evaluate(self, status):
+        for condition in self.conditions:
+            unmet = condition.evaluate(status)
+            if unmet is not None:
+                return unmet
+        return None
+
+    def services(self):
+        return set().union(*[c.services() for c in self.conditions])
+
+    def __str__(self):
+        return '({})'.format(' and '.join(str(c) for c in self.conditions))
+
+
+class AnyOf(AllOf):
+    def evaluate(self, status):
+        for condition in self.conditions:
+            if condition.evaluate(status) is None:
+                return None
+        return self
+
+    def __str__(self):
+        return '({})'.format(' or '.join(str(c) for c in self.conditions))
+
+
+class Not(Condition):
+    def __init__(self, condition):
+        self.condition = condition
+
+    def evaluate(self, status):
+        if self.condition.evaluate(status) is None:
+            return self
+        return None
+
+    def services(self):
+        return self.condition.services()
+
+    def __str__(self):
+        return 'not {}'.format(self.condition)
+
+
+class UnitCondition(Condition):
+    """A condition on every unit of a service, or on a single unit.  It is
+    not met if there are no such units.
+
+    """
+    def __init__(self, target):
+        self.target = target
+
+    def services(self):
+        return set([self.target.split('/')[0]])
+
+    def evaluate(self, status):
+        units = _units(status, self.target)
+        if not units:
+            return self
+        for unit in units:
+            if not self.check_unit(unit):
+                return self
+        return None
+
+    def check_unit(self, unit):
+        raise NotImplementedError()
+
+
+class UnitStateIs(UnitCondition):
+    def __init__(self, target, state):
+        UnitCondition.__init__(self, target)
+        self.state = state
+
+    def check_unit(self, unit):
+        return (_matches(self.state, unit.workload) or
+                _matches(self.state, unit.agent) or
+                _matches(self.state, unit.agent_state))
+
+    def __str__(self):
+        return '{} in state {!r}'.format(
+            self.target, getattr(self.state, 'pattern', self.state))
+
+
+class AgentIdleFor(UnitCondition):
+    def __init__(self, target, seconds):
+        UnitCondition.__init__(self, target)
+        self.seconds = seconds
+
+    def check_unit(self, unit):
+        if not unit.has_agent_status:
+            raise UnsupportedError()
+        if unit.agent != 'idle':
+            return False
+        return time.time() - since_epoch(unit.agent_since) >= self.seconds
+
+    def __str__(self):
+        return '{} agent idle for {}s'.format(self.target, self.seconds)
+
+
+class MessageMatches(Condition):
+    def __init__(self, service, expected):
+        self.service = service
+        self.expected = expected
+
+    def services(self):
+        return set([self.service])
+
+    def evaluate(self, status):
+        messages = []
+        for unit in _units(status, self.service):
+            if not unit.has_workload_status:
+                raise UnsupportedError()
+            messages.append(unit.message or '')
+        if _MATCHER.check(self.expected, messages):
+            return None
+        return self
+
+    def __str__(self):
+        return '{} message {!r}'.format(
+            self.service, getattr(self.expected, 'pattern', self.expected))
+
+
+class UnitCount(Condition):
+    def __init__(self, service, count, at_least=False):
+        self.service = service
+        self.count = count
+        self.at_least = at_least
+
+    def services(self):
+        return set([self.service])
+
+    def evaluate(self, status):
+        count = len(status.get(self.service, {}))
+        if count == self.count or (self.at_least and count > self.count):
+            return None
+        return self
+
+    def __str__(self):
+        return '{} has {}{} units'.format(
+            self.service, 'at least ' if self.at_least else '', self.count)
+
+
+def all_of(*conditions):
+    """Met when every one of ``conditions`` is met."""
+    return AllOf(conditions)
+
+
+def any_of(*conditions):
+    """Met when at least one of ``conditions`` is met."""
+    return AnyOf(conditions)
+
+
+def not_(condition):
+    """Met when ``condition`` is not."""
+    return Not(condition)
+
+
+def unit_state(target, state):
+    """Met when every unit of ``target`` (a service, or a unit like
+    'mysql/0') has ``state`` as its workload or agent status.
+
+    :param state: A status, or a compiled regular expression.
+
+    """
+    return UnitStateIs(target, state)
+
+
+def message(service, expected):
+    """Met when the status messages of the units of ``service`` match
+    ``expected``, with the same rules as
+    :meth:`Talisman.wait_for_messages
+    <amulet.sentry.Talisman.wait_for_messages>`: a string or regular
+    expression must match every unit, each item of a set at least one
+    unit, and a list must match the units one-to-one.
+
+    """
+    return MessageMatches(service, expected)
+
+
+def unit_count(service, count, at_least=False):
+    """Met when ``service`` has exactly (or, with ``at_least``, at least)
+    ``count`` units.
+
+    """
+    return UnitCount(service, count, at_least)
+
+
+def agent_idle_for(target, seconds):
+    """Met when the agent of every unit of ``target`` (a service, or a unit
+    like 'mysql/0') has been idle for at least ``seconds``.
+
+    """
+    return AgentIdleFor(target, seconds)
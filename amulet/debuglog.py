@@ -0,0 +1,260 @@
+"""Hook activity from a model's ``juju debug-log``.
+
+A :class:`DebugLogWatcher` tails ``juju debug-log`` for a model with one
+long-lived process, and turns the uniter's hook start and completion lines
+into a table of what each unit is doing.  Waits on a watched model (see
+:meth:`amulet.sentry.Talisman.wait`) are woken as soon as a hook finishes,
+and only poll ``juju status`` to confirm what the log says, so they can
+poll it much less often.
+
+To use it for a model, either call :func:`watch`, or set
+``AMULET_DEBUG_LOG=1`` in the environment, in which case every
+:class:`~amulet.sentry.Talisman` starts one for its model::
+
+    from amulet import debuglog
+    debuglog.watch('my-model')
+
+The log is parsed one line at a time as it arrives, and only the latest
+hook of each unit (and when each of its hooks last finished) is kept, so
+memory use does not grow with the amount of logging.
+
+"""
+import os
+import re
+import subprocess
+import threading
+import time
+
+from .helpers import JUJU_VERSION
+
+# logging module of the uniter's hook operations
+MODULE = 'juju.worker.uniter.operation'
+
+# seconds between the status polls of a settling wait, when a watcher tells
+# it when hooks finish
+CONFIRM_INTERVAL = 30
+
+# longest log line parsed; the rest of a longer line is skipped
+MAX_LINE = 4096
+
+WATCHERS = {}
+_watchers_lock = threading.Lock()
+
+_UNIT = re.compile(r'^unit-([\w-]+)-(\d+)[:\[]')
+_EVENTS = [
+    ('running', re.compile(
+        r'running operation run (?:hook for ([\w-]+)|([\w-]+) hook)')),
+    ('ran', re.compile(r'ran "([\w-]+)" hook')),
+    ('ran', re.compile(r'skipped "([\w-]+)" hook')),
+    ('failed', re.compile(r'hook "([\w-]+)" failed')),
+]
+
+
+def parse_line(line):
+    """Parse a debug-log line.
+
+    :return: A ``(unit_name, event, hook)`` tuple, where ``event`` is one
+        of 'running', 'ran' or 'failed', or None if the line is not about a
+        hook.
+
+    """
+    if MODULE not in line:
+        return None
+    unit = _UNIT.match(line)
+    if unit is None:
+        return None
+    for event, pattern in _EVENTS:
+        match = pattern.search(line)
+        if match is not None:
+            hook = [group for group in match.groups() if group][0]
+            return '{}/{}'.format(*unit.groups()), event, hook
+    return None
+
+
+class UnitActivity(object):
+    """The latest hook activity of a unit, as seen in the debug-log.
+
+    :ivar str hook: Name of the latest hook.
+    :ivar str event: 'running', 'ran' or 'failed'.
+    :ivar float time: When the line was read.
+
+    """
+    __slots__ = ('hook', 'event', 'time')
+
+    def __init__(self, hook, event, timestamp):
+        self.hook = hook
+        self.event = event
+        self.time = timestamp
+
+    @property
+    def running(self):
+        return self.event == 'running'
+
+    def __repr__(self):
+        return '<UnitActivity {} {}>'.format(self.event, self.hook)
+
+
+class DebugLogWatcher(object):
+    """Follow hook activity in a debug-log stream on a background thread.
+
+    :param stream: A binary file-like object the log is read from.
+    :param str juju_env: Name of the model.
+    :param process: The process writing ``stream``, stopped with the
+        watcher.
+
+    :ivar dict units: Maps unit names to their :class:`UnitActivity`.
+    :ivar int hooks: Number of hooks seen finishing so far.
+    :ivar Exception error: Set if the log ended before :meth:`stop`.
+
+    """
+    def __init__(self, stream, juju_env=None, process=None):
+        self.stream = stream
+        self.juju_env = juju_env
+        self.process = process
+        self.units = {}
+        self.hooks = 0
+        self.error = None
+        self._finished = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._thread = None
+        self._stopping = False
+
+    @classmethod
+    def from_juju(cls, juju_env):
+        """Start tailing ``juju debug-log`` for ``juju_env``."""
+        if JUJU_VERSION.major == 1:
+            args = ['-e', juju_env, '-n', '0']
+        else:
+            args = ['-m', juju_env, '--lines', '0']
+        devnull = open(os.devnull, 'wb')
+        try:
+            process = subprocess.Popen(
+                ['juju', 'debug-log', '--include-module', MODULE] + args,
+                stdout=subprocess.PIPE, stderr=devnull)
+        finally:
+            devnull.close()
+        return cls(process.stdout, juju_env, process)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='amulet-debuglog-{}'.format(self.juju_env))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        skipping = False
+        try:
+            while not self._stopping:
+                line = self.stream.readline(MAX_LINE)
+                if not line:
+                    break
+                truncated = not line.endswith(b'\n')
+                if not skipping:
+                    self.feed(line.decode('utf-8', 'replace'))
+                # drop the rest of an overlong line
+                skipping = truncated
+        except Exception as e:
+            if not self._stopping:
+                self.error = e
+        else:
+            if not self._stopping:
+                self.error = IOError(
+                    'debug-log for {} ended'.format(self.juju_env))
+        if self.error is not None:
+            self._notify()
+
+    def feed(self, line):
+        """Parse one line of the log, and wake the listeners if it tells
+        that a hook finished.
+
+        """
+        parsed = parse_line(line)
+        if parsed is None:
+            return
+        unit_name, event, hook = parsed
+        now = time.time()
+        with self._lock:
+            self.units[unit_name] = UnitActivity(hook, event, now)
+            if event != 'running':
+                self.hooks += 1
+                self._finished.setdefault(unit_name, {})[hook] = now
+        if event != 'running':
+            self._notify()
+
+    def finished(self, unit_name, hook):
+        """Return when ``unit_name`` last finished running ``hook``
+        (successfully or not), or None if it wasn't seen doing so.
+
+        """
+        with self._lock:
+            return self._finished.get(unit_name, {}).get(hook)
+
+    def running(self):
+        """Return the names of the units running a hook."""
+        with self._lock:
+            return set(name for name, activity in self.units.items()
+                       if activity.running)
+
+    def stop(self):
+        self._stopping = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def add_listener(self, callback):
+        """Call ``callback()`` (on the watcher thread) whenever a hook
+        finishes.
+
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def _notify(self):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+
+def watch(juju_env, watcher=None):
+    """Start following the hooks of ``juju_env`` with a
+    :class:`DebugLogWatcher`.
+
+    :param watcher: An already started watcher to register; if None, one is
+        created with :meth:`DebugLogWatcher.from_juju`.
+    :return: The registered watcher.
+
+    """
+    with _watchers_lock:
+        if juju_env in WATCHERS and watcher is None:
+            return WATCHERS[juju_env]
+    if watcher is None:
+        watcher = DebugLogWatcher.from_juju(juju_env).start()
+    with _watchers_lock:
+        WATCHERS[juju_env] = watcher
+    return watcher
+
+
+def unwatch(juju_env):
+    """Stop and unregister the watcher for ``juju_env``, if any."""
+    with _watchers_lock:
+        watcher = WATCHERS.pop(juju_env, None)
+    if watcher is not None:
+        watcher.stop()
+
+
+def get_watcher(juju_env):
+    """Return the watcher registered for ``juju_env``, or None."""
+    watcher = WATCHERS.get(juju_env)
+    if watcher is not None and watcher.error is not None:
+        return None  # fall back to polling
+    return watcher
@@ -12,13 +12,17 @@ from path import Path as path
 from path import tempdir
 
 from . import actions
+from . import waiter
 from .helpers import (
+    Deadline,
+    communicate,
     default_environment,
     juju,
     timeout as unit_timesout,
     JUJU_VERSION,
     INFRA_FAIL,
     raise_status,
+    require_asyncio,
 )
 from .sentry import (
     Talisman,
@@ -164,6 +168,16 @@ class Deployment(object):
             if service_config.get('expose'):
                 self.expose(service)
 
+    def _juju(self, args):
+        """Run a juju command which changes the deployed model, and drop
+        any cached status which it made stale.
+
+        """
+        try:
+            return juju(args)
+        finally:
+            waiter.invalidate_status()
+
     def add(self, service_name,
             charm=None,
             units=1,
@@ -299,11 +313,16 @@ class Deployment(object):
             if target is not None:
                 args.extend(["--to", target])
 
-            juju(args)
+            self._juju(args)
 
             try:
-                self.sentry = Talisman(
-                    self.services, juju_env=self.juju_env, timeout=timeout)
+                if self.sentry is None:
+                    self.sentry = Talisman(
+                        self.services, juju_env=self.juju_env,
+                        timeout=timeout)
+                else:
+                    # only the new units need setting up
+                    self.sentry.refresh(timeout)
             except SentryError as e:
                 raise_status(INFRA_FAIL, msg=e)
 
@@ -325,7 +344,7 @@ class Deployment(object):
             if service not in self.services:
                 raise ValueError('%s is not a deployed service' % service)
 
-        juju(['remove-unit'] + list(units))
+        self._juju(['remove-unit'] + list(units))
 
         for unit in units:
             if self.sentry and unit in self.sentry.unit:
@@ -354,7 +373,7 @@ class Deployment(object):
 
         for service in services:
             if self.deployed:
-                juju([remove_cmd, service])
+                self._juju([remove_cmd, service])
             self._remove_service_sentries(service)
             self._remove_service_relations(service)
             del self.services[service]
@@ -449,7 +468,7 @@ class Deployment(object):
         if [a, b] not in self.relations and [b, a] not in self.relations:
             self.relations.append([a, b])
             if self.deployed:
-                juju(['add-relation'] + [a, b])
+                self._juju(['add-relation'] + [a, b])
 
     def unrelate(self, *args):
         """Remove a relation between two services.
@@ -491,7 +510,7 @@ class Deployment(object):
 
         self.relations.remove(relation)
         if self.deployed:
-            juju(['remove-relation'] + relation)
+            self._juju(['remove-relation'] + relation)
 
     def schema(self):
         """Return the deployment schema (bundle) as a dictionary.
@@ -536,7 +555,7 @@ class Deployment(object):
             opts = [juju_set_cmd, service]
             for k, v in options.items():
                 opts.append("%s=%s" % (k, v))
-            return juju(opts)
+            return self._juju(opts)
 
         if service not in self.services:
             raise ValueError('Service has not yet been described')
@@ -563,24 +582,26 @@ class Deployment(object):
 
         """
         if self.deployed:
-            return juju(['expose', service])
+            return self._juju(['expose', service])
 
         if service not in self.services:
             raise ValueError('%s has not yet been described' % service)
         self.services[service]['expose'] = True
 
     @contextlib.contextmanager
-    def _deploy_w_timeout(self, timeout):
-        """Sets timeout and tmp working directory for wrapped block.
+    def _deploy_w_timeout(self, timeout, deadline=None):
+        """Sets timeout and tmp working directory for wrapped block, which
+        gets the :class:`~amulet.helpers.Deadline` of the timeout.
 
         If successful, sets instance.deployed.
 
         :param timeout: Amount of time to wait for deployment to complete.
+        :param deadline: Outer deadline, if not the current one.
 
         """
         deploy_dir = tempdir(prefix='amulet_deployment_')
-        with deploy_dir, unit_timesout(timeout):
-            yield
+        with deploy_dir, unit_timesout(timeout, deadline=deadline) as limit:
+            yield limit
         self.deployed = True
 
     def action_defined(self, service):
@@ -655,7 +676,8 @@ class Deployment(object):
         )
     get_action_output = action_fetch
 
-    def setup(self, timeout=600, cleanup=True):
+    def setup(self, timeout=600, cleanup=True, progressive=False,
+              deadline=None):
         """Deploy the workload.
 
         If timeout expires before the deployment completes, raises
@@ -666,6 +688,14 @@ class Deployment(object):
             this value.
         :param cleanup: Set to False to leave the generated deployer file
             on disk. Useful for debugging.
+        :param progressive: Return as soon as the deployer is done, and set
+            up the units of :attr:`sentry` as they come up, in the
+            background.  Use :meth:`Talisman.ready_units
+            <amulet.sentry.Talisman.ready_units>` to start on each unit as
+            soon as it is ready.
+        :param deadline: A :class:`~amulet.helpers.Deadline` the whole setup
+            must be done by, e.g. that of a test suite.  The deployer is
+            killed if it is still running then.
 
         Example::
 
@@ -694,31 +724,58 @@ class Deployment(object):
             schema_file = tmpdir / 'deployer-schema.json'
             schema_file.write_text(schema_json)
 
-            cmd = (
-                "{deployer} -W {debug} -c {schema} -e {env} -t {timeout} {env}"
-            )
-            cmd_args = dict(
-                deployer=self.deployer.expanduser(),
-                debug=(
-                    '-d'
-                    if self.log.getEffectiveLevel() == logging.DEBUG
-                    else ''),
-                schema=schema_file,
-                env=self.juju_env,
-                timeout=str(timeout + 100),
-            )
-            cmd = cmd.format(**cmd_args)
-            self.log.debug(cmd)
-
-            with self._deploy_w_timeout(timeout):
-                subprocess.check_call(shlex.split(cmd))
+            deadline = Deadline.within(None, deadline)
+            with self._deploy_w_timeout(timeout, deadline) as limit:
+                cmd = self._deployer_cmd(
+                    schema_file, int(limit.remaining() or timeout))
+                process = subprocess.Popen(cmd)
+                communicate(process, limit, cmd)
+                if process.returncode:
+                    raise subprocess.CalledProcessError(
+                        process.returncode, cmd)
+            waiter.invalidate_status()
 
         try:
             self.sentry = Talisman(
-                self.services, timeout=timeout, juju_env=self.juju_env)
+                self.services, timeout=timeout, juju_env=self.juju_env,
+                progressive=progressive, deadline=deadline)
         except SentryError as e:
             raise_status(INFRA_FAIL, msg=e)
 
         if cleanup is False:
             tmpdir.makedirs()
             (tmpdir / 'deployer-schema.json').write_text(schema_json)
+
+    def _deployer_cmd(self, schema_file, timeout):
+        cmd = (
+            "{deployer} -W {debug} -c {schema} -e {env} -t {timeout} {env}"
+        )
+        cmd_args = dict(
+            deployer=self.deployer.expanduser(),
+            debug=(
+                '-d'
+                if self.log.getEffectiveLevel() == logging.DEBUG
+                else ''),
+            schema=schema_file,
+            env=self.juju_env,
+            timeout=str(timeout + 100),
+        )
+        cmd = cmd.format(**cmd_args)
+        self.log.debug(cmd)
+        return shlex.split(cmd)
+
+    def setup_async(self, timeout=600, cleanup=True):
+        """Coroutine version of :meth:`setup`, for use with asyncio.
+
+        Both juju-deployer and the wait for the deployment to come up run
+        without blocking the event loop, so several deployments (in
+        different models) can be set up concurrently::
+
+            loop.run_until_complete(asyncio.gather(
+                d1.setup_async(timeout=900), d2.setup_async(timeout=900)))
+
+        The timeout is enforced by the event loop.  Requires Python 3.5 or
+        later.
+
+        """
+        return require_asyncio().setup(self, timeout, cleanup)
@@ -1,12 +1,13 @@
 from __future__ import print_function
 import functools
 import os
+import random
 import sys
+import threading
+import time
 import yaml
-import signal
 import subprocess
 import errno
-from datetime import datetime
 
 from contextlib import contextmanager
 
@@ -18,8 +19,15 @@ FAIL = 1
 JUJU_VERSION = None  # will be set below
 JUJU_MODEL = None  # will be set below
 
+# seconds a fresh `juju status` printed on timeout (see AMULET_TIMEOUT_STATUS)
+# may take before it is given up
+TIMEOUT_STATUS_LIMIT = 10
+
 
 class TimeoutError(Exception):
+    # whether the diagnostics were written already (see report_timeout)
+    reported = False
+
     def __init__(self, value="Timed Out"):
         self.value = value
 
@@ -28,6 +36,28 @@ class UnsupportedError(Exception):
     pass
 
 
+class UnitError(Exception):
+    """Raised by the waits of :class:`~amulet.sentry.Talisman` as soon as
+    units go into a state they won't leave without intervention, such as a
+    failed hook.
+
+    :ivar list failures: ``(unit_name, hook, message)`` tuples, one per
+        failing unit; ``hook`` is the name of the failed hook, or None if
+        it isn't known.
+
+    """
+    def __init__(self, failures):
+        self.failures = sorted(failures, key=lambda f: f[0])
+        Exception.__init__(self, '\n'.join(
+            'Error on unit {}: {}'.format(unit_name, message)
+            for unit_name, hook, message in self.failures))
+
+    @property
+    def units(self):
+        """Names of the failing units."""
+        return [failure[0] for failure in self.failures]
+
+
 def _as_text(bytestring):
     """Naive conversion of subprocess output to Python string"""
     return bytestring.decode("utf-8", "replace")
@@ -61,7 +91,18 @@ def run_bzr(args, working_dir, env=None):
     return _as_text(out)
 
 
-def juju(args, env=None, include_model=True):
+def juju(args, env=None, include_model=True, timeout=None, deadline=None):
+    """Run a juju command and return its output.
+
+    :param float timeout: If given, kill the command if it hasn't finished
+        after that many seconds.
+    :param Deadline deadline: Kill the command if it hasn't finished by
+        then; see :meth:`Deadline.within`.
+    :raises: :class:`TimeoutError` if the command was killed.
+
+    """
+    deadline = Deadline.within(timeout, deadline)
+    deadline.check()
     if include_model:
         if env is None:
             env = os.environ
@@ -73,14 +114,247 @@ def juju(args, env=None, include_model=True):
         if e.errno != errno.ENOENT:
             raise
         raise OSError("juju not found, do you have Juju installed?")
-    out, err = p.communicate()
+    out, err = communicate(p, deadline, args)
     if p.returncode:
         raise IOError("juju command failed {!r}:\n"
                       "{}".format(args, _as_text(err)))
     return _as_text(out) if out else None
 
 
-def timeout_gen(seconds):
+def require_asyncio():
+    """Return the :mod:`amulet.aio` module, which implements the coroutine
+    (``*_async``) APIs.
+
+    :raises: :class:`UnsupportedError` on Pythons older than 3.5.
+
+    """
+    if sys.version_info < (3, 5):
+        raise UnsupportedError('asyncio support requires Python 3.5 or later')
+    from . import aio
+    return aio
+
+
+class Backoff(object):
+    """Polling schedule for :func:`timeout_gen`.
+
+    The first ``fast`` polls are ``initial`` seconds apart; after that the
+    interval grows by ``factor`` on each poll, up to ``ceiling``, with up to
+    ``jitter`` (as a fraction) of random variation so that many jobs polling
+    the same controller drift apart.
+
+    Calling :meth:`reset` (e.g. when a loop body notices that something
+    changed) returns the schedule to the fast phase, and :meth:`wake` does
+    the same while also interrupting the current sleep; it may be called
+    from any thread.
+
+    :param float initial: Interval between polls in the fast phase.
+    :param int fast: Number of polls in the fast phase.
+    :param float factor: Growth factor of the interval after the fast phase.
+    :param float ceiling: Maximum interval between polls.
+    :param float jitter: Maximum random variation of each interval, as a
+        fraction of it.
+
+    :ivar float poll_at: If set to a future time, the next poll is due
+        then instead of on the schedule, e.g. because nothing can be
+        decided before agents have been idle for long enough, and nothing
+        is left to decide after.  :meth:`wake` still ends the sleep early.
+
+    """
+    def __init__(self, initial=1, fast=3, factor=1.5, ceiling=10,
+                 jitter=0.2):
+        self.initial = initial
+        self.fast = fast
+        self.factor = factor
+        self.ceiling = ceiling
+        self.jitter = jitter
+        self.polls = 0
+        self.poll_at = None
+        self._event = threading.Event()
+
+    def reset(self):
+        """Return to the fast phase of the schedule."""
+        self.polls = 0
+
+    def wake(self):
+        """Return to the fast phase, and end the current sleep early."""
+        self.reset()
+        self._event.set()
+
+    def delay(self):
+        """Return the interval before the next poll, and advance the
+        schedule.
+
+        """
+        slow = max(0, self.polls - self.fast + 1)
+        self.polls += 1
+        delay = min(self.ceiling, self.initial * self.factor ** slow)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        delay = min(self.ceiling, delay)
+        if self.poll_at is not None:
+            until = self.poll_at - time.time()
+            if until > 0:
+                delay = until
+        return delay
+
+    def sleep(self, limit=None):
+        """Sleep until the next poll is due, :meth:`wake` is called, or
+        ``limit`` seconds have passed, whichever comes first.
+
+        """
+        delay = self.delay()
+        if limit is not None:
+            delay = min(delay, limit)
+        if delay > 0:
+            self._event.wait(delay)
+        self._event.clear()
+
+
+class Deadline(object):
+    """A point in time by which some work must be done.
+
+    Deadlines are plain values: they can be handed to other threads, and
+    any number of them can be in use at once.  They are enforced by the
+    code they are passed to, which stops polling, and kills the processes
+    it runs (see :func:`communicate`), once they have passed.
+
+    A deadline made with a ``parent`` never ends after it, so that nested
+    calls, each with a timeout of their own, can't outlive their caller.
+
+    :param float seconds: Number of seconds from now, or None for no limit
+        other than the parent's.
+    :param Deadline parent: Deadline this one must not outlive.
+
+    :ivar float at: Epoch time of the deadline, or None if there is none.
+
+    """
+    def __init__(self, seconds=None, parent=None):
+        at = None if seconds is None else time.time() + seconds
+        if parent is not None and parent.at is not None:
+            at = parent.at if at is None else min(at, parent.at)
+        self.at = at
+
+    @classmethod
+    def within(cls, seconds=None, parent=None):
+        """Return a deadline ``seconds`` from now, which does not outlive
+        ``parent``, or if it is None, the innermost :func:`timeout` block
+        of the calling thread.
+
+        """
+        if parent is None:
+            parent = current_deadline()
+        return cls(seconds, parent)
+
+    def remaining(self):
+        """Return the number of seconds left (0 once it has passed), or None
+        if there is no deadline.
+
+        """
+        if self.at is None:
+            return None
+        return max(0, self.at - time.time())
+
+    def expired(self):
+        return self.at is not None and time.time() >= self.at
+
+    def check(self):
+        """Raise :class:`TimeoutError` if the deadline has passed."""
+        if self.expired():
+            raise TimeoutError('Deadline exceeded')
+
+    def __repr__(self):
+        if self.at is None:
+            return '<Deadline none>'
+        return '<Deadline in {:.1f}s>'.format(self.at - time.time())
+
+
+_local = threading.local()
+
+
+def _deadlines():
+    if not hasattr(_local, 'deadlines'):
+        _local.deadlines = []
+    return _local.deadlines
+
+
+def current_deadline():
+    """Return the deadline of the innermost :func:`timeout` block of the
+    calling thread, or None.
+
+    """
+    deadlines = _deadlines()
+    return deadlines[-1] if deadlines else None
+
+
+def communicate(process, deadline=None, args=None):
+    """Like ``process.communicate()``, but kill the process if it is still
+    running when ``deadline`` passes.
+
+    :param args: The command, for the error message.
+    :raises: :class:`TimeoutError` if the process was killed.
+
+    """
+    remaining = None if deadline is None else deadline.remaining()
+    if remaining is None:
+        return process.communicate()
+    killed = []
+
+    def kill():
+        # the timer can still fire once the process has exited
+        if process.poll() is None:
+            process.kill()
+            killed.append(True)
+
+    timer = threading.Timer(remaining, kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        output = process.communicate()
+    finally:
+        timer.cancel()
+    # a process which exited successfully before the kill landed finished
+    # in time
+    if killed and process.returncode != 0:
+        raise TimeoutError('Deadline exceeded, killed {!r}'.format(
+            args or process))
+    return output
+
+
+def report_timeout(seconds, report=None, fresh_status=True):
+    """Write the diagnostics of a timeout after ``seconds`` to stderr.
+
+    :param report: If given, a callable returning a description of what
+        was still being waited for, built from what the wait last saw (it
+        must not block).
+
+    A fresh `juju status` is only added if the AMULET_TIMEOUT_STATUS
+    environment variable is set, and is given up after
+    :data:`TIMEOUT_STATUS_LIMIT` seconds, so that a struggling controller
+    can't hold up the failure.  This must not be called from a signal
+    handler.
+
+    :param bool fresh_status: Set to False to leave fetching the fresh
+        status, if wanted, to the caller.
+
+    """
+    sys.stderr.write('Timeout occurred ({}s)\n'.format(seconds))
+    if report is not None:
+        try:
+            sys.stderr.write(report())
+        except Exception as e:
+            sys.stderr.write('Unable to describe the wait: {}\n'.format(e))
+    if fresh_status and os.environ.get('AMULET_TIMEOUT_STATUS'):
+        sys.stderr.write('juju status:\n')
+        try:
+            # not bound by the deadline which just expired
+            sys.stderr.write(juju(['status', '--format', 'yaml'],
+                                  deadline=Deadline(TIMEOUT_STATUS_LIMIT))
+                             or '')
+        except (IOError, OSError, TimeoutError) as e:
+            sys.stderr.write('{}\n'.format(e))
+
+
+def timeout_gen(seconds, backoff=None, report=None, deadline=None):
     """
     Return a counting generator that raises a :class:`TimeoutError` after
     a number of seconds.
@@ -90,10 +364,20 @@ def timeout_gen(seconds):
     in the middle of doing its work / checking, which makes it more
     deterministic and easier to debug, but also means that you must ensure
     that the block does not contain an infinite loop or blocking system
-    call that needs to be preempted.  If you need a preemptive timeout, see
-    :func:`timeout`.
+    call that needs to be preempted.  Blocking calls which take a
+    :class:`Deadline` can be given ``deadline`` to be stopped at the same
+    time.
+
+    Between iterations the generator sleeps according to ``backoff``, but
+    never past the timeout, so that the block always gets a final iteration
+    right at the deadline.
 
     :param float seconds: Number of seconds after which to timeout.
+    :param Backoff backoff: Polling schedule to follow between iterations.
+        Defaults to a new :class:`Backoff` with the default settings.
+    :param report: Passed to :func:`report_timeout` on timeout.
+    :param Deadline deadline: Timeout earlier if it passes first; see
+        :meth:`Deadline.within`.
 
     Examples::
 
@@ -105,31 +389,65 @@ def timeout_gen(seconds):
         # wrong!
         for i in timeout(30):
             sleep(60)  # will not preempt! this will take 60s
+
+        # poll every 5s, waking early whenever `changed` is signalled
+        backoff = Backoff(initial=5, fast=0, factor=1)
+        for i in timeout_gen(300, backoff):
+            ...  # another thread calls backoff.wake()
     """
-    start = datetime.now()
+    if backoff is None:
+        backoff = Backoff()
+    deadline = Deadline.within(seconds, deadline)
     i = 0
     while True:
         yield i
-        if (datetime.now() - start).total_seconds() > seconds:
-            sys.stderr.write('Timeout occurred ({}s), '
-                             'printing juju status...'.format(seconds))
-            sys.stderr.write(juju(['status', '--format', 'yaml']))
-            raise TimeoutError()
+        remaining = deadline.remaining()
+        if deadline.expired():
+            report_timeout(seconds, report)
+            error = TimeoutError()
+            error.reported = True
+            raise error
+        backoff.sleep(remaining)
         i += 1
 
 
 @contextmanager
-def timeout(seconds):
-    def signal_handler(signum, frame):
-        sys.stderr.write('Timeout occurred, printing juju status...')
-        sys.stderr.write(juju(['status', '--format', 'yaml']))
-        raise TimeoutError()
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
+def timeout(seconds, report=None, deadline=None):
+    """Give the block ``seconds`` to run, as a :class:`Deadline` (which
+    is also what the block gets ``as``).
+
+    The deadline is the calling thread's current one for the duration of
+    the block, so the juju commands, waits and unit commands run in it
+    without a deadline of their own stop at it, raising
+    :class:`TimeoutError`.  Nested blocks can only shorten it.  Unlike the
+    SIGALRM handler this used to install, it works on any thread, and any
+    number of blocks can be active at once.
+
+    This is not preemptive: code which doesn't take a deadline (a plain
+    ``time.sleep``, a blocking call of some other library) is never
+    interrupted, and a block which gets stuck in such code runs past its
+    deadline.  A block which finishes late without raising isn't treated
+    as having timed out.
+
+    Diagnostics are written with :func:`report_timeout` when a
+    :class:`TimeoutError` is raised in the block after its deadline, unless
+    they were already.
+
+    :param Deadline deadline: Outer deadline, if not the current one.
+
+    """
+    deadline = Deadline.within(seconds, deadline)
+    deadlines = _deadlines()
+    deadlines.append(deadline)
     try:
-        yield
+        yield deadline
+    except TimeoutError as e:
+        if deadline.expired() and not e.reported:
+            report_timeout(seconds, report)
+            e.reported = True
+        raise
     finally:
-        signal.alarm(0)
+        deadlines.remove(deadline)
 
 
 class JujuVersion(object):
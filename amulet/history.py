@@ -0,0 +1,178 @@
+"""Recording and replay of the status seen by waits.
+
+If ``AMULET_STATUS_HISTORY`` is set, every :class:`~amulet.sentry.Talisman`
+keeps the statuses its waits look at in a :class:`StatusHistory`, a ring
+buffer of compressed snapshots with a fixed memory cap, so that a wait
+which times out can be inspected after the fact::
+
+    for timestamp, status in d.sentry.history.snapshots():
+        ...
+
+Setting ``AMULET_STATUS_RECORDING`` to a file name instead also streams
+every snapshot to that file (gzipped, if the name ends in ``.gz``), one
+JSON document per line.  Neither is set by default, as encoding every
+status polled from a large model costs about as much as parsing it.
+
+A recording can be replayed without any controller with
+:func:`amulet.waiter.replay`.
+
+"""
+import collections
+import gzip
+import json
+import threading
+import time
+import zlib
+
+# memory cap of the snapshots kept by each StatusHistory, in bytes
+HISTORY_SIZE = 4 * 1024 * 1024
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+
+class StatusHistory(object):
+    """A bounded record of the statuses of a model.
+
+    Snapshots are kept zlib-compressed; once their total size goes over
+    ``max_bytes`` the oldest ones are dropped.  A status identical to the
+    previous one only extends the time span of the latest snapshot.
+
+    :param str juju_env: Name of the model, written to the recording.
+    :param int max_bytes: Memory cap of the compressed snapshots.
+    :param str path: If given, also append every new snapshot to this file.
+
+    """
+    def __init__(self, juju_env=None, max_bytes=HISTORY_SIZE, path=None):
+        self.juju_env = juju_env
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.path = path
+        self._entries = collections.deque()
+        self._last = None
+        self._lock = threading.Lock()
+        self._file = _open(path, 'a') if path else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, status, timestamp=None):
+        """Add ``status`` to the history.  ``status`` is not modified, and
+        no reference to it is kept beyond the next call.
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if status is self._last and self._entries:
+                # the same shared snapshot again; nothing new to encode
+                self._entries[-1][1] = timestamp
+                return
+            self._last = status
+            data = json.dumps(status, sort_keys=True, separators=(',', ':'))
+            blob = zlib.compress(data.encode('utf-8'))
+            if self._entries and self._entries[-1][2] == blob:
+                self._entries[-1][1] = timestamp
+                return
+            self._entries.append([timestamp, timestamp, blob])
+            self.size += len(blob)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                self.size -= len(self._entries.popleft()[2])
+            if self._file is not None:
+                self._write(self._file, timestamp, data)
+
+    def _write(self, f, timestamp, data):
+        header = json.dumps({'model': self.juju_env, 'time': timestamp})
+        # splice the already serialized status in, instead of encoding
+        # it a second time
+        f.write('{}, "status": {}}}\n'.format(header[:-1], data).encode(
+            'utf-8'))
+        f.flush()
+
+    def snapshots(self):
+        """Return a list of ``(timestamp, status)`` tuples, oldest first.
+
+        The timestamp is the time at which the status was first seen.
+
+        """
+        with self._lock:
+            entries = list(self._entries)
+        return [(first, json.loads(zlib.decompress(blob).decode('utf-8')))
+                for first, last, blob in entries]
+
+    def dump(self, path):
+        """Write the snapshots in memory to ``path``, in the same format as
+        a recording.
+
+        """
+        with self._lock:
+            entries = list(self._entries)
+        with _open(path, 'w') as f:
+            for first, last, blob in entries:
+                self._write(f, first, zlib.decompress(blob).decode('utf-8'))
+
+    def close(self):
+        """Stop recording to the file, if any."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load(path):
+    """Yield the ``{'model', 'time', 'status'}`` records of a recording."""
+    with _open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+
+
+class Replay(object):
+    """Serve recorded statuses, in order, in place of a live model.
+
+    Registered with :func:`amulet.apiwatcher.watch`, it answers
+    :func:`amulet.waiter.status` (and so every wait) for its model: each
+    query returns the next recorded status, and wakes polling waits right
+    away so that the recording is replayed as fast as it is consumed.
+    Once the recording is exhausted, the last status is repeated.
+
+    :ivar int position: Number of statuses served so far.
+
+    """
+    error = None
+
+    def __init__(self, statuses):
+        if not statuses:
+            raise ValueError('Nothing to replay')
+        self.statuses = list(statuses)
+        self.position = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.statuses)
+
+    def status(self, services=None):
+        with self._lock:
+            status = self.statuses[min(self.position, len(self.statuses) - 1)]
+            self.position += 1
+            listeners = list(self._listeners) if not self.exhausted else []
+        for callback in listeners:
+            callback()
+        return status
+
+    def add_listener(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def stop(self):
+        pass
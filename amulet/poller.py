@@ -0,0 +1,239 @@
+"""Shared background polling of ``juju status``.
+
+A single :class:`StatusPoller` per model owns status acquisition and
+publishes every snapshot it fetches to all of its subscribers, so that any
+number of concurrent waits cost one ``juju status`` per tick instead of one
+each.
+
+Example::
+
+    poller = StatusPoller.for_model('my-model')
+    with poller.subscribe() as subscription:
+        for i in helpers.timeout_gen(300):
+            status = subscription.next()
+            if ready(status):
+                break
+
+"""
+import threading
+import time
+
+from . import apiwatcher
+from . import debuglog
+from . import waiter
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+
+def wake_sources(juju_env):
+    """Return the watchers which can tell when ``juju_env`` changes: its
+    :mod:`~amulet.apiwatcher` and :mod:`~amulet.debuglog` watchers, if any.
+
+    """
+    return [watcher for watcher in (apiwatcher.get_watcher(juju_env),
+                                    debuglog.get_watcher(juju_env))
+            if watcher is not None]
+
+
+class Snapshot(object):
+    """A single status document published by a :class:`StatusPoller`.
+
+    :ivar int seq: Sequence number of the fetch which produced it.
+    :ivar dict status: The status, as returned by :func:`waiter.status`
+        with only the :data:`~amulet.waiter.STATUS_PROJECTION` fields.
+    :ivar float time: Time at which the fetch was started.
+    :ivar Exception error: Set instead of ``status`` if the fetch failed.
+
+    """
+    def __init__(self, seq, status, timestamp, error=None):
+        self.seq = seq
+        self.status = status
+        self.time = timestamp
+        self.error = error
+
+
+class StatusPoller(object):
+    """Fetch ``juju status`` for a model on behalf of many waiters.
+
+    The polling thread is demand driven: it only runs ``juju status`` when
+    at least one subscriber is waiting for a snapshot newer than the latest
+    one, and every subscriber waiting at that moment receives the result of
+    the same fetch.  The thread is started by the first subscription and
+    exits once the last one is closed.
+
+    Each fetch is scoped to the union of the services its subscribers are
+    interested in; if any subscriber did not name its services, the whole
+    model is fetched.
+
+    Use :meth:`for_model` rather than instantiating this class directly, so
+    that all waiters on a model share the same poller.
+
+    :ivar int fetches: Number of status fetches performed so far.
+
+    """
+    def __init__(self, juju_env):
+        self.juju_env = juju_env
+        self.fetches = 0
+        self._cond = threading.Condition()
+        self._latest = None
+        self._started = 0  # seq of the most recently started fetch
+        self._demand = 0  # highest seq any subscriber is waiting for
+        self._subscribers = []
+        self._thread = None
+
+    @classmethod
+    def for_model(cls, juju_env):
+        """Return the shared poller for ``juju_env``, creating it if needed.
+
+        """
+        with _pollers_lock:
+            if juju_env not in _pollers:
+                _pollers[juju_env] = cls(juju_env)
+            return _pollers[juju_env]
+
+    def subscribe(self, services=None, backoff=None, deadline=None):
+        """Register a new subscriber, starting the polling thread if needed.
+
+        :param list services: Services the subscriber is interested in, or
+            None for the whole model.
+        :param backoff: The subscriber's :class:`~amulet.helpers.Backoff`.
+            If the model is followed by one of its :func:`wake_sources`,
+            it is woken up whenever that tells of a change.
+        :param deadline: A :class:`~amulet.helpers.Deadline` after which
+            :meth:`Subscription.next` stops waiting for a status.
+        :return: A :class:`Subscription`, which should be closed (or used as
+            a context manager) when no longer needed.
+
+        """
+        watchers = wake_sources(self.juju_env) if backoff is not None \
+            else []
+        for watcher in watchers:
+            watcher.add_listener(backoff.wake)
+        with self._cond:
+            subscription = Subscription(
+                self, self._started, services, backoff, watchers, deadline)
+            self._subscribers.append(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='amulet-status-{}'.format(self.juju_env))
+                self._thread.daemon = True
+                self._thread.start()
+            return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._cond:
+            self._subscribers.remove(subscription)
+            self._cond.notify_all()
+
+    def _scope(self):
+        """Return the services to fetch, or None for the whole model."""
+        services = set()
+        for subscription in self._subscribers:
+            if not subscription.services:
+                return None
+            services.update(subscription.services)
+        return sorted(services)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._subscribers and self._demand <= self._started:
+                    self._cond.wait(1)
+                if not self._subscribers:
+                    self._thread = None
+                    return
+                self._started += 1
+                seq = self._started
+                services = self._scope()
+
+            started = time.time()
+            try:
+                status = waiter.status(self.juju_env, services,
+                                       projected=True)
+                snapshot = Snapshot(seq, status, started)
+            except Exception as e:
+                snapshot = Snapshot(seq, None, started, error=e)
+
+            with self._cond:
+                self.fetches += 1
+                self._latest = snapshot
+                self._cond.notify_all()
+            # only the published snapshot may stay alive; a failed one would
+            # otherwise form a cycle with this frame through its traceback
+            snapshot = None
+
+    def next(self, after, deadline=None):
+        """Block until a snapshot newer than sequence number ``after`` has
+        been published, and return it.
+
+        If ``deadline`` passes first, the latest snapshot is returned again,
+        so that the caller's :func:`~amulet.helpers.timeout_gen` times out
+        (and reports on it) as usual.
+
+        :raises: :class:`~amulet.helpers.TimeoutError` if ``deadline``
+            passes before any snapshot was published.
+
+        """
+        with self._cond:
+            if after + 1 > self._demand:
+                self._demand = after + 1
+                self._cond.notify_all()
+            while self._latest is None or self._latest.seq <= after:
+                # wake up periodically so signals are delivered on all
+                # Python versions, and to give up at the deadline (after a
+                # last chance for a fetch in flight to come in)
+                remaining = None if deadline is None \
+                    else deadline.remaining()
+                self._cond.wait(min(1, remaining or 1))
+                if remaining == 0 and (self._latest is None or
+                                       self._latest.seq <= after):
+                    if self._latest is None:
+                        deadline.check()
+                    return self._latest
+            return self._latest
+
+
+class Subscription(object):
+    """A single waiter's view of a :class:`StatusPoller`.
+
+    Each call to :meth:`next` returns a status fetched after the previous
+    one was returned; the first call returns a status fetched after the
+    subscription was created.
+
+    """
+    def __init__(self, poller, seq, services=None, backoff=None,
+                 watchers=(), deadline=None):
+        self.poller = poller
+        self.deadline = deadline
+        self.seq = seq
+        self.services = list(services) if services else None
+        self.backoff = backoff
+        self.watchers = list(watchers)
+        self.closed = False
+
+    def next(self):
+        """Return the next raw status document for the model.
+
+        Re-raises the exception of the fetch, if it failed.
+
+        """
+        snapshot = self.poller.next(self.seq, self.deadline)
+        self.seq = snapshot.seq
+        if snapshot.error is not None:
+            raise snapshot.error
+        return snapshot.status
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.poller._unsubscribe(self)
+            for watcher in self.watchers:
+                watcher.remove_listener(self.backoff.wake)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,157 @@
+"""Deciding when a deployment has settled, from its hook activity.
+
+An idle agent is not enough to call a deployment settled: a hook which
+just ran may have changed relation data (or leader settings), and the units
+on the other side of the relation will run a hook of their own a moment
+later.  Instead of waiting a fixed time after the last hook,
+:class:`HookActivity` follows the hooks the units run and the relations
+between their services, and only makes a unit wait for the hooks it may
+still cause:
+
+- a unit whose service has no related units, and whose last hook is not
+  followed by another one, is settled as soon as it is idle;
+- otherwise, it is settled once it has been idle for ``latency`` seconds,
+  the time Juju takes to start the hooks of the related units;
+- a unit whose last hook is known to change nothing for other units (e.g.
+  ``update-status``) never waits.
+
+An optional ``min_idle`` floor is applied on top; ``min_idle=30`` with no
+observed activity is the fixed threshold amulet used to apply
+(:data:`amulet.sentry.IDLE_THRESHOLD`).
+
+Decisions only depend on the statuses passed to :meth:`HookActivity.observe`
+and on the time, so they can be evaluated against a recording; see
+``benchmarks/settle.py``.
+
+"""
+import re
+
+from .helpers import JUJU_VERSION
+
+# seconds Juju may take to start the hooks caused by a hook on a related unit
+HOOK_LATENCY = 5
+
+# hooks which Juju always follows with another hook on the same unit
+FOLLOWED_HOOKS = re.compile(
+    r'^(install|upgrade-charm|leader-elected|leader-settings-changed|'
+    r'.+-relation-(joined|departed)|.+-storage-attached)$')
+
+# hooks which can't cause hooks on other units, in practice
+QUIET_HOOKS = frozenset(['update-status', 'collect-metrics',
+                         'meter-status-changed'])
+
+_RUNNING_HOOK = re.compile(r'running (\S+) hook')
+
+
+def relation_graph(status):
+    """Return a ``{service: set(related services)}`` map of the raw
+    ``status``.  A service with a peer relation is related to itself.
+
+    """
+    graph = {}
+    for name, service in status.get('services', {}).items():
+        related = graph.setdefault(name, set())
+        for remotes in (service.get('relations') or {}).values():
+            related.update(remotes)
+        related.update(service.get('subordinate-to') or ())
+        for remote in related:
+            if remote != name:
+                graph.setdefault(remote, set()).add(name)
+    return graph
+
+
+class HookActivity(object):
+    """Settle detector fed with the successive raw statuses of a model.
+
+    :param float min_idle: Minimum number of seconds every agent must have
+        been idle, whatever its activity.
+    :param float latency: Number of seconds to give related units to start
+        the hooks a unit may have caused.
+
+    """
+    def __init__(self, min_idle=0, latency=HOOK_LATENCY):
+        self.min_idle = min_idle
+        self.latency = latency
+        self.graph = {}
+        self._units = {}
+        self._seen = {}
+        self._hooks = {}
+        self._ran = {}
+
+    def observe(self, status):
+        """Take note of the relations and running hooks in the raw
+        ``status``.
+
+        """
+        agent_key = 'agent-status' if JUJU_VERSION.major == 1 \
+            else 'juju-status'
+        self.graph = relation_graph(status)
+        counts = {}
+        for service in status.get('services', {}).values():
+            for unit_name, unit in (service.get('units') or {}).items():
+                self._observe_unit(unit_name, unit, agent_key, counts)
+                for sub_name, sub in (unit.get('subordinates') or {}).items():
+                    self._observe_unit(sub_name, sub, agent_key, counts)
+        self._units = counts
+
+    def _observe_unit(self, unit_name, unit, agent_key, counts):
+        service = unit_name.split('/')[0]
+        counts[service] = counts.get(service, 0) + 1
+        agent = unit.get(agent_key) or {}
+        seen = (agent.get('current'), agent.get('since'))
+        previous = self._seen.get(unit_name)
+        if seen[0] == 'executing':
+            match = _RUNNING_HOOK.search(agent.get('message') or '')
+            self._hooks[unit_name] = match.group(1) if match else None
+            if match:
+                self._ran.setdefault(unit_name, set()).add(match.group(1))
+        elif previous != seen and (previous is None or
+                                   previous[0] != 'executing'):
+            # it ran a hook between two observations; we can't tell which
+            self._hooks.pop(unit_name, None)
+        self._seen[unit_name] = seen
+
+    def hook(self, unit_name):
+        """Return the name of the last hook ``unit_name`` was seen running,
+        if it is known to be the last hook it ran.
+
+        """
+        return self._hooks.get(unit_name)
+
+    def ran(self, unit_name, hook):
+        """Return whether ``unit_name`` was seen running ``hook`` since
+        this object was created.  A hook which starts and ends between two
+        observations is missed.
+
+        """
+        return hook in self._ran.get(unit_name, ())
+
+    def may_cause_hooks(self, unit_name):
+        """Return whether the last hook of ``unit_name`` may still be
+        followed by a hook, on that unit or on a related one.
+
+        """
+        hook = self.hook(unit_name)
+        if hook in QUIET_HOOKS:
+            return False
+        if hook is not None and FOLLOWED_HOOKS.match(hook):
+            return True
+        service = unit_name.split('/')[0]
+        if not self._units:
+            # nothing observed; assume the worst
+            return True
+        for related in self.graph.get(service, ()):
+            if related != service or self._units.get(service, 0) > 1:
+                return True
+        return False
+
+    def settled_at(self, unit_name, idle_since):
+        """Return the time at which ``unit_name``, idle since the epoch time
+        ``idle_since`` (see :func:`amulet.sentry.since_epoch`), can be
+        considered settled.
+
+        """
+        wait = self.min_idle
+        if self.latency > wait and self.may_cause_hooks(unit_name):
+            wait = self.latency
+        return idle_since + wait
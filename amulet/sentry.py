@@ -1,25 +1,54 @@
-import gc
+import bisect
+import calendar
+import functools
 import json
 import logging
 import os
+import re
 import subprocess
+import threading
 import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 import pkg_resources
 
 from path import Path
 
 from . import actions
+from . import apiwatcher
+from . import debuglog
+from . import history
+from . import quiescence
 from . import waiter
 from . import helpers
+from .poller import StatusPoller, wake_sources
 
 JUJU_VERSION = helpers.JUJU_VERSION
 
 
-# number of seconds an agent must be idle to be considered quiescent
+# number of seconds an agent used to have to be idle to be considered
+# quiescent; pass it as ``idle_floor`` to the waits to get that behaviour back
 IDLE_THRESHOLD = 30
 
+# number of threads running Talisman.subscribe callbacks
+CALLBACK_WORKERS = 2
+
+# number of machines probed at once for running hooks, on Juju < 1.24
+PROBE_WORKERS = 8
+
+# number of units set up at once by a progressive Talisman
+UPLOAD_WORKERS = 4
+
+# longest interval between status polls of a wait for a given hook, when
+# the hook can only be caught running in the status
+HOOK_POLL_INTERVAL = 2
+
 log = logging.getLogger(__name__)
 
 
@@ -75,15 +104,23 @@ class UnitSentry(Sentry):
         pass
 
     @classmethod
-    def fromunitdata(cls, unit, unit_data):
+    def fromunitdata(cls, unit, unit_data, deadline=None):
+        """Create the sentry of ``unit`` from its ``unit_data`` in the
+        status, and upload the unit scripts to it by ``deadline``, if
+        given.
+
+        """
         address = unit_data['public-address']
         unitsentry = cls(address)
-        d = unitsentry.info = unit_data
+        # status is shared with other waiters; don't modify it
+        d = unitsentry.info = dict(unit_data)
         d['unit_name'] = unit
         d['service'], d['unit'] = unit.split('/')
 
         try:
-            unitsentry.upload_scripts()
+            unitsentry.upload_scripts(deadline)
+        except helpers.TimeoutError:
+            raise
         except:
             raise SentryError('Unable to upload scripts')
 
@@ -110,32 +147,45 @@ class UnitSentry(Sentry):
             self.info['unit_name'], action, action_args=action_args)
     action_do = run_action
 
-    def upload_scripts(self):
+    def upload_scripts(self, deadline=None):
+        """Copy the unit scripts to the unit.
+
+        :param deadline: A :class:`~amulet.helpers.Deadline` by which to
+            give up; see :meth:`~amulet.helpers.Deadline.within`.
+
+        """
+        deadline = helpers.Deadline.within(None, deadline)
         model = helpers.default_environment()
         model_flag = '-m' if helpers.JUJU_VERSION.major == 2 else '-e'
         source = pkg_resources.resource_filename(
             'amulet', os.path.join('unit-scripts', 'amulet'))
         dest = '/tmp/amulet'
         mkdir_cmd = 'mkdir -p -m a=rwx {}'.format(dest)
+
+        def pause():
+            # sleep a short bit before trying again, but not past the
+            # deadline
+            remaining = deadline.remaining()
+            time.sleep(5 if remaining is None else min(5, remaining))
+            deadline.check()
+
         for i in range(3):  # try thrice
-            output, code = self.ssh(mkdir_cmd,
-                                    model=model, raise_on_failure=False)
+            output, code = self.ssh(mkdir_cmd, model=model,
+                                    raise_on_failure=False, deadline=deadline)
             if code == 0:
                 break
-            time.sleep(5)  # sleep a short bit and try again
+            pause()
 
+        cmd = (['juju', 'scp', model_flag, model] + Path(source).files() +
+               ['{}:{}'.format(self.info['unit_name'], dest)])
         for i in range(3):  # try thrice
-            try:
-                subprocess.check_call(['juju', 'scp', model_flag, model] +
-                                      Path(source).files() +
-                                      ['{}:{}'.format(self.info['unit_name'],
-                                                      dest)])
-            except subprocess.CalledProcessError:
-                if i == 2:  # final countdown
-                    raise
-                time.sleep(5)  # sleep a short bit and try again
-            else:
+            p = subprocess.Popen(cmd)
+            helpers.communicate(p, deadline, cmd)
+            if p.returncode == 0:
                 break
+            if i == 2:  # final countdown
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+            pause()
 
     def _fs_data(self, path):
         return self._run_unit_script("filesystem_data.py {}".format(path))
@@ -193,7 +243,7 @@ class UnitSentry(Sentry):
         """
         return self._run_unit_script("directory_listing.py {}".format(path))
 
-    def run(self, command):
+    def run(self, command, deadline=None):
         """Run an arbitrary command (as root) on the remote unit.
 
         Uses ``juju run`` to execute the command, which means the command
@@ -202,6 +252,8 @@ class UnitSentry(Sentry):
         :meth:`ssh` method.
 
         :param str command: The command to run.
+        :param deadline: A :class:`~amulet.helpers.Deadline` by which the
+            command is killed, if it is still running.
         :return: A 2-tuple containing the output of the command and the exit
             code of the command.
 
@@ -209,10 +261,10 @@ class UnitSentry(Sentry):
         this timeout, see the :meth:`_run` method.
 
         """
-        output, code = self._run(command)
+        output, code = self._run(command, deadline=deadline)
         return output.strip(), code
 
-    def _run(self, command, unit=None, timeout=300):
+    def _run(self, command, unit=None, timeout=300, deadline=None):
         """Run an arbitrary command (as root) on the remote unit.
 
         Uses ``juju run`` to execute the command, which means the command
@@ -225,27 +277,56 @@ class UnitSentry(Sentry):
             'wordpress/0'. If None, defaults to the unit for this
             :class:`UnitSentry`.
         :param int timeout: Seconds to wait before timing out.
+        :param deadline: A :class:`~amulet.helpers.Deadline` by which the
+            command is killed, if it is still running; see
+            :meth:`~amulet.helpers.Deadline.within`.
         :return: A 2-tuple containing the output of the command and the exit
             code of the command.
 
         """
-        unit = unit or self.info['unit_name']
-        cmd = [
-            'juju', 'run',
-            '--unit', unit,
-            '--timeout', "%ds" % timeout,
-            command
-        ]
+        deadline = helpers.Deadline.within(None, deadline)
+        deadline.check()
+        remaining = deadline.remaining()
+        if remaining is not None:
+            # have the unit give up too
+            timeout = max(1, min(timeout, int(remaining)))
+        cmd = self._run_cmd(command, unit, timeout)
         p = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
-        stdout, stderr = p.communicate()
+        stdout, stderr = helpers.communicate(p, deadline, cmd)
         output = stdout if p.returncode == 0 else stderr
         return output.decode('utf8'), p.returncode
 
-    def ssh(self, command, unit=None, raise_on_failure=False, model=None):
+    def _run_cmd(self, command, unit=None, timeout=300):
+        unit = unit or self.info['unit_name']
+        return [
+            'juju', 'run',
+            '--unit', unit,
+            '--timeout', "%ds" % timeout,
+            command
+        ]
+
+    def run_async(self, command):
+        """Coroutine version of :meth:`run`, for use with asyncio::
+
+            output, code = await unit.run_async('hostname')
+
+        The command is run in an asyncio subprocess, so many commands can
+        run concurrently from one event loop; cancelling the coroutine
+        kills the command.  Requires Python 3.5 or later.
+
+        :param str command: The command to run.
+        :return: A 2-tuple containing the output of the command and the exit
+            code of the command.
+
+        """
+        return helpers.require_asyncio().unit_run(self, command)
+
+    def ssh(self, command, unit=None, raise_on_failure=False, model=None,
+            deadline=None):
         """Run an arbitrary command (as the ubuntu user) against a remote
         unit, using `juju ssh`.
 
@@ -259,21 +340,22 @@ class UnitSentry(Sentry):
             :class:`UnitSentry`.
         :param bool raise_on_failure: If True, raises
             :class:`subprocess.CalledProcessError` if the command fails.
+        :param deadline: A :class:`~amulet.helpers.Deadline` by which the
+            command is killed, if it is still running; see
+            :meth:`~amulet.helpers.Deadline.within`.
         :return: A 2-tuple containing the output of the command and the exit
             code of the command.
 
         """
-        unit = unit or self.info['unit_name']
-        if model is None:
-            model = helpers.default_environment()
-        model_flag = '-m' if helpers.JUJU_VERSION.major == 2 else '-e'
-        cmd = ['juju', 'ssh', model_flag, model, unit, '-v', command]
+        deadline = helpers.Deadline.within(None, deadline)
+        deadline.check()
+        cmd = self._ssh_cmd(command, unit, model)
         p = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
-        stdout, stderr = p.communicate()
+        stdout, stderr = helpers.communicate(p, deadline, cmd)
         output = stdout if p.returncode == 0 else stderr
         if p.returncode != 0:
             print(output)
@@ -281,6 +363,26 @@ class UnitSentry(Sentry):
                 raise subprocess.CalledProcessError(p.returncode, cmd, output)
         return output.decode('utf8').strip(), p.returncode
 
+    def _ssh_cmd(self, command, unit=None, model=None):
+        unit = unit or self.info['unit_name']
+        if model is None:
+            model = helpers.default_environment()
+        model_flag = '-m' if helpers.JUJU_VERSION.major == 2 else '-e'
+        return ['juju', 'ssh', model_flag, model, unit, '-v', command]
+
+    def ssh_async(self, command, unit=None, raise_on_failure=False,
+                  model=None):
+        """Coroutine version of :meth:`ssh`, for use with asyncio::
+
+            output, code = await unit.ssh_async('uptime')
+
+        Takes the same arguments as :meth:`ssh`.  Cancelling the coroutine
+        kills the command.  Requires Python 3.5 or later.
+
+        """
+        return helpers.require_asyncio().unit_ssh(
+            self, command, unit, raise_on_failure, model)
+
     def _run_unit_script(self, cmd, working_dir=None):
         if working_dir is None:
             working_dir = '/var/lib/juju/agents/unit-{service}-{unit}/charm'.format(**self.info)
@@ -336,6 +438,214 @@ class UnitSentry(Sentry):
         raise Exception('Relationship not found')
 
 
+_STATES = {}
+
+
+def _intern(state):
+    """Return the canonical copy of a state string, so that a state shared
+    by many units and many polls is only stored once.
+
+    """
+    if state is None:
+        return None
+    return _STATES.setdefault(state, state)
+
+
+def _unit_key(unit_name):
+    """Sort key putting 'svc/10' after 'svc/9'."""
+    number = unit_name.split('/', 1)[1]
+    if number.isdigit():
+        return (0, int(number), '')
+    return (1, 0, number)
+
+
+class UnitIndex(dict):
+    """The ``{unit_name: UnitSentry}`` dict of a :class:`Talisman`.
+
+    Also keeps an index of the unit names of each service, in order of
+    unit number, which is maintained as units are added and removed so
+    that :meth:`service` doesn't have to scan and sort all of the units.
+
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self._services = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, unit_name, unit_sentry):
+        if unit_name not in self:
+            service = unit_name.split('/', 1)[0]
+            bisect.insort(self._services.setdefault(service, []),
+                          (_unit_key(unit_name), unit_name))
+        dict.__setitem__(self, unit_name, unit_sentry)
+
+    def __delitem__(self, unit_name):
+        dict.__delitem__(self, unit_name)
+        service = unit_name.split('/', 1)[0]
+        entries = self._services[service]
+        entries.pop(bisect.bisect_left(
+            entries, (_unit_key(unit_name), unit_name)))
+        if not entries:
+            del self._services[service]
+
+    def pop(self, unit_name, *default):
+        if unit_name not in self:
+            return dict.pop(self, unit_name, *default)
+        unit_sentry = self[unit_name]
+        del self[unit_name]
+        return unit_sentry
+
+    def popitem(self):
+        unit_name = next(iter(self))
+        return unit_name, self.pop(unit_name)
+
+    def setdefault(self, unit_name, default=None):
+        if unit_name not in self:
+            self[unit_name] = default
+        return self[unit_name]
+
+    def update(self, *args, **kwargs):
+        for unit_name, unit_sentry in dict(*args, **kwargs).items():
+            self[unit_name] = unit_sentry
+
+    def clear(self):
+        dict.clear(self)
+        self._services.clear()
+
+    def service(self, service):
+        """Return the sentries of the units of ``service``, in order."""
+        return [self[unit_name]
+                for key, unit_name in self._services.get(service, ())]
+
+
+class UnitState(object):
+    """The normalized status of a single unit, as returned (per service)
+    by :meth:`Talisman.get_status`.
+
+    The commonly used fields are available as attributes.  For
+    compatibility, the record can also be read like the dictionary which
+    used to represent it, with the keys 'machine-state', 'public-address',
+    'workload-status', 'agent-status', 'agent-state' and 'agent-state-info'.
+
+    :ivar str workload: Current workload status, e.g. 'active'.
+    :ivar str message: Workload status message.
+    :ivar str agent: Current agent status, e.g. 'idle'.
+    :ivar str agent_since: When the agent status last changed.
+
+    """
+    __slots__ = ('name', 'machine_state', 'public_address',
+                 'workload', 'message', 'workload_since',
+                 'agent', 'agent_since', 'agent_state', 'agent_state_info')
+
+    def __init__(self, name, machine_state=None, public_address=None,
+                 workload=None, message=None, workload_since=None,
+                 agent=None, agent_since=None, agent_state=None,
+                 agent_state_info=None):
+        self.name = name
+        self.machine_state = machine_state
+        self.public_address = public_address
+        self.workload = workload
+        self.message = message
+        self.workload_since = workload_since
+        self.agent = agent
+        self.agent_since = agent_since
+        self.agent_state = agent_state
+        self.agent_state_info = agent_state_info
+
+    @classmethod
+    def fromstatus(cls, name, unit, machine_state, agent_key):
+        """Build a record from the raw status of a unit.
+
+        :param str agent_key: Key of the agent status in ``unit``, which
+            depends on the Juju version.
+
+        """
+        workload = unit.get('workload-status') or {}
+        agent = unit.get(agent_key) or {}
+        return cls(name, machine_state, unit.get('public-address'),
+                   _intern(workload.get('current')), workload.get('message'),
+                   workload.get('since'),
+                   _intern(agent.get('current')), agent.get('since'),
+                   _intern(unit.get('agent-state')),
+                   unit.get('agent-state-info'))
+
+    @property
+    def has_workload_status(self):
+        """False on Juju versions without extended status."""
+        return self.workload is not None or self.workload_since is not None
+
+    @property
+    def has_agent_status(self):
+        return self.agent is not None or self.agent_since is not None
+
+    def _fields(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, UnitState):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<UnitState {} {}/{}>'.format(
+            self.name, self.workload, self.agent or self.agent_state)
+
+    # dict-style access, for compatibility
+    _keys = ('machine-state', 'public-address', 'workload-status',
+             'agent-status', 'agent-state', 'agent-state-info')
+
+    def __getitem__(self, key):
+        if key == 'machine-state':
+            return self.machine_state
+        if key == 'public-address':
+            return self.public_address
+        if key == 'workload-status':
+            return _status_dict(self.workload, self.workload_since,
+                                self.message)
+        if key == 'agent-status':
+            return _status_dict(self.agent, self.agent_since)
+        if key == 'agent-state':
+            return self.agent_state
+        if key == 'agent-state-info':
+            return self.agent_state_info
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys]
+
+
+def _status_dict(current, since, message=None):
+    d = {}
+    if current is not None:
+        d['current'] = current
+    if since is not None:
+        d['since'] = since
+    if message is not None:
+        d['message'] = message
+    return d
+
+
 class Talisman(object):
     """A dict-like object containing a collection of :class:`UnitSentry`
     objects, one for each unit in the deployment.
@@ -351,38 +661,226 @@ class Talisman(object):
         :attr:`~amulet.deployer.Deployment.sentry` attribute on an
         :class:`amulet.deployer.Deployment` instance.
 
+    :param bool progressive: Return right away, instead of once every unit
+        is up, and set up each unit in the background as soon as it is; see
+        :meth:`ready_units`.
+    :param deadline: A :class:`~amulet.helpers.Deadline` the units must be
+        up by, on top of ``timeout``.
+
     """
 
     def __init__(self, services, rel_sentry='relation-sentry',
-                 juju_env=None, timeout=300):
+                 juju_env=None, timeout=300, status=None, progressive=False,
+                 deadline=None):
         self.service_names = services
-        self.unit = {}
+        self.unit = UnitIndex()
         self.service = {}
+        self._subscriptions = []
+        self._stream_lock = threading.Lock()
+        self._stream = None
+        self._executor = None
+        self._loading = threading.Condition()
+        self._loaded = []
+        self._load_error = None
+        self._load_thread = None
 
         self.juju_env = juju_env or helpers.default_environment()
 
+        _watch_backend(self.juju_env)
+
+        if progressive and status is None:
+            self.status = None
+            # thread-local deadlines don't follow the loading thread
+            self._load_thread = threading.Thread(
+                target=self._load_progressively,
+                args=(timeout, helpers.Deadline.within(None, deadline)),
+                name='amulet-load-{}'.format(self.juju_env))
+            self._load_thread.daemon = True
+            self._load_thread.start()
+            return
+
         # Save the juju status so we can inspect it later if we don't
         # end up with what we expect in our dictionary of sentries.
-        self.status = self.wait_for_status(self.juju_env, services, timeout)
+        if status is None:
+            status = self.wait_for_status(self.juju_env, services, timeout,
+                                          deadline)
+        self._load_units(status, deadline)
 
+    def _unit_data(self, status):
+        """Yield the ``(unit_name, unit_data)`` of every unit of our
+        services in the raw ``status``, subordinates included.
+
+        """
+        services = self.service_names
         for service in services:
-            if service not in self.status['services']:
-                continue  # Raise something?
+            service_status = status['services'].get(service)
+            if not service_status or 'units' not in service_status:
+                continue
+            for unit, unit_data in service_status['units'].items():
+                yield unit, unit_data
+                for sub, subdata in unit_data.get('subordinates', {}).items():
+                    if sub.split('/')[0] in services:
+                        yield sub, subdata
 
-            service_status = self.status['services'][service]
+    def _load_units(self, status, deadline=None):
+        """Add a :class:`UnitSentry` for every unit of our services in
+        ``status`` which doesn't have one yet, by ``deadline``.
 
-            if 'units' not in service_status:
-                continue
+        """
+        self.status = status
+        for unit, unit_data in self._unit_data(status):
+            if unit not in self.unit:
+                self._add_unit(unit, UnitSentry.fromunitdata(
+                    unit, unit_data, deadline))
+
+    def _add_unit(self, unit_name, unit_sentry):
+        with self._loading:
+            self.unit[unit_name] = unit_sentry
+            self._loaded.append(unit_name)
+            self._loading.notify_all()
+
+    def _load_progressively(self, timeout, deadline=None):
+        """Body of the loading thread of a progressive Talisman: set up
+        the units as they come up, in a pool of :data:`UPLOAD_WORKERS`
+        threads, until all of them are.
+
+        """
+        timeout = int(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
+        deadline = helpers.Deadline(timeout, deadline)
+        tracker = StatusTracker(_unit_ready)
+        backoff = helpers.Backoff()
+        pool = ThreadPool(UPLOAD_WORKERS)
+        started = set()
+        errors = []
+
+        def load(unit_name, unit_data):
+            try:
+                # the pool's threads don't share this one's deadlines
+                self._add_unit(unit_name, UnitSentry.fromunitdata(
+                    unit_name, unit_data, deadline))
+            except Exception as e:
+                errors.append(e)
+                backoff.wake()
 
-            for unit in service_status['units']:
-                unit_data = service_status['units'][unit]
-                self.unit[unit] = UnitSentry.fromunitdata(unit, unit_data)
-                if 'subordinates' in unit_data:
-                    for sub in unit_data['subordinates']:
-                        if sub.split('/')[0] not in services:
+        try:
+            with self._subscribe(backoff=backoff,
+                                 deadline=deadline) as subscription:
+                for i in helpers.timeout_gen(timeout, backoff,
+                                             tracker.report, deadline):
+                    raw = subscription.next()
+                    self.status = raw
+                    status = self._normalize_status(raw)
+                    done = _services_ready(status, tracker, self.service_names)
+                    units = dict((name, unit) for units in status.values()
+                                 for name, unit in units.items())
+                    for unit_name, unit_data in self._unit_data(raw):
+                        unit = units.get(unit_name)
+                        if unit_name in started or unit is None:
                             continue
-                        subdata = unit_data['subordinates'][sub]
-                        self.unit[sub] = UnitSentry.fromunitdata(sub, subdata)
+                        if _unit_ready(unit_name, unit):
+                            started.add(unit_name)
+                            pool.apply_async(load, (unit_name, unit_data))
+                    if errors:
+                        raise errors[0]
+                    if done:
+                        break
+                    if tracker.changed:
+                        backoff.reset()  # things are moving
+            pool.close()
+            pool.join()
+            if errors:
+                raise errors[0]
+        except Exception as e:
+            pool.terminate()
+            with self._loading:
+                self._load_error = e
+        with self._loading:
+            self._load_thread = None
+            self._loading.notify_all()
+
+    def ready_units(self, timeout=None):
+        """Yield ``(unit_name, unit_sentry)`` for each unit, as soon as it
+        is up and set up, until all of them are.
+
+        With a progressive Talisman, this lets tests start on the units of
+        fast services while slow ones are still coming up::
+
+            d.setup(progressive=True)
+            for unit_name, unit in d.sentry.ready_units():
+                check(unit)
+
+        Otherwise, all the units are yielded right away.
+
+        :param int timeout: Number of seconds to wait for all the units.
+            By default, the timeout given to the Talisman applies.
+        :raises: :class:`amulet.TimeoutError` if ``timeout`` expires, or
+            the error which stopped the units from being set up.
+
+        """
+        deadline = helpers.Deadline.within(timeout)
+        position = 0
+        while True:
+            with self._loading:
+                while (position == len(self._loaded) and
+                       self._load_thread is not None):
+                    if deadline.expired():
+                        raise helpers.TimeoutError(
+                            'Units not ready after {}s: {}'.format(
+                                timeout, self._pending_units()))
+                    # wake up periodically so signals are delivered
+                    remaining = deadline.remaining()
+                    self._loading.wait(
+                        1 if remaining is None else min(1, remaining))
+                loaded = self._loaded[position:]
+                error = self._load_error
+                finished = self._load_thread is None
+            for unit_name in loaded:
+                unit_sentry = self.unit.get(unit_name)
+                if unit_sentry is not None:  # unless removed since
+                    yield unit_name, unit_sentry
+            position += len(loaded)
+            if finished and position == len(self._loaded):
+                if error is not None:
+                    raise error
+                return
+
+    def wait_loaded(self, timeout=None):
+        """Block until every unit of a progressive Talisman is set up.
+        See :meth:`ready_units`.
+
+        """
+        for unit in self.ready_units(timeout):
+            pass
+
+    def _pending_units(self):
+        if self.status is None:
+            return 'all'
+        return ', '.join(sorted(
+            name for name, data in self._unit_data(self.status)
+            if name not in self.unit)) or 'none'
+
+    def refresh(self, timeout=300):
+        """Wait for all units to come up (see :meth:`wait_for_status`), and
+        add sentries for any units which were added since this object was
+        created.  Only the new units are set up.
+
+        With a progressive Talisman, the units it is still setting up are
+        waited for first, so that none of them is set up twice.
+
+        :param int timeout: Time to wait before timing out.
+
+        """
+        deadline = helpers.Deadline.within(timeout)
+        with self._loading:
+            while self._load_thread is not None:
+                deadline.check()
+                # wake up periodically so signals are delivered
+                remaining = deadline.remaining()
+                self._loading.wait(
+                    1 if remaining is None else min(1, remaining))
+        # units the loader failed to set up are tried again here
+        self._load_units(self.wait_for_status(
+            self.juju_env, self.service_names, timeout, deadline), deadline)
 
     def __getitem__(self, service):
         """Return the UnitSentry object(s) for ``service``
@@ -392,7 +890,8 @@ class Talisman(object):
             "service_name/unit_num"
 
         If the first form is used, a list (possibly empty) of all the
-        UnitSentry objects for that service is returned.
+        UnitSentry objects for that service is returned, in order of unit
+        number.
 
         If the second form is used, a single object, the UnitSentry for
         the specified unit, is returned.
@@ -416,8 +915,8 @@ class Talisman(object):
             >>> for sentry in d.sentry['meteor']:
             ...     print(sentry.info['service'], sentry.info['unit'])
             ...
-            meteor 1
             meteor 0
+            meteor 1
             >>>
 
         """
@@ -425,57 +924,57 @@ class Talisman(object):
             unit_name = service
             return self.unit[unit_name]
         else:
-            return [unit_sentry
-                    for unit_name, unit_sentry in sorted(self.unit.items())
-                    if service == unit_name.split('/', 1)[0]]
+            return self.unit.service(service)
+
+    def _subscribe(self, juju_env=None, services=None, backoff=None,
+                   deadline=None):
+        """Subscribe to the shared status poller for this model."""
+        if services is None:
+            services = self.service_names
+        poller = StatusPoller.for_model(juju_env or self.juju_env)
+        return poller.subscribe(services, backoff, deadline)
+
+    @helpers.reify
+    def history(self):
+        """A :class:`~amulet.history.StatusHistory` of the statuses seen by
+        the waits of this Talisman, or None if they aren't kept.
+
+        Encoding every status has a cost on large models, so they are only
+        kept if AMULET_STATUS_HISTORY is set, or recorded to a file if
+        AMULET_STATUS_RECORDING is; a history can also be assigned to this
+        attribute.
+
+        """
+        path = os.environ.get('AMULET_STATUS_RECORDING')
+        if not (path or os.environ.get('AMULET_STATUS_HISTORY')):
+            return None
+        return history.StatusHistory(getattr(self, 'juju_env', None),
+                                     path=path)
+
+    def _next_status(self, subscription, observe=None):
+        """Return the next status from ``subscription``, normalized, and
+        record it in :attr:`history`, if it is kept.
+
+        :param observe: If given, called with the raw status first.
+
+        """
+        status = subscription.next()
+        if self.history is not None:
+            self.history.record(status)
+        if observe is not None:
+            observe(status)
+        return self._normalize_status(status)
 
     def get_status(self, juju_env=None):
-        status = waiter.status(juju_env or self.juju_env)
-        machine_states = {}
-        normalized = {}
-
-        def machine_state(machine_dict):
-            if JUJU_VERSION.major == 1:
-                return machine_dict.get('agent-state')
-            return machine_dict.get('juju-status', {}).get('current')
-
-        def agent_status(unit_dict):
-            key = 'agent-status' if JUJU_VERSION.major == 1 else 'juju-status'
-            return unit_dict.get(key, {})
-
-        for number, machine in status['machines'].items():
-            machine_states[number] = machine_state(machine)
-            for container_name, container in machine.get('containers', {}).items():
-                machine_states[container_name] = machine_state(container)
-
-        for service_name, service in status['services'].items():
-            if 'units' not in service and 'relations' not in service:
-                # ignore unrelated subordinates; they will never become ready
-                continue
-            normalized.setdefault(service_name, {})
-            for unit_name, unit in service.get('units', {}).items():
-                normalized[service_name][unit_name] = {
-                    'machine-state': machine_states.get(unit.get('machine')),
-                    'public-address': unit.get('public-address'),
-                    'workload-status': unit.get('workload-status', {}),
-                    'agent-status': agent_status(unit),
-                    'agent-state': unit.get('agent-state'),
-                    'agent-state-info': unit.get('agent-state-info'),
-                }
-                for sub_name, sub in unit.get('subordinates', {}).items():
-                    sub_service = sub_name.split('/')[0]
-                    normalized.setdefault(sub_service, {})
-                    normalized[sub_service][sub_name] = {
-                        'machine-state': machine_states.get(unit.get('machine')),
-                        'public-address': sub.get('public-address'),
-                        'workload-status': sub.get('workload-status', {}),
-                        'agent-status': agent_status(sub),
-                        'agent-state': sub.get('agent-state'),
-                        'agent-state-info': sub.get('agent-state-info'),
-                    }
-        return normalized
-
-    def wait_for_status(self, juju_env, services, timeout=300):
+        return self._normalize_status(
+            waiter.status(juju_env or self.juju_env, self.service_names,
+                          projected=True))
+
+    def _normalize_status(self, status):
+        return _normalize_status(status)
+
+    def wait_for_status(self, juju_env, services, timeout=300,
+                        deadline=None):
         """Return environment status, but only after all units have a
         public-address assigned and are in a 'started' state.
 
@@ -491,83 +990,126 @@ class Talisman(object):
         :param dict services: Dictionary of services in the environment.
         :param int timeout: Time to wait before timing out. If environment
             variable AMULET_WAIT_TIMEOUT is set, it overrides this value.
+        :param deadline: A :class:`~amulet.helpers.Deadline` to time out at
+            if it comes first.
         :return: Dictionary of juju enviroment status.
 
         """
         timeout = int(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
-
-        def check_status(status, juju_env, services):
-            for service_name in services:
-                if service_name not in status:
-                    # ignore unrelated subordinates; they will never become ready
-                    continue
-                if not status[service_name]:
-                    return False  # expected subordinate
-                for unit_name, unit in status[service_name].items():
-                    state = unit['workload-status'].get('current') or unit['agent-state']
-                    message = unit['workload-status'].get('message') or unit['agent-state-info']
-                    if state == 'error':
-                        raise Exception('Error on unit {}: {}'.format(
-                            unit_name, message))
-                    if unit['machine-state'] != 'started':
-                        return False
-                    if not unit['public-address']:
-                        return False
-                    # Some substrates (like Amazon) will return a
-                    # public-address while the machine is still allocating, so
-                    # it's necessary to also check the agent-state to see if
-                    # the unit is ready.
-                    if unit['agent-state'] not in (None, 'started'):
-                        return False
-            return True
-
-        for i in helpers.timeout_gen(timeout):
-            status = self.get_status(juju_env)
-            if check_status(status, juju_env, services):
-                return waiter.status(juju_env)
-            del status
-            gc.collect()
-
-    def wait(self, timeout=300):
+        deadline = helpers.Deadline.within(timeout, deadline)
+
+        tracker = StatusTracker(_unit_ready)
+        backoff = helpers.Backoff()
+        raw = [None]
+
+        def observe(status):
+            raw[0] = status
+
+        with self._subscribe(juju_env, services, backoff,
+                             deadline) as subscription:
+            for i in helpers.timeout_gen(timeout, backoff, tracker.report,
+                                         deadline):
+                status = self._next_status(subscription, observe)
+                if _services_ready(status, tracker, services):
+                    if waiter.STATUS_FORMAT != 'json':
+                        # polled YAML status is projected; the units'
+                        # sentries get the whole of their status
+                        return waiter.status(juju_env, services)
+                    return raw[0]
+                if tracker.changed:
+                    backoff.reset()  # things are moving; keep polling fast
+
+    def wait(self, timeout=300, idle_floor=None, units=None, hook=None,
+             since=None, fail_on_error=True, deadline=None):
         """Wait for all units to finish running hooks.
 
+        The deployment is settled once every agent is idle and no unit can
+        still cause a hook on a related unit; see
+        :mod:`amulet.quiescence`.
+
+        The wait can be limited to some of the units, in which case the
+        others are neither checked nor probed, and can be busy (or broken)
+        without holding it up.  It can also wait for those units to run a
+        given hook before settling, e.g. after changing their
+        configuration::
+
+            since = time.time()
+            d.configure('mysql', {'dataset-size': '50%'})
+            d.sentry.wait(units=['mysql'], hook='config-changed',
+                          since=since)
+
+        The hook is seen finishing in the debug-log of the model if it is
+        followed (see :mod:`amulet.debuglog`).  Otherwise it has to be seen
+        running in the status of the units, or, for a hook shorter than the
+        polling interval, is assumed to have run once the agent status of
+        a unit changed after ``since``, which any hook does.  Set
+        AMULET_DEBUG_LOG to tell hooks apart, or on Juju < 1.24.
+
         :param int timeout: Number of seconds to wait before timing-out.
             If environment variable AMULET_WAIT_TIMEOUT is set, it overrides
             this value.
+        :param float idle_floor: Minimum number of seconds every agent must
+            have been idle, as an extra safety margin.  Defaults to the
+            environment variable AMULET_IDLE_FLOOR, or 0.  Pass
+            :data:`IDLE_THRESHOLD` for the fixed wait of earlier versions.
+        :param list units: Names of the services and units to wait for.
+            Defaults to all of them.
+        :param str hook: Name of a hook each unit waited for must run
+            before it is settled.
+        :param float since: Epoch time after which the hook must have
+            finished, to count.  Defaults to the start of the wait; pass
+            the time taken before triggering the hook, so that a hook which
+            finished before the wait started is not missed.
+        :param bool fail_on_error: Raise as soon as a unit waited for goes
+            into an error state, since the deployment can't settle then.
+        :param deadline: A :class:`~amulet.helpers.Deadline` to time out at
+            if it comes first.
         :raises: :class:`amulet.TimeoutError` if the timeout is exceeded.
+        :raises: :class:`amulet.UnitError`, naming the failing units, their
+            failed hooks and status messages, if ``fail_on_error`` is set.
 
         """
         timeout = int(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
 
-        def check_status(status):
-            for service_name in self.service_names:
-                service = status.get(service_name, {})
-                for unit_name, unit in service.items():
-                    if unit['agent-status']:
-                        if unit['agent-status'].get('current') != 'idle':
-                            return False
-                        since = datetime.strptime(unit['agent-status']['since'][:20], '%d %b %Y %H:%M:%S')
-                        if (datetime.now() - since).total_seconds() < IDLE_THRESHOLD:
-                            return False
-                    else:
-                        running_hooks = self.unit[unit_name].juju_agent()
-                        if running_hooks is None or running_hooks:
-                            return False
-            return True
-
         log.info('Waiting up to %s seconds for deployment to settle...',
                  timeout)
         start = datetime.now()
-        for i in helpers.timeout_gen(timeout):
-            status = self.get_status()
-            if check_status(status):
-                log.info('Deployment settled in %s seconds.',
-                         (datetime.now() - start).total_seconds())
-                return
-            del status
-            gc.collect()
-
-    def wait_for_messages(self, messages, timeout=300):
+        deadline = helpers.Deadline.within(timeout, deadline)
+        services, named, scope = self.service_names, (), None
+        if units is not None:
+            services, named, scope = _unit_scope(units)
+        activity = _hook_activity(idle_floor)
+        if hook is None:
+            check = functools.partial(self._unit_settled, activity)
+        else:
+            check = functools.partial(
+                self._hook_settled, activity, hook,
+                time.time() if since is None else since)
+        tracker = StatusTracker(check)
+        backoff = _settle_backoff(self.juju_env)
+        if hook is not None and debuglog.get_watcher(self.juju_env) is None:
+            # the hook has to be caught running
+            backoff = helpers.Backoff(ceiling=HOOK_POLL_INTERVAL)
+        with self._subscribe(services=services, backoff=backoff,
+                             deadline=deadline) as subscription:
+            for i in helpers.timeout_gen(timeout, backoff, tracker.report,
+                                         deadline):
+                status = self._next_status(subscription, activity.observe)
+                if fail_on_error:
+                    _raise_for_errors(status, services, scope)
+                self._agents.update(status, scope)
+                missing = [name for name in named
+                           if name not in status.get(name.split('/')[0], {})]
+                if tracker.update(status, services, scope) and not missing:
+                    log.info('Deployment settled in %s seconds.',
+                             (datetime.now() - start).total_seconds())
+                    return
+                if tracker.changed:
+                    backoff.reset()  # things are moving; keep polling fast
+                backoff.poll_at = tracker.ready_at
+
+    def wait_for_messages(self, messages, timeout=300, fail_on_error=True,
+                          deadline=None):
         """Wait for specific extended status messages to be set via status-set.
 
         Note that if this is called on an environment that doesn't support
@@ -582,6 +1124,10 @@ class Talisman(object):
             list is given, then there must be a one-to-one match between the
             messages and the units, though the order doesn't matter.
         :param int timeout: Number of seconds to wait before timing-out.
+        :param bool fail_on_error: Raise :class:`amulet.UnitError` as soon
+            as a unit of one of the services goes into an error state.
+        :param deadline: A :class:`~amulet.helpers.Deadline` to time out at
+            if it comes first.
 
         Examples::
 
@@ -606,30 +1152,901 @@ class Talisman(object):
             t.wait_for_messages({'ubuntu': ['ready', 'ok']})
 
         """
-        def get_messages(service, status):
-            messages = []
-            for unit in status.get(service, {}).values():
-                if not unit['workload-status']:
-                    raise helpers.UnsupportedError()
-                messages.append(unit['workload-status'].get('message', ''))
-            return messages
+        matcher = StatusMessageMatcher()
+        backoff = helpers.Backoff()
+        seen = _LastStatus(list(messages))
+        deadline = helpers.Deadline.within(timeout, deadline)
+        with self._subscribe(services=list(messages), backoff=backoff,
+                             deadline=deadline) as subscription:
+            for i in helpers.timeout_gen(timeout, backoff, seen.report,
+                                         deadline):
+                status = seen.status = self._next_status(subscription)
+                if fail_on_error:
+                    _raise_for_errors(status, list(messages))
+                if _messages_match(messages, status, matcher):
+                    return
+
+    def wait_for(self, condition, timeout=300, fail_on_error=True,
+                 deadline=None):
+        """Wait until ``condition`` is met.
+
+        The condition, usually a combination of several (see
+        :mod:`amulet.conditions`), is checked against every new status in a
+        single poll loop.
+
+        :param condition: A :class:`~amulet.conditions.Condition`.
+        :param int timeout: Number of seconds to wait before timing-out.
+            If environment variable AMULET_WAIT_TIMEOUT is set, it overrides
+            this value.
+        :param bool fail_on_error: Raise :class:`amulet.UnitError` as soon
+            as a unit of one of the services the condition looks at goes
+            into an error state.
+        :param deadline: A :class:`~amulet.helpers.Deadline` to time out at
+            if it comes first.
+        :return: The normalized status which met the condition.
+        :raises: :class:`amulet.TimeoutError`, naming the part of the
+            condition which was still unmet, if the timeout is exceeded.
+
+        Example::
+
+            from amulet.conditions import all_of, message, unit_count
+
+            d.sentry.wait_for(all_of(
+                message('wordpress', 'ready'),
+                unit_count('haproxy', 3),
+            ))
+
+        """
+        timeout = int(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
+        services = sorted(condition.services())
+        backoff = helpers.Backoff()
+        unmet = condition
+        previous = None
+        seen = _LastStatus(services)
+        deadline = helpers.Deadline.within(timeout, deadline)
+        try:
+            with self._subscribe(services=services, backoff=backoff,
+                                 deadline=deadline) as subscription:
+                for i in helpers.timeout_gen(timeout, backoff, seen.report,
+                                             deadline):
+                    status = seen.status = self._next_status(subscription)
+                    if fail_on_error:
+                        _raise_for_errors(status, services)
+                    unmet = condition.evaluate(status)
+                    if unmet is None:
+                        return status
+                    if status != previous:
+                        backoff.reset()  # things are moving
+                        previous = status
+        except helpers.TimeoutError as e:
+            error = helpers.TimeoutError(
+                'Timed out waiting for {}; unmet: {}'.format(
+                    condition, unmet))
+            error.reported = e.reported
+            raise error
+
+    @helpers.reify
+    def _agents(self):
+        return AgentProbe(self)
+
+    def _unit_settled(self, activity, unit_name, unit):
+        """:class:`StatusTracker` check used by :meth:`wait`."""
+        settled = _agent_settled(unit_name, unit, activity)
+        if settled is not None:
+            return settled
+        # no agent-status means the agent has to be asked directly,
+        # which can change without the status changing
+        return not self._agents.running(unit_name), 0
+
+    def _hook_settled(self, activity, hook, since, unit_name, unit):
+        """:class:`StatusTracker` check used by :meth:`wait` when waiting
+        for a hook: the unit must have run ``hook`` since the epoch time
+        ``since`` before it can settle.
+
+        Without a debug-log, a hook too short to be seen running is taken
+        as run once the agent status changed after ``since``.
+
+        """
+        watcher = debuglog.get_watcher(self.juju_env)
+        if watcher is not None:
+            finished = watcher.finished(unit_name, hook)
+            ran = finished is not None and finished >= since
+        else:
+            # the status only has whole seconds
+            ran = (unit.agent_since is not None and
+                   since_epoch(unit.agent_since) >= int(since))
+        if not (ran or activity.ran(unit_name, hook)):
+            # the hook may run (or be logged) without the status changing
+            return False, 0
+        return self._unit_settled(activity, unit_name, unit)
+
+    def wait_async(self, timeout=300, idle_floor=None, units=None, hook=None,
+                   since=None, fail_on_error=True, deadline=None):
+        """Coroutine version of :meth:`wait`, for use with asyncio, taking
+        the same arguments::
+
+            await d.sentry.wait_async(units=['mysql'])
+
+        Status is fetched without blocking the event loop, so any number of
+        waits (on this or other deployments) can run concurrently.  The
+        timeout is enforced by the event loop, and the wait can be
+        cancelled.  Requires Python 3.5 or later.
+
+        """
+        return helpers.require_asyncio().wait(
+            self, timeout, idle_floor, units, hook, since, fail_on_error,
+            deadline)
+
+    def wait_for_status_async(self, juju_env, services, timeout=300):
+        """Coroutine version of :meth:`wait_for_status`."""
+        return helpers.require_asyncio().wait_for_status(
+            self, juju_env, services, timeout)
+
+    def wait_for_messages_async(self, messages, timeout=300,
+                                fail_on_error=True):
+        """Coroutine version of :meth:`wait_for_messages`."""
+        return helpers.require_asyncio().wait_for_messages(
+            self, messages, timeout, fail_on_error)
+
+    def subscribe(self, predicate, callback=None, once=False):
+        """Call ``callback`` whenever ``predicate`` becomes true.
+
+        ``predicate`` is called with the normalized status of the deployment
+        (a ``{service: {unit_name: UnitState}}`` dict) every time a new
+        status is collected.  Whenever its result turns from false to true,
+        ``callback`` is called with that status on a small pool of worker
+        threads, so a slow callback doesn't hold up status collection.
+
+        All subscriptions of a Talisman share a single background status
+        stream, which in turn shares status queries with any waits on the
+        same model, so subscriptions cost no extra controller queries.  The
+        stream stops when the last subscription is cancelled.
 
+        :param predicate: A callable taking the normalized status.
+        :param callback: A callable taking the normalized status, or None
+            to only use :meth:`StatusSubscription.wait`.
+        :param bool once: Cancel the subscription after it first fires.
+        :return: A :class:`StatusSubscription`.
+
+        Example::
+
+            def mysql_down(status):
+                return any(unit.workload == 'blocked'
+                           for unit in status['mysql'].values())
+
+            d.sentry.subscribe(mysql_down, lambda status: alarm())
+
+        """
+        subscription = StatusSubscription(self, predicate, callback, once)
+        with self._stream_lock:
+            self._subscriptions.append(subscription)
+            if self._stream is None:
+                self._stream = threading.Thread(target=self._run_stream)
+                self._stream.daemon = True
+                self._stream.start()
+        return subscription
+
+    def on_unit_state(self, unit_name, state, callback=None, once=True):
+        """Call ``callback`` when the unit ``unit_name`` enters ``state``.
+
+        :param str unit_name: The unit, in the form 'mysql/0'.
+        :param state: A workload status (e.g. 'active'), an agent status
+            (e.g. 'idle'), or a status message, either as a string or as a
+            compiled regular expression.
+        :param callback: A callable taking the normalized status.
+        :param bool once: Cancel the subscription after it first fires.
+        :return: A :class:`StatusSubscription`.
+
+        Example::
+
+            d.sentry.on_unit_state('mysql/0', 'ready', start_traffic)
+            d.sentry.on_unit_state('mysql/0', re.compile('ready')).wait(300)
+
+        """
+        service = unit_name.split('/')[0]
         matcher = StatusMessageMatcher()
-        for i in helpers.timeout_gen(timeout):
-            status = self.get_status()
-            for service, expected in messages.items():
-                actual = get_messages(service, status)
-                if not matcher.check(expected, actual):
-                    break
-            else:
-                return
-            del status
-            gc.collect()
+
+        def in_state(status):
+            unit = status.get(service, {}).get(unit_name)
+            if unit is None:
+                return False
+            for actual in (unit.workload, unit.agent, unit.agent_state,
+                           unit.message):
+                if actual and matcher.check_message(state, actual):
+                    return True
+            return False
+
+        return self.subscribe(in_state, callback, once)
+
+    def _unsubscribe(self, subscription):
+        with self._stream_lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _run_stream(self):
+        backoff = helpers.Backoff()
+        previous = None
+        with self._subscribe(backoff=backoff) as stream:
+            while True:
+                with self._stream_lock:
+                    subscriptions = list(self._subscriptions)
+                    if not subscriptions:
+                        self._stream = None
+                        return
+                try:
+                    status = self._next_status(stream)
+                except Exception as e:
+                    log.warning('Unable to get status of %s: %s',
+                                self.juju_env, e)
+                else:
+                    if status != previous:
+                        backoff.reset()  # things are moving
+                        previous = status
+                    for subscription in subscriptions:
+                        subscription._check(status)
+                backoff.sleep()
+
+    def _submit(self, callback, status):
+        with self._stream_lock:
+            if self._executor is None:
+                self._executor = ThreadPool(CALLBACK_WORKERS)
+        self._executor.apply_async(_call_safely, (callback, status))
 
     def _sync(self):
         pass
 
 
+def _watch_backend(juju_env):
+    """Start an API watcher for ``juju_env`` if AMULET_STATUS_BACKEND=api,
+    and a debug-log watcher if AMULET_DEBUG_LOG is set.
+
+    """
+    if os.environ.get('AMULET_STATUS_BACKEND') == 'api':
+        try:
+            apiwatcher.watch(juju_env)
+        except Exception as e:
+            log.warning('Unable to watch %s through the API, falling '
+                        'back to juju status: %s', juju_env, e)
+    if os.environ.get('AMULET_DEBUG_LOG'):
+        try:
+            debuglog.watch(juju_env)
+        except Exception as e:
+            log.warning('Unable to follow the debug-log of %s, falling '
+                        'back to polling: %s', juju_env, e)
+
+
+def _normalize_status(status):
+    """Return a ``{service: {unit_name: UnitState}}`` view of the raw
+    ``status``, including subordinate units under their own service.
+
+    """
+    machine_states = {}
+    normalized = {}
+    agent_key = 'agent-status' if JUJU_VERSION.major == 1 else 'juju-status'
+
+    def machine_state(machine_dict):
+        if JUJU_VERSION.major == 1:
+            return _intern(machine_dict.get('agent-state'))
+        return _intern(machine_dict.get('juju-status', {}).get('current'))
+
+    for number, machine in status['machines'].items():
+        machine_states[number] = machine_state(machine)
+        for container_name, container in machine.get('containers', {}).items():
+            machine_states[container_name] = machine_state(container)
+
+    for service_name, service in status['services'].items():
+        if 'units' not in service and 'relations' not in service:
+            # ignore unrelated subordinates; they will never become ready
+            continue
+        units = normalized.setdefault(service_name, {})
+        for unit_name, unit in service.get('units', {}).items():
+            machine = machine_states.get(unit.get('machine'))
+            units[unit_name] = UnitState.fromstatus(
+                unit_name, unit, machine, agent_key)
+            for sub_name, sub in unit.get('subordinates', {}).items():
+                sub_service = sub_name.split('/')[0]
+                normalized.setdefault(sub_service, {})[sub_name] = \
+                    UnitState.fromstatus(sub_name, sub, machine, agent_key)
+    return normalized
+
+
+_SINCES = {}
+
+# number of parsed timestamps kept by since_epoch
+SINCE_CACHE_SIZE = 4096
+
+
+def since_epoch(since):
+    """Return the time of a status ``since`` field, in seconds since the
+    epoch.
+
+    The offset at the end of the field (``Z``, ``+01:00``, ``-0400``) is
+    taken into account; a field without one is taken as local time.
+    Parsed values are cached on the raw string, which only changes when the
+    status does.
+
+    """
+    epoch = _SINCES.get(since)
+    if epoch is None:
+        if len(_SINCES) >= SINCE_CACHE_SIZE:
+            _SINCES.clear()
+        epoch = _SINCES[since] = _parse_since(since)
+    return epoch
+
+
+def _parse_since(since):
+    fields = time.strptime(since[:20], '%d %b %Y %H:%M:%S')
+    zone = since[20:].strip()
+    if not zone:
+        return time.mktime(fields)
+    offset = 0
+    if zone[0] in '+-':
+        digits = zone[1:].replace(':', '')
+        offset = int(digits[:2]) * 3600 + int(digits[2:4] or 0) * 60
+        if zone[0] == '-':
+            offset = -offset
+    return calendar.timegm(fields) - offset
+
+
+_HOOK_FAILED = re.compile(r'hook failed: "?([\w-]+)')
+
+
+def _unit_failure(unit_name, unit):
+    """Return a ``(unit_name, hook, message)`` tuple if ``unit`` is in a
+    state it won't leave on its own, otherwise None.
+
+    """
+    if unit.machine_state == 'error':
+        return unit_name, None, 'machine failed to start'
+    state = unit.workload or unit.agent_state
+    if state != 'error' and unit.agent != 'error':
+        return None
+    message = unit.message or unit.agent_state_info or ''
+    hook = _HOOK_FAILED.search(message)
+    return unit_name, hook.group(1) if hook else None, message
+
+
+def _describe_units(units, title='Units still being waited for:',
+                    now=None):
+    """Return a line per unit of the ``{unit_name: unit}`` dict ``units``,
+    with the state the unit is in, and for how long.
+
+    """
+    if not units:
+        return 'No unit was holding up the wait.\n'
+    now = time.time() if now is None else now
+    lines = [title]
+    for name in sorted(units):
+        unit = units[name]
+        states = []
+        if unit.machine_state not in (None, 'started'):
+            states.append('machine {}'.format(unit.machine_state))
+        agent = unit.agent or unit.agent_state
+        if agent:
+            states.append('agent {}'.format(agent))
+        if unit.workload:
+            states.append('workload {}'.format(unit.workload))
+        line = '  {}: {}'.format(name, ', '.join(states) or 'unknown')
+        message = unit.message or unit.agent_state_info
+        if message:
+            line += ' ({})'.format(message)
+        since = unit.agent_since or unit.workload_since
+        if since:
+            try:
+                line += ' for {:.0f}s'.format(now - since_epoch(since))
+            except ValueError:
+                pass
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+class _LastStatus(object):
+    """The last normalized status seen by a wait on ``services``, for
+    :func:`~amulet.helpers.report_timeout`.
+
+    """
+    def __init__(self, services):
+        self.services = services
+        self.status = None
+
+    def report(self):
+        if self.status is None:
+            return 'No status was received.\n'
+        return _describe_units(dict(
+            (name, unit) for service in self.services
+            for name, unit in self.status.get(service, {}).items()),
+            'Last status of the units waited for:')
+
+
+def _raise_for_errors(status, services, scope=None):
+    """Raise :class:`~amulet.helpers.UnitError`, naming every failing unit,
+    if any unit of ``services`` in the normalized ``status`` has failed.
+
+    :param scope: If given, a callable taking a unit name; only the units
+        for which it returns True are looked at.
+
+    """
+    failures = []
+    for service in services:
+        for unit_name, unit in status.get(service, {}).items():
+            if scope is not None and not scope(unit_name):
+                continue
+            failure = _unit_failure(unit_name, unit)
+            if failure is not None:
+                failures.append(failure)
+    if failures:
+        raise helpers.UnitError(failures)
+
+
+def _settle_backoff(juju_env):
+    """Return the :class:`~amulet.helpers.Backoff` of a wait for
+    ``juju_env`` to settle.  If a :class:`~amulet.debuglog.DebugLogWatcher`
+    wakes the wait whenever a hook finishes, status is only polled every
+    :data:`~amulet.debuglog.CONFIRM_INTERVAL` seconds, to confirm.
+
+    """
+    if debuglog.get_watcher(juju_env) is None:
+        return helpers.Backoff()
+    interval = debuglog.CONFIRM_INTERVAL
+    return helpers.Backoff(initial=interval, fast=0, factor=1,
+                           ceiling=interval)
+
+
+def _unit_scope(names):
+    """Return the ``(services, units, scope)`` of a wait limited to
+    ``names``, a list of service and unit names: the services to poll, the
+    units named explicitly, and a :class:`StatusTracker` scope.
+
+    """
+    services, units, whole = [], set(), set()
+    for name in names:
+        service = name.split('/')[0]
+        if service not in services:
+            services.append(service)
+        (units if '/' in name else whole).add(name)
+
+    def scope(unit_name):
+        return unit_name in units or unit_name.split('/')[0] in whole
+    return services, units, scope
+
+
+def _hook_activity(idle_floor=None):
+    if idle_floor is None:
+        idle_floor = float(os.environ.get('AMULET_IDLE_FLOOR') or 0)
+    return quiescence.HookActivity(min_idle=idle_floor)
+
+
+def _agent_settled(unit_name, unit, activity):
+    """Return whether the agent of ``unit`` has settled, according to the
+    :class:`~amulet.quiescence.HookActivity` ``activity``, as a
+    :class:`StatusTracker` verdict, or None if the unit has no agent-status
+    to tell (Juju < 1.24).
+
+    """
+    if not unit.has_agent_status:
+        return None
+    if unit.agent != 'idle':
+        return False
+    quiescent = activity.settled_at(unit_name, since_epoch(unit.agent_since))
+    if quiescent > time.time():
+        # nothing to do until then, unless the unit changes
+        return False, quiescent
+    return True
+
+
+def _unit_ready(unit_name, unit):
+    """:class:`StatusTracker` check used by :meth:`Talisman.wait_for_status`.
+
+    """
+    if unit.machine_state != 'started':
+        return False
+    if not unit.public_address:
+        return False
+    # Some substrates (like Amazon) will return a
+    # public-address while the machine is still allocating, so
+    # it's necessary to also check the agent-state to see if
+    # the unit is ready.
+    if unit.agent_state not in (None, 'started'):
+        return False
+    return True
+
+
+def _services_ready(status, tracker, services):
+    # ignore unrelated subordinates; they will never become ready
+    services = [s for s in services if s in status]
+    _raise_for_errors(status, services)
+    for service_name in services:
+        if not status[service_name]:
+            return False  # expected subordinate
+    return tracker.update(status, services)
+
+
+def _messages_match(messages, status, matcher):
+    for service, expected in messages.items():
+        actual = []
+        for unit in status.get(service, {}).values():
+            if not unit.has_workload_status:
+                raise helpers.UnsupportedError()
+            actual.append(unit.message or '')
+        if not matcher.check(expected, actual):
+            return False
+    return True
+
+
+class StatusTracker(object):
+    """Evaluate a per-unit check over successive normalized statuses.
+
+    Each call to :meth:`update` diffs the new status against the previous
+    one and throws away the cached verdicts of units which changed; the
+    check is then only run for units without a cached verdict, so on a
+    large, mostly settled model each tick costs a comparison per unit
+    rather than a full re-check.
+
+    :param check: A callable taking a unit name and normalized unit dict.
+        It may return a plain boolean, which is cached until the unit
+        changes, or a ``(ready, until)`` tuple, in which case the verdict is
+        only cached until the time ``until`` (``0`` meaning not at all).
+
+    :ivar set changed: Names of the units which changed in the last update.
+    :ivar ready_at: If the last update failed only on units whose verdict
+        expires at a known time, the time at which they could all pass (the
+        latest of those times), otherwise None.  Nothing can pass before
+        then unless the status changes, so there is no point polling
+        sooner.
+
+    """
+    def __init__(self, check):
+        self.check = check
+        self.changed = set()
+        self.ready_at = None
+        self._units = {}
+        self._verdicts = {}
+
+    def update(self, status, services, scope=None):
+        """Diff ``status`` against the previous update and return True if
+        the check passes for every unit of ``services``.
+
+        :param scope: If given, a callable taking a unit name; only the
+            units for which it returns True are checked.
+
+        """
+        units = {}
+        for service_name in services:
+            units.update(status.get(service_name, {}))
+        if scope is not None:
+            units = dict((name, unit) for name, unit in units.items()
+                         if scope(name))
+        previous = self._units
+        self.changed = set(name for name, unit in units.items()
+                           if previous.get(name) != unit)
+        self.changed.update(set(previous) - set(units))
+        for name in self.changed:
+            self._verdicts.pop(name, None)
+        self._units = units
+
+        # one pass over the units, which only stops early on a unit that
+        # fails for good, so that the pass also yields ready_at
+        now = time.time()
+        ready_at = 0
+        for name in units:
+            verdict = self._verdicts.get(name)
+            if verdict is None or verdict[1] is not None and verdict[1] <= now:
+                verdict = self.check(name, units[name])
+                if not isinstance(verdict, tuple):
+                    verdict = (verdict, None)
+                self._verdicts[name] = verdict
+            if not verdict[0]:
+                if not verdict[1]:
+                    self.ready_at = None
+                    return False
+                ready_at = max(ready_at, verdict[1])
+        self.ready_at = ready_at or None
+        return not ready_at
+
+    def blocking(self):
+        """Return the ``{unit_name: unit}`` of the units which failed the
+        check in the last update (or weren't checked, since it stopped at
+        an earlier failure), as of that update.
+
+        """
+        return dict((name, unit) for name, unit in self._units.items()
+                    if not self._verdicts.get(name, (False,))[0])
+
+    def report(self):
+        """Describe the units returned by :meth:`blocking`, for
+        :func:`~amulet.helpers.report_timeout`.
+
+        """
+        return _describe_units(self.blocking())
+
+
+def _call_safely(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        log.exception('Status subscription callback %r failed', callback)
+
+
+class AgentProbe(object):
+    """Tell which units of a :class:`Talisman` are running hooks, for agents
+    which don't report agent-status (Juju < 1.24), by running
+    ``juju_agent.py`` on their machines.
+
+    Units sharing a machine are answered by a single probe of one of them,
+    and machines are probed concurrently, by at most ``workers`` threads.
+    All the units of a status snapshot are probed at once, the first time
+    one of them is asked about, and the answers are reused for that
+    snapshot; a new one given to :meth:`update` starts over.  (A running
+    hook doesn't show in the status of these agents, so answers can't be
+    kept any longer than that.)
+
+    :param int workers: Defaults to :data:`PROBE_WORKERS`.
+
+    """
+    def __init__(self, talisman, workers=None):
+        self.talisman = talisman
+        self.workers = workers
+        self._status = None
+        self._scope = None
+        self._results = None
+        self._lock = threading.Lock()
+
+    def update(self, status, scope=None):
+        """Start a new snapshot, from the normalized ``status``.
+
+        :param scope: If given, a callable taking a unit name; only the
+            units for which it returns True are probed along with the one
+            asked about.
+
+        """
+        with self._lock:
+            if status is not self._status or scope is not self._scope:
+                self._status = status
+                self._scope = scope
+                self._results = None
+
+    def running(self, unit_name):
+        """Return whether ``unit_name`` is running a hook, or couldn't be
+        probed.
+
+        """
+        with self._lock:
+            if self._results is None or unit_name not in self._results:
+                names = [unit_name]
+                if self._status is not None:
+                    names.extend(
+                        name for units in self._status.values()
+                        for name, unit in units.items()
+                        if not unit.has_agent_status and
+                        name in self.talisman.unit and name != unit_name and
+                        (self._scope is None or self._scope(name)))
+                self._results = self._probe(names)
+            return self._results[unit_name]
+
+    def _probe(self, names):
+        machines = {}
+        for name in names:
+            # co-located units (and subordinates) share their address
+            info = self.talisman.unit[name].info
+            address = info.get('public-address') or name
+            machines.setdefault(address, []).append(name)
+        groups = list(machines.values())
+        workers = min(self.workers or PROBE_WORKERS, len(groups))
+        if workers <= 1:
+            outputs = [self._probe_machine(group) for group in groups]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                outputs = pool.map(self._probe_machine, groups)
+            finally:
+                pool.close()
+        results = {}
+        for output in outputs:
+            results.update(output)
+        return results
+
+    def _probe_machine(self, names):
+        output = self.talisman.unit[names[0]].juju_agent()
+        if output is None:
+            return dict((name, True) for name in names)
+        hooks = output.get('units')
+        if hooks is None:
+            # an older script only tells whether any hook is running
+            return dict((name, bool(output.get('hook'))) for name in names)
+        return dict((name, bool(hooks.get('unit-' + name.replace('/', '-'))))
+                    for name in names)
+
+
+class StatusSubscription(object):
+    """A predicate registered with :meth:`Talisman.subscribe`.
+
+    :ivar bool matched: Whether the predicate held for the latest status.
+    :ivar int fired: Number of times the callback has been triggered.
+
+    """
+    def __init__(self, talisman, predicate, callback=None, once=False):
+        self.talisman = talisman
+        self.predicate = predicate
+        self.callback = callback
+        self.once = once
+        self.matched = False
+        self.fired = 0
+        self._event = threading.Event()
+
+    def _check(self, status):
+        try:
+            matched = bool(self.predicate(status))
+        except Exception:
+            log.exception('Status subscription predicate %r failed',
+                          self.predicate)
+            matched = False
+        if matched and not self.matched:
+            self.fired += 1
+            if self.once:
+                self.cancel()
+            if self.callback is not None:
+                self.talisman._submit(self.callback, status)
+            self._event.set()
+        self.matched = matched
+
+    def wait(self, timeout=None):
+        """Block until the predicate has become true at least once, or
+        ``timeout`` seconds have passed.  Returns whether it has.
+
+        """
+        return self._event.wait(timeout)
+
+    def cancel(self):
+        """Stop checking the predicate."""
+        self.talisman._unsubscribe(self)
+
+
+class _ModelWait(object):
+    """Progress of one model in :func:`wait_all`."""
+    def __init__(self, target, idle_floor=None):
+        if isinstance(target, Talisman):
+            self.juju_env = target.juju_env
+            self.services = target.service_names
+            self.talisman = target
+        else:
+            self.juju_env, self.services = target
+            self.talisman = None
+        self.activity = _hook_activity(idle_floor)
+        self.tracker = StatusTracker(self.unit_settled)
+        self.backoff = _settle_backoff(self.juju_env)
+        self.due = 0
+        self.busy = False
+
+    def unit_settled(self, unit_name, unit):
+        if self.talisman is not None:
+            return self.talisman._unit_settled(self.activity, unit_name, unit)
+        settled = _agent_settled(unit_name, unit, self.activity)
+        if settled is None:
+            # only a Talisman can ask the agent directly
+            raise helpers.UnsupportedError()
+        return settled
+
+    def poll(self, results):
+        """Run one status check, and report its outcome to ``results``."""
+        try:
+            raw = waiter.status(self.juju_env, self.services, projected=True)
+            self.activity.observe(raw)
+            status = _normalize_status(raw)
+            _raise_for_errors(status, self.services)
+            if self.talisman is not None:
+                self.talisman._agents.update(status)
+            results.put((self, self.tracker.update(status, self.services)))
+        except Exception as e:
+            results.put((self, e))
+
+    def wake(self, results):
+        results.put((self, None))
+
+
+def _models_report(pending):
+    """Describe the units which held up each of the ``pending``
+    :class:`_ModelWait` objects.
+
+    """
+    return ''.join('{}:\n{}'.format(model_wait.juju_env,
+                                    model_wait.tracker.report())
+                   for model_wait in pending)
+
+
+def wait_all(targets, timeout=300, workers=4, idle_floor=None,
+             deadline=None):
+    """Wait for the units of several models to finish running hooks, like
+    :meth:`Talisman.wait` does for one.
+
+    The models are polled concurrently, by a pool of at most ``workers``
+    threads, each model on its own polling schedule.  The wait ends as
+    soon as every model has settled, or as soon as a unit in any of them
+    goes into an error state.
+
+    :param list targets: :class:`Talisman` objects, or ``(model, services)``
+        tuples.  Plain tuples need Juju 1.24 or later, because agents which
+        don't report agent-status can only be asked through a Talisman.
+    :param int timeout: Number of seconds to wait before timing-out.
+        If environment variable AMULET_WAIT_TIMEOUT is set, it overrides
+        this value.
+    :param int workers: Maximum number of status checks in flight at once.
+    :param float idle_floor: As for :meth:`Talisman.wait`.
+    :param deadline: A :class:`~amulet.helpers.Deadline` to time out at
+        if it comes first.
+    :return: A dict mapping each model name to the number of seconds it
+        took to settle.
+    :raises: :class:`amulet.TimeoutError` naming the models which did not
+        settle in time.
+
+    Example::
+
+        timings = wait_all([('xenial-model', ['mysql']),
+                            ('trusty-model', ['mysql'])])
+
+    """
+    timeout = float(os.environ.get('AMULET_WAIT_TIMEOUT') or timeout)
+    deadline = helpers.Deadline.within(timeout, deadline)
+    pending = [_ModelWait(target, idle_floor) for target in targets]
+    timings = {}
+    results = queue.Queue()
+    listeners = []
+    for model_wait in pending:
+        listener = functools.partial(model_wait.wake, results)
+        for watcher in wake_sources(model_wait.juju_env):
+            watcher.add_listener(listener)
+            listeners.append((watcher, listener))
+
+    start = time.time()
+    pool = ThreadPool(max(1, min(workers, len(pending))))
+    try:
+        while pending:
+            now = time.time()
+            for model_wait in pending:
+                if not model_wait.busy and model_wait.due <= now:
+                    model_wait.busy = True
+                    pool.apply_async(model_wait.poll, (results,))
+            if deadline.expired():
+                helpers.report_timeout(timeout, functools.partial(
+                    _models_report, pending))
+                error = helpers.TimeoutError(
+                    'Models not settled after {:g}s: {}'.format(
+                        timeout, ', '.join(w.juju_env for w in pending)))
+                error.reported = True
+                raise error
+            due = [w.due - now for w in pending if not w.busy]
+            due.append(deadline.remaining())
+            try:
+                model_wait, outcome = results.get(timeout=max(0, min(due)))
+            except queue.Empty:
+                continue
+            if model_wait not in pending:
+                continue
+            if isinstance(outcome, Exception):
+                raise outcome
+            if outcome is None:
+                # woken by the API watcher; check as soon as it's free
+                model_wait.backoff.reset()
+                model_wait.due = 0
+            elif outcome:
+                elapsed = time.time() - start
+                log.info('%s settled in %s seconds.',
+                         model_wait.juju_env, elapsed)
+                timings[model_wait.juju_env] = elapsed
+                pending.remove(model_wait)
+            else:
+                model_wait.busy = False
+                if model_wait.tracker.changed:
+                    model_wait.backoff.reset()
+                model_wait.backoff.poll_at = model_wait.tracker.ready_at
+                model_wait.due = time.time() + model_wait.backoff.delay()
+    finally:
+        # don't wait for checks which are still in flight
+        pool.close()
+        for watcher, listener in listeners:
+            watcher.remove_listener(listener)
+    return timings
+
+
 class StatusMessageMatcher(object):
     def check(self, expected, actual):
         if isinstance(expected, (list, tuple)):
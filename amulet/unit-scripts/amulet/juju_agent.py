@@ -7,13 +7,18 @@ PROC_DIR = '/proc'
 JUJU_DIR = '/var/lib/juju/agents/'
 
 d = {}
+# hook running for each unit agent on this machine, by agent name
+units = {}
 for pid in [p for p in os.listdir(PROC_DIR) if p.isdigit()]:
     try:
         cmd = open(os.path.join(PROC_DIR, pid, 'cmdline')).read()
     except:
         continue
     if JUJU_DIR in cmd:
-        d['hook'] = os.path.basename(cmd)
-        break
+        hook = os.path.basename(cmd)
+        d.setdefault('hook', hook)
+        agent = cmd.split(JUJU_DIR, 1)[1].split('/', 1)[0]
+        units.setdefault(agent, hook)
+d['units'] = units
 
 print(json.dumps(d))
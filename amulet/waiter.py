@@ -1,6 +1,18 @@
+import json
+import os
 import sys
+import threading
+import time
 import yaml
+from contextlib import contextmanager
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+
+from . import apiwatcher
+from . import history
 from .helpers import (
     TimeoutError,
     default_environment,
@@ -10,6 +22,12 @@ from .helpers import (
 )
 
 SUCCESS_STATES = ['started']
+# format requested from `juju status`; json is parsed by the C-accelerated
+# json module, yaml by libyaml where available
+STATUS_FORMAT = 'json'
+# format asked for instead from a juju which rejects STATUS_FORMAT; once it
+# worked, it is used from then on
+FALLBACK_FORMAT = 'yaml'
 JUJU_VERSION = JujuVersion()
 
 
@@ -57,32 +75,189 @@ class StateError(Exception):
 
 
 # Move these to another module?
-def _get_gojuju_status(environment=None):
-    return _get_pyjuju_status(environment)
+def _get_gojuju_status(environment=None, services=None, projection=None):
+    return _get_pyjuju_status(environment, services, projection)
+
+
+# The parts of the status document which the waits, Talisman.get_status
+# and state() look at.  Each key maps to True to keep the whole value, or to
+# a nested projection; '*' matches any key.
+_AGENT_STATUS = {'current': True, 'message': True, 'since': True}
+_MACHINE = {'agent-state': True, 'juju-status': _AGENT_STATUS}
+_MACHINE['containers'] = {'*': _MACHINE}
+_UNIT = {
+    'agent-state': True,
+    'agent-state-info': True,
+    'agent-status': _AGENT_STATUS,
+    'juju-status': _AGENT_STATUS,
+    'life': True,
+    'machine': True,
+    'public-address': True,
+    'relations-error': True,
+    'workload-status': _AGENT_STATUS,
+}
+_UNIT['subordinates'] = {'*': _UNIT}
+_SERVICE = {
+    'life': True,
+    # the related services, for settle detection
+    'relations': True,
+    'subordinate-to': True,
+    'units': {'*': _UNIT},
+}
+STATUS_PROJECTION = {
+    'machines': {'*': _MACHINE},
+    'services': {'*': _SERVICE},
+    'applications': {'*': _SERVICE},
+}
+
+_RESOLVER = yaml.resolver.Resolver()
+_CONSTRUCTOR = yaml.constructor.SafeConstructor()
+_STR_TAG = 'tag:yaml.org,2002:str'
+
+
+def _scalar(event):
+    if event.tag is None or event.tag == '!':
+        tag = _RESOLVER.resolve(yaml.ScalarNode, event.value, event.implicit)
+    else:
+        tag = event.tag
+    if tag == _STR_TAG:
+        return event.value
+    node = yaml.ScalarNode(tag, event.value, style=event.style)
+    return _CONSTRUCTOR.yaml_constructors[tag](_CONSTRUCTOR, node)
+
+
+def _skip(events, event):
+    if not isinstance(event, yaml.CollectionStartEvent):
+        return
+    depth = 1
+    while depth:
+        event = next(events)
+        if isinstance(event, yaml.CollectionStartEvent):
+            depth += 1
+        elif isinstance(event, yaml.CollectionEndEvent):
+            depth -= 1
+
+
+def _project(events, event, projection):
+    if isinstance(event, yaml.MappingStartEvent):
+        result = {}
+        while True:
+            event = next(events)
+            if isinstance(event, yaml.MappingEndEvent):
+                return result
+            key = _scalar(event)
+            if projection is True:
+                value_projection = True
+            else:
+                value_projection = projection.get(key, projection.get('*'))
+            event = next(events)
+            if value_projection is None:
+                _skip(events, event)
+            else:
+                result[key] = _project(events, event, value_projection)
+    if isinstance(event, yaml.SequenceStartEvent):
+        result = []
+        while True:
+            event = next(events)
+            if isinstance(event, yaml.SequenceEndEvent):
+                return result
+            result.append(_project(events, event, projection))
+    if isinstance(event, yaml.ScalarEvent):
+        return _scalar(event)
+    return None  # alias; juju never emits them
+
+
+def project_yaml(raw, projection=STATUS_PROJECTION):
+    """Parse the YAML document ``raw``, keeping only the parts selected by
+    ``projection``.
+
+    The document is consumed as a stream of parse events, and everything
+    outside the projection is skipped without ever being constructed, so
+    this is both faster and much lighter on memory than loading the whole
+    document and throwing most of it away.
+
+    :param dict projection: Maps the keys to keep to either True, to keep
+        their whole value, or to a nested projection applied to the value
+        (or to each item, if the value is a list).  The key ``'*'``
+        matches any key.
 
+    """
+    events = yaml.parse(raw, Loader=SafeLoader)
+    for event in events:
+        if isinstance(event, yaml.NodeEvent):
+            return _project(events, event, projection)
+    return None
 
-# Move these to another module?
-def _get_pyjuju_status(environment=None):
-    cmd = ['status', '--format', 'yaml']
+
+def parse_status(raw, projection=None):
+    """Parse the output of `juju status --format json|yaml`.
+
+    JSON is tried first; since YAML is a superset of JSON, anything which
+    is not valid JSON is handed to the (libyaml, if available) YAML loader.
+
+    :param dict projection: If given, YAML is parsed with
+        :func:`project_yaml` so that only the selected parts of the document
+        are built.  JSON is cheap enough to parse that it is always loaded
+        in full.
+
+    """
+    try:
+        return json.loads(raw)
+    except ValueError:
+        if projection is not None:
+            return project_yaml(raw, projection)
+        return yaml.load(raw, Loader=SafeLoader)
+
+
+def _status_formats():
+    """Return the formats to try to get the status in, in order."""
+    if STATUS_FORMAT == FALLBACK_FORMAT:
+        return [STATUS_FORMAT]
+    return [STATUS_FORMAT, FALLBACK_FORMAT]
+
+
+def _status_format_used(status_format):
+    """Remember which format the status was last got in."""
+    global STATUS_FORMAT
+    STATUS_FORMAT = status_format
+
+
+def _status_args(environment=None, services=None, status_format=None):
+    cmd = ['status', '--format', status_format or STATUS_FORMAT]
     if environment:
         if JUJU_VERSION.major == 1:
             cmd.extend(['-e', environment])
         else:
             cmd.extend(['-m', environment])
+    if services:
+        # only fetch the given services, and the machines hosting them
+        cmd.extend(sorted(set(services)))
+    return cmd
 
-    try:
-        status_yml = juju(cmd)
-    except TimeoutError:
-        raise
-    except:
-        raise Exception('Unable to query status for %s' % environment)
 
-    d = yaml.safe_load(status_yml)
+def _load_status(raw_status, projection=None):
+    d = parse_status(raw_status, projection)
     if 'applications' in d:
         d['services'] = d['applications']
     return d
 
 
+# Move these to another module?
+def _get_pyjuju_status(environment=None, services=None, projection=None):
+    for status_format in _status_formats():
+        cmd = _status_args(environment, services, status_format)
+        try:
+            raw_status = juju(cmd)
+        except TimeoutError:
+            raise
+        except:
+            continue
+        _status_format_used(status_format)
+        return _load_status(raw_status, projection)
+
+    raise Exception('Unable to query status for %s' % environment)
+
+
 def get_state(data):
     states = ['life', 'relations-error', 'agent-state']
     for state_key in states:
@@ -90,21 +265,177 @@ def get_state(data):
             return str(data[state_key])
 
 
-def status(juju_env=None):
+class _Fetch(object):
+    """A single, possibly still running, status fetch."""
+    def __init__(self, generation, started):
+        self.generation = generation
+        self.started = started
+        self.status = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, status=None, error=None):
+        self.status = status
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        while not self._done.is_set():
+            self._done.wait(1)  # stay responsive to signals on Python 2
+        if self.error is not None:
+            raise self.error
+        return self.status
+
+
+class StatusCache(object):
+    """Short-lived cache of `juju status` results.
+
+    A cached result is reused for ``ttl`` seconds after the fetch which
+    produced it was started.  Concurrent requests for the same model and
+    services share a single in-flight fetch instead of each running their
+    own `juju status`.  Failed fetches are never cached.
+
+    Results are shared between callers, and must be treated as read-only.
+
+    :param float ttl: Seconds for which a result may be reused.
+
+    """
+    def __init__(self, ttl=1):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._fetches = {}
+        self._generation = 0
+
+    def get(self, key, fetch, max_age=None):
+        """Return the status cached under ``key``, calling ``fetch`` if
+        there is none younger than ``max_age`` (defaulting to the TTL).
+
+        """
+        if max_age is None:
+            max_age = self.ttl
+        with self._lock:
+            now = time.time()
+            pending = self._fetches.get(key)
+            if (pending is None or pending.error is not None or
+                    pending.generation != self._generation or
+                    now - pending.started > max_age):
+                pending = self._fetches[key] = _Fetch(self._generation, now)
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return pending.wait()
+        try:
+            result = fetch()
+        except Exception as e:
+            pending.finish(error=e)
+            # the traceback references this frame; don't let it keep a
+            # reference cycle through the failed fetch alive
+            pending = None
+            raise
+        pending.finish(result)
+        return result
+
+    def invalidate(self):
+        """Forget all cached results, and make sure requests from now on
+        don't join fetches which were started before this call.
+
+        """
+        with self._lock:
+            self._generation += 1
+            self._fetches.clear()
+
+
+STATUS_CACHE = StatusCache(float(os.environ.get('AMULET_STATUS_TTL', 1)))
+
+
+def status(juju_env=None, services=None, max_age=None, projected=False):
+    """Return the parsed `juju status` of ``juju_env``.
+
+    Results are cached in :data:`STATUS_CACHE` and shared between callers,
+    so the returned dictionary must not be modified.  If an
+    :mod:`~amulet.apiwatcher` is watching the model, it answers instead.
+
+    :param list services: If given, only query the status of these services
+        (and the machines hosting them) instead of the whole model.
+    :param float max_age: Maximum age in seconds of a cached result which
+        may be returned.  Defaults to the cache TTL, which can be set with
+        the AMULET_STATUS_TTL environment variable; use 0 to force a fresh
+        fetch.
+    :param bool projected: Set if only the parts of the status listed in
+        :data:`STATUS_PROJECTION` are needed; YAML status is then parsed
+        with :func:`project_yaml`, and the rest of it is left out.  This
+        applies once juju is known to need YAML (see
+        :data:`FALLBACK_FORMAT`); the query which finds that out is loaded
+        whole.
+
+    """
     if not juju_env:
         raise KeyError('No juju_env set')
 
-    try:
+    watcher = apiwatcher.get_watcher(juju_env)
+    if watcher is not None:
+        return watcher.status(services)
+
+    # JSON status is always loaded in full, so projected and full queries
+    # share their fetches
+    projected = projected and STATUS_FORMAT != 'json'
+    projection = STATUS_PROJECTION if projected else None
+
+    def fetch():
         if JUJU_VERSION.major == 0:
-            juju_status = _get_pyjuju_status(juju_env)
-        else:
-            juju_status = _get_gojuju_status(juju_env)
-    except TimeoutError:
-        raise
-    except:
-        raise
+            return _get_pyjuju_status(juju_env, services, projection)
+        return _get_gojuju_status(juju_env, services, projection)
+
+    key = (juju_env, tuple(sorted(set(services))) if services else None,
+           projected)
+    return STATUS_CACHE.get(key, fetch, max_age)
+
+
+@contextmanager
+def replay(source, juju_env=None):
+    """Serve :func:`status` from a recording instead of the controller.
+
+    Within the block, every status query for a recorded model returns the
+    next snapshot from the recording, so waits and wait predicates can be
+    run (and debugged, or benchmarked) offline::
+
+        with waiter.replay('status.jsonl.gz'):
+            sentry.wait()
+
+    :param source: The path of a recording made with AMULET_STATUS_RECORDING
+        or :meth:`~amulet.history.StatusHistory.dump`, or a
+        :class:`~amulet.history.StatusHistory`.
+    :param str juju_env: Replay all of the snapshots as the status of this
+        model, regardless of the model they were recorded from.
+    :return: A dict mapping each model to its :class:`~amulet.history.Replay`.
+
+    """
+    if isinstance(source, history.StatusHistory):
+        records = [{'model': source.juju_env, 'status': status}
+                   for timestamp, status in source.snapshots()]
+    else:
+        records = history.load(source)
+    statuses = {}
+    for record in records:
+        model = juju_env or record['model']
+        statuses.setdefault(model, []).append(record['status'])
+
+    replays = {}
+    try:
+        for model, model_statuses in statuses.items():
+            replays[model] = apiwatcher.watch(
+                model, history.Replay(model_statuses))
+        yield replays
+    finally:
+        for model in replays:
+            apiwatcher.unwatch(model)
+
 
-    return juju_status
+def invalidate_status():
+    """Drop all cached status, e.g. after changing the model."""
+    STATUS_CACHE.invalidate()
 
 
 def state(*args, **kwargs):
@@ -114,9 +445,10 @@ def state(*args, **kwargs):
         raise KeyError('No juju_env set')
 
     juju_env = kwargs['juju_env']
+    services = [arg.split('/')[0] for arg in args]
 
     try:
-        juju_status = status(juju_env)
+        juju_status = status(juju_env, services, projected=True)
     except TimeoutError:
         raise
     except:
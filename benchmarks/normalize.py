@@ -0,0 +1,110 @@
+"""Measure the cost of normalizing status in :class:`Talisman` per poll,
+before and after normalizing into :class:`~amulet.sentry.UnitState`
+records.
+
+Usage::
+
+    python -m benchmarks.normalize [units ...]
+
+The baseline is the dict-based normalization amulet used before.  Its
+retained memory looks small because its records point into the raw status
+instead of copying from it, which keeps the whole raw status alive for as
+long as the normalized one is.
+
+"""
+from __future__ import print_function
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from amulet import waiter
+from amulet.sentry import JUJU_VERSION, Talisman
+
+from . import synthetic
+
+
+def baseline_normalize(status):
+    """The normalization of earlier versions, for comparison."""
+    machine_states = {}
+    normalized = {}
+
+    def machine_state(machine_dict):
+        if JUJU_VERSION.major == 1:
+            return machine_dict.get('agent-state')
+        return machine_dict.get('juju-status', {}).get('current')
+
+    def agent_status(unit_dict):
+        key = 'agent-status' if JUJU_VERSION.major == 1 else 'juju-status'
+        return unit_dict.get(key, {})
+
+    def unit_record(unit, machine):
+        return {
+            'machine-state': machine_states.get(machine),
+            'public-address': unit.get('public-address'),
+            'workload-status': unit.get('workload-status', {}),
+            'agent-status': agent_status(unit),
+            'agent-state': unit.get('agent-state'),
+            'agent-state-info': unit.get('agent-state-info'),
+        }
+
+    for number, machine in status['machines'].items():
+        machine_states[number] = machine_state(machine)
+        for container_name, container in machine.get(
+                'containers', {}).items():
+            machine_states[container_name] = machine_state(container)
+
+    for service_name, service in status['services'].items():
+        if 'units' not in service and 'relations' not in service:
+            continue
+        normalized.setdefault(service_name, {})
+        for unit_name, unit in service.get('units', {}).items():
+            normalized[service_name][unit_name] = unit_record(
+                unit, unit.get('machine'))
+            for sub_name, sub in unit.get('subordinates', {}).items():
+                sub_service = sub_name.split('/')[0]
+                normalized.setdefault(sub_service, {})
+                normalized[sub_service][sub_name] = unit_record(
+                    sub, unit.get('machine'))
+    return normalized
+
+
+def measure(normalize, status, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        normalize(status)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    gc.collect()
+    tracemalloc.start()
+    normalized = normalize(status)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del normalized
+    return best, retained, peak
+
+
+def main(sizes):
+    talisman = Talisman.__new__(Talisman)
+    implementations = [
+        ('baseline', baseline_normalize),
+        ('UnitState', talisman._normalize_status),
+    ]
+    print('{:>6} {:>10} {:>12} {:>14} {:>12}'.format(
+        'units', 'version', 'time (ms)', 'retained (kB)', 'peak (kB)'))
+    for size in sizes:
+        status = synthetic.status(size)
+        # round-trip so that strings are fresh objects, as after a real poll
+        status = waiter.parse_status(synthetic.dumps(status, 'json'))
+        status['services'] = status['applications']
+        for name, normalize in implementations:
+            elapsed, retained, peak = measure(normalize, status)
+            print('{:>6} {:>10} {:>12.2f} {:>14.0f} {:>12.0f}'.format(
+                size, name, elapsed * 1000, retained / 1024.0,
+                peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [100, 1000, 5000])
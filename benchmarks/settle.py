@@ -0,0 +1,88 @@
+"""Compare settle detectors on status traces: how long after the last hook
+each one declares the model settled, and whether it ever does so while
+hooks are still to come.
+
+Usage::
+
+    python -m benchmarks.settle [recording ...]
+
+Recordings are files written with ``AMULET_STATUS_RECORDING`` (see
+:mod:`amulet.history`); without any, synthetic traces are used.
+
+"""
+from __future__ import print_function
+
+import sys
+
+from amulet import history
+from amulet.quiescence import HookActivity
+from amulet.sentry import IDLE_THRESHOLD, _normalize_status, since_epoch
+
+from . import synthetic
+
+DETECTORS = [
+    ('fixed {}s'.format(IDLE_THRESHOLD),
+     lambda: HookActivity(min_idle=IDLE_THRESHOLD, latency=0)),
+    ('hook activity', HookActivity),
+    ('hook activity, 10s floor', lambda: HookActivity(min_idle=10)),
+]
+
+
+def settle_time(trace, activity):
+    """Replay ``trace`` through ``activity`` and return the time at which a
+    wait polling at every recorded status would have returned, or None.
+
+    """
+    for i, (timestamp, status) in enumerate(trace):
+        activity.observe(status)
+        ready = timestamp
+        for units in _normalize_status(status).values():
+            for unit_name, unit in units.items():
+                if unit.agent != 'idle':
+                    ready = None
+                    break
+                ready = max(ready, activity.settled_at(
+                    unit_name, since_epoch(unit.agent_since)))
+            if ready is None:
+                break
+        if ready is None:
+            continue
+        if i + 1 == len(trace) or ready < trace[i + 1][0]:
+            return ready
+    return None
+
+
+def last_hook(trace):
+    """Return the time at which the last hook of ``trace`` ended."""
+    ended = 0
+    for timestamp, status in trace:
+        for units in _normalize_status(status).values():
+            for unit in units.values():
+                if unit.agent_since:
+                    ended = max(ended, since_epoch(unit.agent_since))
+    return ended
+
+
+def main(paths):
+    if paths:
+        traces = [(path, [(r['time'], r['status'])
+                          for r in history.load(path)]) for path in paths]
+    else:
+        traces = [('synthetic-{}'.format(seed), synthetic.hook_trace(seed))
+                  for seed in range(5)]
+    print('{:<20} {:<26} {:>14}'.format('trace', 'detector', 'settle (s)'))
+    for name, trace in traces:
+        quiet = last_hook(trace)
+        for detector, factory in DETECTORS:
+            settled = settle_time(trace, factory())
+            if settled is None:
+                result = 'never'
+            elif settled < quiet:
+                result = 'EARLY {:.0f}'.format(settled - quiet)
+            else:
+                result = '{:.0f}'.format(settled - quiet)
+            print('{:<20} {:<26} {:>14}'.format(name, detector, result))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
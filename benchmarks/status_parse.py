@@ -0,0 +1,59 @@
+"""Compare status parse time and peak memory for each supported format,
+and for the projection parser used for YAML status.
+
+Usage::
+
+    python -m benchmarks.status_parse [units ...]
+
+"""
+from __future__ import print_function
+
+import sys
+import time
+import tracemalloc
+
+import yaml
+
+from amulet import waiter
+
+from . import synthetic
+
+PARSERS = [
+    ('yaml (SafeLoader)', 'yaml',
+     lambda raw: yaml.load(raw, Loader=yaml.SafeLoader)),
+    ('yaml ({})'.format(waiter.SafeLoader.__name__), 'yaml',
+     lambda raw: yaml.load(raw, Loader=waiter.SafeLoader)),
+    ('yaml (projected)', 'yaml', waiter.project_yaml),
+    ('json', 'json', waiter.parse_status),
+]
+
+
+def measure(parse, raw, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        parse(raw)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    parse(raw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main(sizes):
+    print('{:>6}  {:<22} {:>10} {:>12} {:>12}'.format(
+        'units', 'parser', 'size (kB)', 'time (ms)', 'peak (kB)'))
+    for size in sizes:
+        doc = synthetic.status(size)
+        raw = dict((fmt, synthetic.dumps(doc, fmt)) for fmt in ('json', 'yaml'))
+        for name, fmt, parse in PARSERS:
+            elapsed, peak = measure(parse, raw[fmt])
+            print('{:>6}  {:<22} {:>10.0f} {:>12.1f} {:>12.0f}'.format(
+                size, name, len(raw[fmt]) / 1024.0, elapsed * 1000,
+                peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [100, 1000, 5000])
@@ -0,0 +1,132 @@
+"""Synthetic `juju status` documents for benchmarking.
+
+"""
+import json
+import random
+import time
+
+import yaml
+
+SINCE = '24 Sep 2015 16:44:44-04:00'
+
+
+def status(num_units, units_per_service=10, seed=0):
+    """Return a Juju 2 style status dict with ``num_units`` units.
+
+    Units are spread over services of ``units_per_service`` units each, one
+    machine per unit, and every other service carries a subordinate.
+
+    """
+    rng = random.Random(seed)
+    machines = {}
+    applications = {}
+    for n in range(num_units):
+        service = 'service-{}'.format(n // units_per_service)
+        machine = str(n)
+        machines[machine] = {
+            'juju-status': {'current': 'started', 'since': SINCE,
+                            'version': '2.0.0'},
+            'dns-name': '10.0.{}.{}'.format(n // 250, n % 250),
+            'instance-id': 'juju-{}-machine-{}'.format(seed, n),
+            'machine-status': {'current': 'running', 'message': 'Running',
+                               'since': SINCE},
+            'series': 'xenial',
+            'hardware': 'arch=amd64 cpu-cores=2 mem=4096M root-disk=40960M',
+        }
+        app = applications.setdefault(service, {
+            'charm': 'cs:xenial/{}-1'.format(service),
+            'series': 'xenial',
+            'exposed': False,
+            'application-status': {'current': 'active', 'since': SINCE},
+            'relations': {'peer': [service]},
+            'units': {},
+        })
+        unit = {
+            'workload-status': {
+                'current': rng.choice(['active', 'active', 'maintenance']),
+                'message': 'ready', 'since': SINCE},
+            'juju-status': {
+                'current': rng.choice(['idle', 'idle', 'executing']),
+                'since': SINCE, 'version': '2.0.0'},
+            'machine': machine,
+            'public-address': machines[machine]['dns-name'],
+        }
+        if (n // units_per_service) % 2:
+            sub = '{}-sub/{}'.format(service, n % units_per_service)
+            unit['subordinates'] = {sub: {
+                'workload-status': {'current': 'active', 'since': SINCE},
+                'juju-status': {'current': 'idle', 'since': SINCE},
+                'public-address': unit['public-address'],
+            }}
+        app['units']['{}/{}'.format(service, n % units_per_service)] = unit
+    return {'model': {'name': 'bench'}, 'machines': machines,
+            'applications': applications}
+
+
+def dumps(doc, fmt):
+    """Serialize ``doc`` the way `juju status --format fmt` would."""
+    if fmt == 'json':
+        return json.dumps(doc)
+    return yaml.safe_dump(doc, default_flow_style=False)
+
+
+# epoch time at which synthetic traces start
+TRACE_START = 1442000000
+
+
+def _since(t):
+    return time.strftime('%d %b %Y %H:%M:%SZ', time.gmtime(TRACE_START + t))
+
+
+def hook_trace(seed=0, interval=1):
+    """Return a list of ``(time, status)`` tuples, in the format of a status
+    recording (see :mod:`amulet.history`), of the deployment of a small
+    model: two peered wordpress units related to mysql, and an unrelated
+    ntp unit.  Each related unit reacts to the other side 1 to 4 seconds
+    after its hook ends, and the model is polled every ``interval`` seconds.
+
+    """
+    rng = random.Random(seed)
+    hooks = []  # (unit, hook, start, end)
+    ends = {}
+
+    def run(unit, hook, after, duration=1):
+        start = max(ends.get(unit, 0), after)
+        ends[unit] = start + duration
+        hooks.append((unit, hook, start, ends[unit]))
+        return ends[unit]
+
+    for unit in ('mysql/0', 'wordpress/0', 'wordpress/1', 'ntp/0'):
+        t = rng.randint(0, 3)
+        for hook in ('install', 'config-changed', 'start'):
+            t = run(unit, hook, t, 8 if hook == 'install' else 1)
+    joined = max(ends.values())
+    db_set = run('mysql/0', 'db-relation-joined', joined)
+    db_set = run('mysql/0', 'db-relation-changed', db_set)
+    for unit in ('wordpress/0', 'wordpress/1'):
+        run(unit, 'db-relation-joined', joined)
+        t = run(unit, 'db-relation-changed', db_set + rng.randint(1, 4), 2)
+    run('wordpress/0', 'cluster-relation-changed', t + rng.randint(1, 4))
+
+    relations = {'mysql': {'db': ['wordpress']},
+                 'wordpress': {'db': ['mysql'], 'cluster': ['wordpress']}}
+    trace = []
+    for t in range(0, max(ends.values()) + 60, interval):
+        services = {}
+        for unit in sorted(ends):
+            agent = {'current': 'allocating', 'since': _since(0)}
+            for name, hook, start, end in hooks:
+                if name != unit or start > t:
+                    continue
+                if t < end:
+                    agent = {'current': 'executing', 'since': _since(start),
+                             'message': 'running {} hook'.format(hook)}
+                else:
+                    agent = {'current': 'idle', 'since': _since(end)}
+            service = unit.split('/')[0]
+            services.setdefault(service, {
+                'relations': relations.get(service, {}), 'units': {},
+            })['units'][unit] = {'juju-status': agent}
+        trace.append((TRACE_START + t,
+                      {'machines': {}, 'services': services}))
+    return trace
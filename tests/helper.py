@@ -1,5 +1,6 @@
 
 import copy
+import json
 import yaml
 
 TPLS = {
@@ -84,5 +85,8 @@ class JujuStatus(object):
 
         return copy.deepcopy(TPLS[version][key])
 
+    def to_json(self):
+        return json.dumps(self.status)
+
     def __str__(self):
         return yaml.dump(self.status, default_flow_style=False)
@@ -0,0 +1,152 @@
+"""Unit test for amulet.aio"""
+
+import sys
+import time
+import unittest
+from copy import deepcopy
+
+from amulet import Deployment, helpers
+from amulet.helpers import TimeoutError, UnitError
+from amulet.sentry import Talisman, UnitSentry
+from .test_sentry import mock_status
+
+from mock import Mock, patch
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from amulet import aio, waiter
+
+
+def done(result):
+    future = asyncio.Future()
+    future.set_result(result)
+    return future
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'requires Python 3.5')
+class AioTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_communicate(self):
+        self.assertEqual(
+            (3, b'out\n', b''),
+            self.run_coro(aio.communicate([
+                sys.executable, '-c', 'print("out"); exit(3)'])))
+
+    @patch('amulet.aio.juju', new_callable=Mock)
+    def test_status_yaml_fallback(self, juju):
+        self.addCleanup(setattr, waiter, 'STATUS_FORMAT',
+                        waiter.STATUS_FORMAT)
+
+        def fake_juju(args):
+            if 'json' in args:
+                raise IOError('invalid value "json" for flag --format')
+            return done('services: {}\n')
+        juju.side_effect = fake_juju
+        self.assertEqual({'services': {}}, self.run_coro(aio.status('env')))
+        self.assertEqual('yaml', waiter.STATUS_FORMAT)
+
+    @patch('amulet.aio.juju', Mock(side_effect=lambda args: done('status')))
+    def test_deadline_kills_process(self):
+        start = time.time()
+        self.assertRaises(TimeoutError, self.run_coro, aio.deadline(
+            aio.communicate([sys.executable, '-c',
+                             'import time; time.sleep(30)']), 0.2))
+        self.assertLess(time.time() - start, 5)
+
+    @patch('amulet.aio.status', new_callable=Mock)
+    def test_wait_for_status(self, status):
+        pending = deepcopy(mock_status)
+        unit = pending['services']['meteor']['units']['meteor/0']
+        unit['public-address'] = None
+        status.side_effect = [done(pending), done(mock_status)]
+
+        with patch('amulet.helpers.Backoff.delay', return_value=0):
+            result = self.run_coro(
+                aio.wait_for_status(None, 'env', ['meteor'], 5))
+        self.assertIs(mock_status, result)
+        status.assert_called_with('env', ['meteor'])
+
+    @patch('amulet.aio.juju', Mock(side_effect=lambda args: done('status')))
+    @patch('amulet.aio.status', new_callable=Mock)
+    def test_concurrent_waits(self, status):
+        status.side_effect = lambda juju_env, services: done(mock_status)
+        talismans = []
+        for juju_env in ('a', 'b'):
+            t = Talisman.__new__(Talisman)
+            t.juju_env = juju_env
+            talismans.append(t)
+
+        start = time.time()
+        self.run_coro(asyncio.gather(*[
+            t.wait_for_messages_async({'meteor': {'ready', 'ok'}}, 0.5)
+            for t in talismans], return_exceptions=True))
+        self.assertLess(time.time() - start, 1)
+        results = self.run_coro(asyncio.gather(*[
+            t.wait_for_messages_async({'meteor': 'ready'}, 0.5)
+            for t in talismans]))
+        self.assertEqual([None, None], results)
+        self.assertEqual(set(['a', 'b']),
+                         set(c[0][0] for c in status.call_args_list))
+
+    @patch('amulet.aio.status', new_callable=Mock)
+    def test_wait_units(self, status):
+        busy = deepcopy(mock_status)
+        busy['services']['meteor']['units']['meteor/1']['juju-status'][
+            'current'] = 'executing'
+        status.side_effect = lambda juju_env, services: done(busy)
+        t = Talisman.__new__(Talisman)
+        t.juju_env = 'env'
+        t.service_names = ['meteor']
+
+        self.run_coro(t.wait_async(5, units=['meteor/0']))
+        start = time.time()
+        self.assertRaises(TimeoutError, self.run_coro, t.wait_async(
+            300, units=['meteor/1'], deadline=helpers.Deadline(0.3)))
+        self.assertLess(time.time() - start, 5)
+
+    @patch('amulet.aio.status', new_callable=Mock)
+    def test_wait_for_messages_fails_fast(self, status):
+        errored = deepcopy(mock_status)
+        unit = errored['services']['meteor']['units']['meteor/0']
+        unit['workload-status']['current'] = 'error'
+        status.side_effect = lambda juju_env, services: done(errored)
+        t = Talisman.__new__(Talisman)
+        t.juju_env = 'env'
+        self.assertRaisesRegexp(
+            UnitError, 'Error on unit meteor/0', self.run_coro,
+            t.wait_for_messages_async({'meteor': 'ready'}, 300))
+
+    @patch('amulet.aio._watch_backend', Mock())
+    @patch('amulet.aio._wait_for_status', new_callable=Mock)
+    @patch('amulet.aio.communicate', new_callable=Mock)
+    @patch('amulet.aio.Talisman')
+    def test_concurrent_setups(self, talisman, communicate, wait_for_status):
+        communicate.side_effect = lambda cmd, capture: done((0, b'', b''))
+        wait_for_status.side_effect = lambda *args: done(mock_status)
+        talisman.side_effect = lambda *args, **kwargs: time.sleep(0.5)
+        deployments = [Deployment(juju_env=env) for env in ('a', 'b')]
+
+        start = time.time()
+        self.run_coro(asyncio.gather(*[
+            d.setup_async(timeout=5) for d in deployments]))
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(2, talisman.call_count)
+
+    @patch('amulet.helpers.default_environment', Mock())
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.aio.communicate', new_callable=Mock)
+    def test_unit_run(self, communicate):
+        communicate.return_value = done((0, b' ok\n', b''))
+        unit = UnitSentry.fromunitdata(
+            'meteor/0', {'public-address': '10.0.0.1'})
+        self.assertEqual(('ok', 0), self.run_coro(unit.run_async('true')))
+        communicate.assert_called_once_with(
+            ['juju', 'run', '--unit', 'meteor/0', '--timeout', '300s',
+             'true'])
@@ -0,0 +1,285 @@
+"""Unit test for amulet.apiwatcher"""
+
+import base64
+import hashlib
+import json
+import socket
+import ssl
+import struct
+import threading
+import unittest
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+from amulet import apiwatcher, waiter
+from amulet.apiwatcher import (
+    APIConnection,
+    APIError,
+    ModelWatcher,
+    WebSocket,
+)
+from amulet.poller import StatusPoller
+
+from mock import Mock, patch
+
+SINCE = '2017-03-07T10:21:30.123456789Z'
+
+RECORDED_DELTAS = [
+    [
+        ['machine', 'change', {
+            'id': '0', 'instance-id': 'i-0', 'series': 'xenial',
+            'agent-status': {'current': 'started', 'since': SINCE}}],
+        ['machine', 'change', {
+            'id': '0/lxd/0', 'instance-id': 'i-1', 'series': 'xenial',
+            'agent-status': {'current': 'pending', 'since': SINCE}}],
+        ['application', 'change', {
+            'name': 'mysql', 'charm-url': 'cs:mysql-1', 'exposed': False,
+            'status': {'current': 'waiting'}}],
+        ['application', 'change', {
+            'name': 'rsyslog', 'charm-url': 'cs:rsyslog-1',
+            'subordinate': True, 'status': {'current': 'active'}}],
+        ['application', 'change', {
+            'name': 'wordpress', 'charm-url': 'cs:wordpress-1'}],
+        ['relation', 'change', {
+            'key': 'rsyslog:juju-info mysql:juju-info',
+            'endpoints': [
+                {'application-name': 'rsyslog',
+                 'relation': {'name': 'juju-info'}},
+                {'application-name': 'mysql',
+                 'relation': {'name': 'juju-info'}}]}],
+        ['unit', 'change', {
+            'name': 'mysql/0', 'application': 'mysql', 'machine-id': '0',
+            'public-address': '10.0.0.1',
+            'workload-status': {'current': 'maintenance',
+                                'message': 'installing', 'since': SINCE},
+            'agent-status': {'current': 'executing', 'since': SINCE}}],
+        ['unit', 'change', {
+            'name': 'rsyslog/0', 'application': 'rsyslog',
+            'subordinate': True, 'principal': 'mysql/0',
+            'public-address': '10.0.0.1',
+            'workload-status': {'current': 'active', 'since': SINCE},
+            'agent-status': {'current': 'idle', 'since': SINCE}}],
+        ['unit', 'change', {
+            'name': 'wordpress/0', 'application': 'wordpress',
+            'machine-id': '0/lxd/0',
+            'workload-status': {'current': 'waiting', 'since': SINCE},
+            'agent-status': {'current': 'allocating', 'since': SINCE}}],
+        ['annotation', 'change', {'tag': 'model-x'}],
+    ],
+    [
+        ['unit', 'change', {
+            'name': 'mysql/0', 'application': 'mysql', 'machine-id': '0',
+            'public-address': '10.0.0.1',
+            'workload-status': {'current': 'active', 'message': 'ready',
+                                'since': SINCE},
+            'agent-status': {'current': 'idle', 'since': SINCE}}],
+        ['unit', 'remove', {'name': 'wordpress/0'}],
+    ],
+]
+
+
+def _frame(text):
+    """An unmasked server to client text frame."""
+    payload = text.encode('utf-8')
+    if len(payload) < 126:
+        header = struct.pack('!BB', 0x81, len(payload))
+    elif len(payload) < 1 << 16:
+        header = struct.pack('!BBH', 0x81, 126, len(payload))
+    else:
+        header = struct.pack('!BBQ', 0x81, 127, len(payload))
+    return header + payload
+
+
+class FakeAPIHandler(socketserver.BaseRequestHandler):
+    """Speaks just enough of the Juju API to replay recorded deltas."""
+    def handle(self):
+        self.server.connections.append(self.request)
+        ws = WebSocket(self.request)
+        while b'\r\n\r\n' not in ws._buffer:
+            ws._fill()
+        head, ws._buffer = ws._buffer.split(b'\r\n\r\n', 1)
+        key = [line.split(b':', 1)[1].strip() for line in head.split(b'\r\n')
+               if line.lower().startswith(b'sec-websocket-key')][0]
+        accept = base64.b64encode(hashlib.sha1(
+            key + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+        self.request.sendall(
+            b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+            b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept +
+            b'\r\n\r\n')
+        deltas = list(self.server.deltas)
+        try:
+            while True:
+                request = json.loads(ws.recv())
+                self.server.requests.append(request)
+                response = {'request-id': request['request-id']}
+                if request['request'] == 'Login':
+                    if request['params']['credentials'] != 'secret':
+                        response['error'] = 'invalid entity name or password'
+                    response['response'] = {}
+                elif request['request'] == 'WatchAll':
+                    response['response'] = {'watcher-id': '7'}
+                elif request['request'] == 'Next':
+                    if not deltas:
+                        self.server.idle.set()
+                        self.server.release.wait(10)
+                        return
+                    response['response'] = {'deltas': deltas.pop(0)}
+                self.request.sendall(_frame(json.dumps(response)))
+        except (apiwatcher.ConnectionClosed, socket.error):
+            pass
+
+
+class FakeAPIServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, deltas):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), FakeAPIHandler)
+        self.deltas = deltas
+        self.requests = []
+        self.connections = []
+        self.idle = threading.Event()
+        self.release = threading.Event()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'ws://127.0.0.1:{}/model/uuid/api'.format(
+            self.server_address[1])
+
+    def stop(self):
+        self.release.set()
+        self.shutdown()
+        self.server_close()
+
+
+class ModelWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAPIServer(RECORDED_DELTAS)
+        self.addCleanup(self.server.stop)
+
+    def connect(self, password='secret'):
+        connection = APIConnection(WebSocket.connect(self.server.url))
+        connection.login('admin', password)
+        return connection
+
+    def test_login(self):
+        self.connect().close()
+        self.assertEqual('user-admin',
+                         self.server.requests[0]['params']['auth-tag'])
+        self.assertRaises(APIError, self.connect, 'wrong')
+
+    def test_replay(self):
+        watcher = ModelWatcher(self.connect(), 'env').start()
+        self.addCleanup(watcher.stop)
+        status = watcher.status()
+
+        self.assertEqual({'current': 'started',
+                          'since': '07 Mar 2017 10:21:30Z'},
+                         status['machines']['0']['juju-status'])
+        self.assertIn('0/lxd/0', status['machines']['0']['containers'])
+        mysql = status['services']['mysql']['units']['mysql/0']
+        self.assertEqual('10.0.0.1', mysql['public-address'])
+        self.assertIn('rsyslog/0', mysql['subordinates'])
+        self.assertEqual(['mysql'],
+                         status['services']['rsyslog']['subordinate-to'])
+        self.assertNotIn('units', status['services']['rsyslog'])
+
+        self.assertTrue(self.server.idle.wait(5))
+        self.assertEqual(2, watcher.revision)
+        status = watcher.status()
+        mysql = status['services']['mysql']['units']['mysql/0']
+        self.assertEqual('active', mysql['workload-status']['current'])
+        self.assertEqual({}, status['services']['wordpress']['units'])
+
+    def test_scoped_status(self):
+        watcher = ModelWatcher(self.connect(), 'env').start()
+        self.addCleanup(watcher.stop)
+        self.assertEqual(['wordpress'],
+                         list(watcher.status(['wordpress'])['services']))
+        self.assertEqual(set(['mysql', 'rsyslog']),
+                         set(watcher.status(['rsyslog'])['services']))
+
+    def test_listeners(self):
+        watcher = ModelWatcher(self.connect(), 'env')
+        listener = Mock()
+        watcher.add_listener(listener)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        self.assertTrue(self.server.idle.wait(5))
+        self.assertEqual(2, watcher.wait_for_change(0, 5))
+        self.assertEqual(2, listener.call_count)
+
+    def test_error(self):
+        watcher = ModelWatcher(self.connect(), 'env').start()
+        self.assertTrue(self.server.idle.wait(5))
+        for sock in self.server.connections:
+            sock.shutdown(socket.SHUT_RDWR)
+        watcher._thread.join(5)
+        self.assertIsNotNone(watcher.error)
+        self.assertRaises(APIError, watcher.status)
+
+    @patch.dict(apiwatcher.WATCHERS, clear=True)
+    def test_serves_waiter_status(self):
+        watcher = ModelWatcher(self.connect(), 'env').start()
+        self.addCleanup(watcher.stop)
+        apiwatcher.watch('env', watcher)
+        self.assertTrue(self.server.idle.wait(5))
+
+        with patch('amulet.waiter._get_gojuju_status') as cli:
+            status = waiter.status('env', ['mysql'])
+            self.assertFalse(cli.called)
+        self.assertIn('mysql/0', status['services']['mysql']['units'])
+
+    @patch.dict(apiwatcher.WATCHERS, clear=True)
+    def test_wakes_subscribers(self):
+        watcher = ModelWatcher(self.connect(), 'env').start()
+        self.addCleanup(watcher.stop)
+        apiwatcher.watch('env', watcher)
+        self.assertTrue(self.server.idle.wait(5))
+        backoff = Mock()
+
+        with StatusPoller('env').subscribe(backoff=backoff):
+            watcher.apply([])
+        watcher.apply([])
+        self.assertEqual(1, backoff.wake.call_count)
+
+
+class APIConnectionTest(unittest.TestCase):
+    @patch('amulet.apiwatcher.WebSocket.connect')
+    def test_requires_ca_cert(self, connect):
+        self.assertRaises(APIError, APIConnection.connect, '10.0.0.1:17070',
+                          'uuid', 'admin', 'secret')
+        self.assertFalse(connect.called)
+
+    @patch.object(APIConnection, 'login', Mock())
+    @patch('amulet.apiwatcher.ssl.create_default_context')
+    @patch('amulet.apiwatcher.WebSocket.connect')
+    def test_verifies_certificate(self, connect, create_context):
+        APIConnection.connect('10.0.0.1:17070', 'uuid', 'admin', 'secret',
+                              'PEM')
+        create_context.assert_called_once_with(cadata='PEM')
+        context = create_context.return_value
+        self.assertIsNot(False, context.check_hostname)
+        self.assertIsNot(ssl.CERT_NONE, context.verify_mode)
+        connect.assert_called_once_with(
+            'wss://10.0.0.1:17070/model/uuid/api', context, 30,
+            'juju-apiserver')
+
+
+class CLITimeTest(unittest.TestCase):
+    def test_cli_time(self):
+        self.assertEqual('07 Mar 2017 10:21:30Z',
+                         apiwatcher._cli_time('2017-03-07T10:21:30Z'))
+        self.assertEqual('07 Mar 2017 10:21:30+01:00',
+                         apiwatcher._cli_time('2017-03-07T10:21:30.5+01:00'))
+        self.assertEqual('07 Mar 2017 10:21:30-04:00',
+                         apiwatcher._cli_time('2017-03-07T10:21:30-04:00'))
+        self.assertEqual('24 Sep 2015 16:44:44-04:00',
+                         apiwatcher._cli_time('24 Sep 2015 16:44:44-04:00'))
@@ -0,0 +1,148 @@
+"""Unit test for amulet.conditions"""
+
+import re
+import unittest
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from amulet.conditions import (
+    agent_idle_for,
+    all_of,
+    any_of,
+    message,
+    not_,
+    unit_count,
+    unit_state,
+)
+from amulet.helpers import TimeoutError, timeout
+from amulet.sentry import Talisman, UnitSentry, _normalize_status
+from .test_sentry import mock_status
+
+from mock import Mock, patch
+
+
+class ConditionTest(unittest.TestCase):
+    def setUp(self):
+        self.raw = deepcopy(mock_status)
+        self.status = _normalize_status(self.raw)
+
+    def test_unit_state(self):
+        self.assertTrue(unit_state('meteor', 'active').check(self.status))
+        self.assertTrue(unit_state('meteor/0', 'idle').check(self.status))
+        self.assertTrue(
+            unit_state('meteor', re.compile('act|idl')).check(self.status))
+        self.assertFalse(unit_state('meteor', 'blocked').check(self.status))
+        self.assertFalse(unit_state('meteor/9', 'active').check(self.status))
+        self.assertFalse(unit_state('missing', 'active').check(self.status))
+
+    def test_message(self):
+        self.assertTrue(message('meteor', 'ready').check(self.status))
+        self.assertTrue(message('meteor', {'ready'}).check(self.status))
+        self.assertFalse(message('meteor', ['ready', 'ok']).check(self.status))
+
+    def test_unit_count(self):
+        self.assertTrue(unit_count('meteor', 2).check(self.status))
+        self.assertFalse(unit_count('meteor', 1).check(self.status))
+        self.assertTrue(
+            unit_count('meteor', 1, at_least=True).check(self.status))
+        self.assertTrue(unit_count('missing', 0).check(self.status))
+
+    def test_agent_idle_for(self):
+        self.assertTrue(agent_idle_for('meteor', 30).check(self.status))
+        unit = self.raw['services']['meteor']['units']['meteor/1']
+        unit['juju-status']['since'] = (
+            datetime.now() - timedelta(seconds=10)).strftime(
+            '%d %b %Y %H:%M:%S')
+        status = _normalize_status(self.raw)
+        self.assertTrue(agent_idle_for('meteor/0', 30).check(status))
+        self.assertFalse(agent_idle_for('meteor', 30).check(status))
+        self.assertTrue(agent_idle_for('meteor', 5).check(status))
+
+    def test_composition(self):
+        active = unit_state('meteor', 'active')
+        blocked = unit_state('meteor', 'blocked')
+        two = unit_count('meteor', 2)
+
+        self.assertIsNone(all_of(active, two).evaluate(self.status))
+        self.assertIs(blocked, all_of(active, blocked, two).evaluate(
+            self.status))
+        self.assertIsNone(any_of(blocked, active).evaluate(self.status))
+        self.assertIsNotNone(any_of(blocked, ~two).evaluate(self.status))
+        self.assertTrue(not_(blocked).check(self.status))
+        self.assertTrue((active & ~blocked | blocked).check(self.status))
+        self.assertEqual(set(['meteor', 'old']),
+                         (active & unit_count('old', 1)).services())
+
+    def test_short_circuit(self):
+        blocked = unit_state('meteor', 'blocked')
+        later = Mock()
+        self.assertIs(blocked, all_of(blocked, later).evaluate(self.status))
+        self.assertFalse(later.evaluate.called)
+
+    def test_str(self):
+        self.assertEqual(
+            "(meteor in state 'active' and not meteor has 3 units)",
+            str(unit_state('meteor', 'active') & ~unit_count('meteor', 3)))
+
+
+class WaitForTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in [
+                patch.object(Talisman, 'wait_for_status',
+                             Mock(return_value=mock_status)),
+                patch.object(UnitSentry, 'upload_scripts', Mock()),
+                patch('amulet.helpers.juju', Mock(return_value='status')),
+                patch('amulet.helpers.Backoff.delay',
+                      Mock(return_value=0.01))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.statuses = []
+        patcher = patch('amulet.waiter.status', side_effect=self.next_status)
+        self.waiter_status = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.talisman = Talisman(['meteor'], juju_env='env')
+
+    def next_status(self, *args, **kwargs):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+    def test_wait_for(self):
+        pending = deepcopy(mock_status)
+        unit = pending['services']['meteor']['units']['meteor/1']
+        unit['workload-status']['message'] = 'installing'
+        self.statuses = [pending, pending, mock_status]
+
+        status = self.talisman.wait_for(
+            message('meteor', 'ready') & unit_count('meteor', 2), 5)
+        self.assertEqual('ready', status['meteor']['meteor/1'].message)
+        self.assertEqual(3, self.waiter_status.call_count)
+
+    def test_timeout_names_unmet(self):
+        self.statuses = [mock_status]
+        try:
+            self.talisman.wait_for(
+                all_of(unit_state('meteor', 'active'),
+                       unit_count('meteor', 3)), 0.1)
+        except TimeoutError as e:
+            self.assertIn('unmet: meteor has 3 units', e.value)
+            self.assertTrue(e.reported)
+        else:
+            self.fail('TimeoutError not raised')
+
+    @patch('amulet.helpers.report_timeout')
+    def test_timeout_reported_once(self, report_timeout):
+        self.statuses = [mock_status]
+        with self.assertRaises(TimeoutError):
+            with timeout(0.1):
+                self.talisman.wait_for(unit_count('meteor', 3), 300)
+        self.assertEqual(1, report_timeout.call_count)
+
+    def test_fail_on_error(self):
+        errored = deepcopy(mock_status)
+        unit = errored['services']['meteor']['units']['meteor/0']
+        unit['workload-status']['current'] = 'error'
+        self.statuses = [errored]
+        self.assertRaisesRegexp(
+            Exception, 'Error on unit meteor/0',
+            self.talisman.wait_for, unit_count('meteor', 3), 5)
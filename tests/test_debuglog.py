@@ -0,0 +1,125 @@
+"""Unit test for amulet.debuglog"""
+
+import io
+import threading
+import time
+import unittest
+
+from amulet import debuglog
+from amulet.debuglog import DebugLogWatcher, parse_line
+from amulet.helpers import Backoff
+from amulet.poller import StatusPoller
+from amulet.sentry import _settle_backoff
+
+from mock import Mock, patch
+
+RECORDED_LOG = b"""\
+machine-0: 10:41:20 INFO juju.worker.deployer deploying unit "mysql/0"
+unit-mysql-0: 10:41:21 DEBUG juju.worker.uniter.operation running operation run install hook
+unit-mysql-0: 10:41:21 INFO unit.mysql/0.juju-log installing packages
+unit-mysql-0: 10:41:30 INFO juju.worker.uniter.operation ran "install" hook
+unit-my-app-10: 10:41:31 DEBUG juju.worker.uniter.operation running operation run hook for db-relation-changed
+unit-my-app-10: 10:41:33 ERROR juju.worker.uniter.operation hook "db-relation-changed" failed: exit status 1
+"""
+
+
+class ParseLineTest(unittest.TestCase):
+    def test_parse(self):
+        lines = RECORDED_LOG.decode('utf-8').splitlines()
+        self.assertEqual([
+            None,
+            ('mysql/0', 'running', 'install'),
+            None,
+            ('mysql/0', 'ran', 'install'),
+            ('my-app/10', 'running', 'db-relation-changed'),
+            ('my-app/10', 'failed', 'db-relation-changed'),
+        ], [parse_line(line) for line in lines])
+
+    def test_juju1(self):
+        self.assertEqual(
+            ('mysql/0', 'ran', 'config-changed'),
+            parse_line('unit-mysql-0[1234]: 2015-09-24 16:44:44 INFO '
+                       'juju.worker.uniter.operation runhook.go:107 ran '
+                       '"config-changed" hook'))
+        self.assertEqual(
+            ('mysql/0', 'ran', 'stop'),
+            parse_line('unit-mysql-0: 10:41:30 INFO '
+                       'juju.worker.uniter.operation skipped "stop" hook '
+                       '(missing)'))
+
+
+class DebugLogWatcherTest(unittest.TestCase):
+    def watch(self, log):
+        watcher = DebugLogWatcher(io.BytesIO(log), 'env')
+        listener = Mock()
+        watcher.add_listener(listener)
+        watcher.start()
+        watcher._thread.join(5)
+        return watcher, listener
+
+    def test_activity(self):
+        watcher, listener = self.watch(RECORDED_LOG)
+        self.assertEqual('install', watcher.units['mysql/0'].hook)
+        self.assertFalse(watcher.units['mysql/0'].running)
+        self.assertEqual('failed', watcher.units['my-app/10'].event)
+        self.assertEqual(2, watcher.hooks)
+        self.assertEqual(set(), watcher.running())
+        # two hooks finished, then the log ended
+        self.assertEqual(3, listener.call_count)
+        self.assertIsInstance(watcher.error, IOError)
+
+    def test_finished(self):
+        before = time.time()
+        watcher, listener = self.watch(RECORDED_LOG)
+        self.assertGreaterEqual(watcher.finished('mysql/0', 'install'),
+                                before)
+        self.assertIsNotNone(
+            watcher.finished('my-app/10', 'db-relation-changed'))
+        self.assertIsNone(watcher.finished('mysql/0', 'config-changed'))
+        self.assertIsNone(watcher.finished('mysql/1', 'install'))
+
+    def test_long_lines(self):
+        line = (b'unit-mysql-0: 10:41:30 INFO juju.worker.uniter.operation '
+                b'ran "install" hook ' + b'x' * debuglog.MAX_LINE * 3 +
+                b' ran "stop" hook\n')
+        watcher, listener = self.watch(line + RECORDED_LOG.splitlines()[1])
+        self.assertEqual(1, watcher.hooks)
+        self.assertEqual(set(['mysql/0']), watcher.running())
+
+    def test_stop(self):
+        stream = Mock()
+        stream.readline.side_effect = lambda size: (
+            started.set() or stopped.wait(5) or b'')
+        started, stopped = threading.Event(), threading.Event()
+        process = Mock()
+        process.poll.return_value = None
+        process.terminate.side_effect = stopped.set
+        watcher = DebugLogWatcher(stream, 'env', process).start()
+        started.wait(5)
+        watcher.stop()
+        self.assertTrue(process.terminate.called)
+        self.assertIsNone(watcher.error)
+
+    def test_registry(self):
+        watcher = DebugLogWatcher(io.BytesIO(b''), 'env')
+        debuglog.watch('env', watcher)
+        self.addCleanup(debuglog.unwatch, 'env')
+        self.assertIs(watcher, debuglog.get_watcher('env'))
+        self.assertEqual(debuglog.CONFIRM_INTERVAL,
+                         _settle_backoff('env').ceiling)
+        self.assertEqual(1, _settle_backoff('other').initial)
+
+        watcher.error = IOError()
+        self.assertIsNone(debuglog.get_watcher('env'))
+
+    @patch('amulet.waiter.status', Mock(return_value={}))
+    def test_wakes_subscribers(self):
+        watcher = DebugLogWatcher(io.BytesIO(b''), 'debuglog-env')
+        debuglog.watch('debuglog-env', watcher)
+        self.addCleanup(debuglog.unwatch, 'debuglog-env')
+        backoff = Mock(spec=Backoff)
+        poller = StatusPoller('debuglog-env')
+        with poller.subscribe(backoff=backoff):
+            watcher.feed(RECORDED_LOG.decode('utf-8').splitlines()[3])
+        self.assertEqual(1, backoff.wake.call_count)
+        self.assertEqual([], watcher._listeners)
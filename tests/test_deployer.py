@@ -175,7 +175,7 @@ class DeployerTests(unittest.TestCase):
                                     'storage': {"mystorage": "ebs,10g,1"}}}, d.services)
 
     def _make_mock_status(self, d):
-        def _mock_status(juju_env):
+        def _mock_status(juju_env, services=None, projected=False):
             status = dict(services={}, machines={})
             total_units = 1
             for service in d.services:
@@ -223,11 +223,17 @@ class DeployerTests(unittest.TestCase):
 
         waiter_status.side_effect = self._make_mock_status(d)
         d.add('charm', units=1)
+        subprocess.Popen.return_value.returncode = 0
         d.setup()
+        sentry = d.sentry
+        uploads = upload_scripts.call_count
         with patch('amulet.deployer.juju') as j:
             d.add_unit('charm')
             j.assert_called_with(['add-unit', 'charm', '-n', '1'])
         self.assertTrue('charm/1' in d.sentry.unit)
+        self.assertIs(sentry, d.sentry)
+        # only the new unit is set up
+        self.assertEqual(uploads + 1, upload_scripts.call_count)
         self.assertEqual(2, d.services['charm']['num_units'])
 
     @patch.object(UnitSentry, 'upload_scripts')
@@ -254,6 +260,7 @@ class DeployerTests(unittest.TestCase):
 
         waiter_status.side_effect = self._make_mock_status(d)
         d.add('charm', units=1)
+        subprocess.Popen.return_value.returncode = 0
         d.setup()
         with patch('amulet.deployer.juju') as j:
             d.add_unit('charm', target='lxc:0')
@@ -268,8 +275,8 @@ class DeployerTests(unittest.TestCase):
     def test_add_unit_error(self, mcharm, subprocess, waiter_status,
                             environments, upload_scripts):
         def mock_unit_error(f, service, unit_name):
-            def _mock_unit_error(juju_env):
-                status = f(juju_env)
+            def _mock_unit_error(juju_env, services=None, projected=False):
+                status = f(juju_env, services)
                 unit = status['services'][service]['units'].get(unit_name)
                 if not unit:
                     return status
@@ -290,6 +297,7 @@ class DeployerTests(unittest.TestCase):
         waiter_status.side_effect = mock_unit_error(
             self._make_mock_status(d), 'charm', 'charm/1')
         d.add('charm', units=1)
+        subprocess.Popen.return_value.returncode = 0
         d.setup()
         with patch('amulet.deployer.juju'):
             self.assertRaisesRegexp(
@@ -437,6 +445,15 @@ class DeployerTests(unittest.TestCase):
         d = Deployment(juju_env='gojuju')
         self.assertRaises(ValueError, d.expose, 'wordpress')
 
+    @patch('amulet.deployer.waiter.invalidate_status')
+    @patch('amulet.deployer.juju')
+    def test_expose_deployed_invalidates_status(self, juju, invalidate):
+        d = Deployment(juju_env='gojuju')
+        d.deployed = True
+        d.expose('wordpress')
+        juju.assert_called_with(['expose', 'wordpress'])
+        invalidate.assert_called_once_with()
+
     @patch('amulet.charm.CharmCache.get_charm')
     def test_schema(self, mcharm):
         wpmock = MagicMock()
@@ -1,18 +1,25 @@
 """Unit test for amulet.wait"""
 
+import threading
 import unittest
 import sys
 import yaml
 import time
 
 from amulet.helpers import (
+    Backoff,
+    Deadline,
     JujuVersion,
     environments,
     default_environment,
     juju,
+    current_deadline,
     raise_status,
+    report_timeout,
+    timeout,
     timeout_gen,
     TimeoutError,
+    TIMEOUT_STATUS_LIMIT,
 )
 
 from mock import patch, Mock
@@ -102,6 +109,95 @@ class HelpersTest(unittest.TestCase):
         self.assertRaises(TimeoutError, case, 0.1)
         case(0.5)
 
+    @patch('amulet.helpers.juju')
+    @patch('amulet.helpers.sys.stderr')
+    def test_timeout_report(self, stderr, juju):
+        report = Mock(return_value='meteor/0: agent executing\n')
+        with patch.dict('os.environ', {'AMULET_TIMEOUT_STATUS': ''}):
+            self.assertRaises(TimeoutError, list,
+                              timeout_gen(0, report=report))
+        stderr.write.assert_called_with('meteor/0: agent executing\n')
+        self.assertFalse(juju.called)
+
+        juju.return_value = 'status'
+        with patch.dict('os.environ', {'AMULET_TIMEOUT_STATUS': '1'}):
+            report_timeout(10)
+        args, kwargs = juju.call_args
+        self.assertEqual((['status', '--format', 'yaml'],), args)
+        # the fetch isn't bound by the deadline which just passed
+        self.assertAlmostEqual(TIMEOUT_STATUS_LIMIT,
+                               kwargs['deadline'].remaining(), delta=1)
+        stderr.write.assert_called_with('status')
+
+        juju.side_effect = TimeoutError('Deadline exceeded')
+        report.side_effect = KeyError('x')
+        with patch.dict('os.environ', {'AMULET_TIMEOUT_STATUS': '1'}):
+            report_timeout(10, report)  # doesn't raise
+        stderr.write.assert_called_with('Deadline exceeded\n')
+
+    @patch('amulet.helpers.report_timeout')
+    def test_timeout(self, report_timeout):
+        report = Mock()
+        with self.assertRaises(TimeoutError):
+            with timeout(0.2, report) as deadline:
+                self.assertIs(deadline, current_deadline())
+                for i in timeout_gen(60):
+                    pass
+        # reported once, by the inner loop
+        report_timeout.assert_called_once_with(60, None)
+        self.assertIsNone(current_deadline())
+
+        # not preemptive: a block which overruns in code without a
+        # deadline, but succeeds, didn't time out
+        with timeout(0.1):
+            time.sleep(0.2)
+
+        with self.assertRaises(TimeoutError):
+            with timeout(5, report):
+                raise TimeoutError()
+        self.assertEqual(1, report_timeout.call_count)
+
+        # an error from a call bound by the block's deadline
+        with self.assertRaises(TimeoutError):
+            with timeout(0.1, report):
+                time.sleep(0.15)
+                juju(['status'])
+        report_timeout.assert_called_with(0.1, report)
+        self.assertEqual(2, report_timeout.call_count)
+
+    def test_nested_deadlines(self):
+        with timeout(10) as outer:
+            with timeout(60) as inner:
+                self.assertEqual(outer.at, inner.at)
+            with timeout(1) as inner:
+                self.assertLess(inner.at, outer.at)
+                self.assertEqual(inner.at, Deadline.within(None).at)
+                self.assertLessEqual(Deadline.within(5).at, inner.at)
+        self.assertIsNone(Deadline.within().remaining())
+        # an explicit parent replaces the current deadline
+        with timeout(1):
+            self.assertIsNone(Deadline.within(None, Deadline()).at)
+
+    def test_deadline_threads(self):
+        seen = {}
+
+        def work():
+            with timeout(30) as deadline:
+                time.sleep(0.1)
+                seen[deadline] = current_deadline()
+
+        with timeout(1):
+            threads = [threading.Thread(target=work) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # each thread has its own deadlines, not the main thread's
+        self.assertEqual(2, len(seen))
+        for deadline, current in seen.items():
+            self.assertIs(deadline, current)
+            self.assertGreater(deadline.remaining(), 20)
+
     @patch('amulet.helpers.juju')
     @patch('amulet.helpers.JUJU_MODEL', None)
     @patch('os.environ', {})
@@ -118,6 +214,35 @@ class JujuTest(unittest.TestCase):
                          juju(['version'],
                               include_model=False).split('-')[0])
 
+    @patch('amulet.helpers.default_environment', Mock(return_value='env'))
+    @patch('amulet.helpers.subprocess.Popen')
+    def test_juju_timeout(self, popen):
+        killed = threading.Event()
+        process = popen.return_value
+        process.poll.return_value = None
+        process.kill.side_effect = killed.set
+        process.communicate.side_effect = lambda: (
+            killed.wait(5), (b'', b''))[1]
+        process.returncode = -9
+        self.assertRaisesRegexp(TimeoutError, 'killed', juju, ['status'],
+                                env={}, timeout=0.1)
+        self.assertTrue(killed.is_set())
+
+        # the deadline passes as the command exits
+        process.reset_mock()
+        process.poll.return_value = 0
+        process.communicate.side_effect = lambda: (time.sleep(0.2),
+                                                   (b'ok', b''))[1]
+        process.returncode = 0
+        self.assertEqual('ok', juju(['status'], env={}, timeout=0.1))
+        self.assertFalse(process.kill.called)
+
+        # expired before the command would even start
+        popen.reset_mock()
+        self.assertRaises(TimeoutError, juju, ['status'], env={},
+                          deadline=Deadline(0))
+        self.assertFalse(popen.called)
+
     @patch('amulet.helpers.subprocess.Popen')
     def test_juju_oserror(self, mp):
         mp.side_effect = [OSError(1, 'Command Failed')]
@@ -137,3 +262,52 @@ class RaiseStatusTest(unittest.TestCase):
         raise_status(100, 'Hello World')
         mp.assert_called_with('Hello World')
         me.assert_called_with(100)
+
+
+class BackoffTest(unittest.TestCase):
+    def test_delay(self):
+        backoff = Backoff(initial=1, fast=2, factor=2, ceiling=5, jitter=0)
+        self.assertEqual([1, 1, 2, 4, 5, 5],
+                         [backoff.delay() for i in range(6)])
+        backoff.reset()
+        self.assertEqual(1, backoff.delay())
+
+    def test_poll_at(self):
+        backoff = Backoff(initial=1, jitter=0)
+        backoff.poll_at = time.time() + 20
+        self.assertTrue(19 < backoff.delay() <= 20)
+        backoff = Backoff(initial=30, ceiling=30, jitter=0)
+        backoff.poll_at = time.time() + 5
+        self.assertTrue(4 < backoff.delay() <= 5)
+        backoff.poll_at = time.time() - 20
+        self.assertEqual(30, backoff.delay())
+
+    def test_jitter(self):
+        backoff = Backoff(initial=1, fast=10, ceiling=10, jitter=0.5)
+        for i in range(10):
+            self.assertTrue(0.5 <= backoff.delay() <= 1.5)
+
+    def test_sleep_limit(self):
+        backoff = Backoff(initial=10, jitter=0)
+        start = time.time()
+        backoff.sleep(0.05)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_wake(self):
+        backoff = Backoff(initial=10, jitter=0)
+        backoff.delay()
+        backoff.delay()
+        threading.Timer(0.05, backoff.wake).start()
+        start = time.time()
+        backoff.sleep()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(0, backoff.polls)
+
+    @patch('amulet.helpers.juju', Mock(return_value='status'))
+    def test_timeout_gen_backoff(self):
+        backoff = Mock()
+        for i in timeout_gen(10, backoff):
+            if i == 2:
+                break
+        self.assertEqual(2, backoff.sleep.call_count)
+        self.assertTrue(backoff.sleep.call_args[0][0] <= 10)
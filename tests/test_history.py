@@ -0,0 +1,119 @@
+"""Unit test for amulet.history"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from copy import deepcopy
+
+from amulet import history, waiter
+from amulet.helpers import TimeoutError
+from amulet.history import Replay, StatusHistory
+from amulet.sentry import Talisman
+from .test_sentry import mock_status
+
+from mock import Mock, patch
+
+
+def executing():
+    status = deepcopy(mock_status)
+    unit = status['services']['meteor']['units']['meteor/0']
+    unit['juju-status']['current'] = 'executing'
+    return status
+
+
+class StatusHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_record(self):
+        h = StatusHistory('env')
+        h.record(mock_status, 1)
+        h.record(mock_status, 2)
+        h.record(deepcopy(mock_status), 3)
+        h.record(executing(), 4)
+        self.assertEqual([(1, mock_status), (4, executing())],
+                         h.snapshots())
+
+    def test_memory_cap(self):
+        h = StatusHistory('env', max_bytes=4096)
+        for n in range(200):
+            h.record({'n': n, 'services': mock_status['services']})
+        self.assertLessEqual(h.size, 4096)
+        snapshots = h.snapshots()
+        self.assertLess(len(snapshots), 200)
+        self.assertEqual(199, snapshots[-1][1]['n'])
+
+    def test_recording(self):
+        for name in ('status.jsonl', 'status.jsonl.gz'):
+            path = os.path.join(self.tmpdir, name)
+            h = StatusHistory('env', path=path)
+            h.record(mock_status, 1)
+            h.record(executing(), 2)
+            h.close()
+
+            records = list(history.load(path))
+            self.assertEqual(['env', 'env'], [r['model'] for r in records])
+            self.assertEqual([1, 2], [r['time'] for r in records])
+            self.assertEqual([mock_status, executing()],
+                             [r['status'] for r in records])
+
+    def test_dump(self):
+        h = StatusHistory('env')
+        h.record(mock_status, 1)
+        path = os.path.join(self.tmpdir, 'dump.jsonl')
+        h.dump(path)
+        self.assertEqual([{'model': 'env', 'time': 1, 'status': mock_status}],
+                         list(history.load(path)))
+
+
+class ReplayTest(unittest.TestCase):
+    def talisman(self, juju_env):
+        t = Talisman.__new__(Talisman)
+        t.juju_env = juju_env
+        t.service_names = ['meteor']
+        t.unit = {}
+        return t
+
+    def test_replay(self):
+        replay = Replay([1, 2])
+        listener = []
+        replay.add_listener(lambda: listener.append(True))
+        self.assertEqual([1, 2, 2], [replay.status() for i in range(3)])
+        self.assertTrue(replay.exhausted)
+        self.assertEqual(1, len(listener))
+
+    def test_wait_offline(self):
+        h = StatusHistory('recorded')
+        for status in [executing()] * 3 + [mock_status]:
+            h.record(deepcopy(status))
+
+        start = time.time()
+        with waiter.replay(h, juju_env='env') as replays:
+            self.talisman('env').wait(5)
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(replays['env'].exhausted)
+        self.assertIsNone(waiter.apiwatcher.get_watcher('env'))
+
+    @patch.dict(os.environ, {'AMULET_STATUS_HISTORY': '1'})
+    @patch('amulet.helpers.juju', Mock(return_value='status'))
+    def test_wait_offline_times_out(self):
+        h = StatusHistory('env')
+        h.record(executing())
+
+        with waiter.replay(h):
+            t = self.talisman('env')
+            self.assertRaises(TimeoutError, t.wait, 1)
+            self.assertEqual(1, len(t.history))
+
+    @patch.dict(os.environ, clear=True)
+    def test_history_off_by_default(self):
+        h = StatusHistory('env')
+        h.record(mock_status)
+
+        with waiter.replay(h):
+            t = self.talisman('env')
+            t.wait(5)
+        self.assertIsNone(t.history)
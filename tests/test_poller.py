@@ -0,0 +1,120 @@
+"""Unit test for amulet.poller"""
+
+import threading
+import time
+import unittest
+
+from amulet.helpers import Deadline, TimeoutError
+from amulet.poller import StatusPoller
+
+from mock import patch
+
+
+class StatusPollerTest(unittest.TestCase):
+    @patch('amulet.waiter.status')
+    def test_next_is_fresh(self, status):
+        status.side_effect = [{'n': 1}, {'n': 2}, {'n': 3}]
+        poller = StatusPoller('env')
+
+        with poller.subscribe() as subscription:
+            self.assertEqual({'n': 1}, subscription.next())
+            self.assertEqual({'n': 2}, subscription.next())
+
+        with poller.subscribe() as subscription:
+            self.assertEqual({'n': 3}, subscription.next())
+        self.assertEqual(3, poller.fetches)
+
+    @patch('amulet.waiter.status')
+    def test_concurrent_waiters_share_fetch(self, status):
+        release = threading.Event()
+
+        def slow_status(juju_env, services, projected):
+            release.wait(5)
+            return {'env': juju_env}
+        status.side_effect = slow_status
+
+        poller = StatusPoller('env')
+        subscriptions = [poller.subscribe() for i in range(5)]
+        results = []
+
+        def waiter(subscription):
+            results.append(subscription.next())
+
+        threads = [threading.Thread(target=waiter, args=(s,))
+                   for s in subscriptions]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        for subscription in subscriptions:
+            subscription.close()
+
+        self.assertEqual([{'env': 'env'}] * 5, results)
+        self.assertEqual(1, poller.fetches)
+        status.assert_called_once_with('env', None, projected=True)
+
+    @patch('amulet.waiter.status')
+    def test_deadline(self, status):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_status(juju_env, services, projected):
+            if status.call_count > 1:
+                release.wait(5)
+            return {'n': status.call_count}
+        status.side_effect = slow_status
+        poller = StatusPoller('env')
+
+        with poller.subscribe(deadline=Deadline(0.2)) as subscription:
+            self.assertEqual({'n': 1}, subscription.next())
+            # the last status again, for the caller to time out on
+            self.assertEqual({'n': 1}, subscription.next())
+        # nothing to return before a first status
+        with StatusPoller('env').subscribe(
+                deadline=Deadline(0.2)) as subscription:
+            self.assertRaises(TimeoutError, subscription.next)
+
+    @patch('amulet.waiter.status')
+    def test_error_propagates(self, status):
+        status.side_effect = [ValueError('boom'), {'n': 1}]
+        poller = StatusPoller('env')
+
+        with poller.subscribe() as subscription:
+            self.assertRaises(ValueError, subscription.next)
+            self.assertEqual({'n': 1}, subscription.next())
+
+    @patch('amulet.waiter.status')
+    def test_thread_stops_without_subscribers(self, status):
+        status.return_value = {}
+        poller = StatusPoller('env')
+
+        with poller.subscribe() as subscription:
+            subscription.next()
+            thread = poller._thread
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(poller._thread)
+
+    def test_for_model(self):
+        self.assertIs(StatusPoller.for_model('a'),
+                      StatusPoller.for_model('a'))
+        self.assertIsNot(StatusPoller.for_model('a'),
+                         StatusPoller.for_model('b'))
+
+    @patch('amulet.waiter.status')
+    def test_scope(self, status):
+        status.return_value = {}
+        poller = StatusPoller('env')
+
+        with poller.subscribe(['mysql']) as a:
+            with poller.subscribe(['wordpress', 'mysql']):
+                a.next()
+                status.assert_called_with('env', ['mysql', 'wordpress'],
+                                          projected=True)
+                with poller.subscribe():
+                    a.next()
+                    status.assert_called_with('env', None, projected=True)
+            a.next()
+            status.assert_called_with('env', ['mysql'], projected=True)
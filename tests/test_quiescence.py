@@ -0,0 +1,95 @@
+"""Unit test for amulet.quiescence"""
+
+import unittest
+
+from amulet.quiescence import HookActivity, relation_graph
+
+
+def model(units, relations=None):
+    """Return a raw Juju 2 status with ``units`` mapping unit names to
+    ``(agent status, message, since)``.
+
+    """
+    services = {}
+    for name, (current, message, since) in units.items():
+        service = services.setdefault(name.split('/')[0], {'units': {}})
+        service['units'][name] = {'juju-status': {
+            'current': current, 'message': message, 'since': since}}
+    for name, related in (relations or {}).items():
+        services.setdefault(name, {})['relations'] = {'rel': related}
+    return {'machines': {}, 'services': services}
+
+
+class RelationGraphTest(unittest.TestCase):
+    def test_graph(self):
+        status = model({}, {'wordpress': ['mysql'], 'mysql': ['mysql']})
+        status['services']['rsyslog'] = {'subordinate-to': ['wordpress']}
+        self.assertEqual({
+            'wordpress': set(['mysql', 'rsyslog']),
+            'mysql': set(['mysql', 'wordpress']),
+            'rsyslog': set(['wordpress']),
+        }, relation_graph(status))
+
+
+class HookActivityTest(unittest.TestCase):
+    def test_unobserved(self):
+        activity = HookActivity(latency=5)
+        self.assertEqual(105, activity.settled_at('a/0', 100))
+
+    def test_floor(self):
+        activity = HookActivity(min_idle=30, latency=5)
+        activity.observe(model({'a/0': ('idle', '', 's0')}))
+        self.assertEqual(130, activity.settled_at('a/0', 100))
+
+    def test_unrelated(self):
+        activity = HookActivity(latency=5)
+        activity.observe(model({'a/0': ('idle', '', 's0')}))
+        self.assertEqual(100, activity.settled_at('a/0', 100))
+
+    def test_lone_peer(self):
+        activity = HookActivity(latency=5)
+        activity.observe(model({'a/0': ('idle', '', 's0')}, {'a': ['a']}))
+        self.assertEqual(100, activity.settled_at('a/0', 100))
+        activity.observe(model({'a/0': ('idle', '', 's0'),
+                                'a/1': ('idle', '', 's0')}, {'a': ['a']}))
+        self.assertEqual(105, activity.settled_at('a/0', 100))
+
+    def test_related(self):
+        activity = HookActivity(latency=5)
+        activity.observe(model({'a/0': ('idle', '', 's0'),
+                                'b/0': ('idle', '', 's0')}, {'a': ['b']}))
+        self.assertEqual(105, activity.settled_at('a/0', 100))
+        self.assertEqual(105, activity.settled_at('b/0', 100))
+
+    def test_hooks(self):
+        activity = HookActivity(latency=5)
+        units = {'a/0': ('executing', 'running install hook', 's0')}
+        activity.observe(model(units))
+        self.assertEqual('install', activity.hook('a/0'))
+        units['a/0'] = ('idle', '', 's1')
+        activity.observe(model(units))
+        # install is always followed by more hooks
+        self.assertEqual(105, activity.settled_at('a/0', 100))
+
+        units['a/0'] = ('executing', 'running update-status hook', 's2')
+        activity.observe(model(units, {'a': ['b']}))
+        units['a/0'] = ('idle', '', 's3')
+        activity.observe(model(units, {'a': ['b']}))
+        self.assertEqual('update-status', activity.hook('a/0'))
+        self.assertEqual(100, activity.settled_at('a/0', 100))
+
+        # a hook which ran between two observations is unknown
+        units['a/0'] = ('idle', '', 's4')
+        activity.observe(model(units, {'a': ['b']}))
+        self.assertIsNone(activity.hook('a/0'))
+        self.assertEqual(105, activity.settled_at('a/0', 100))
+
+    def test_ran(self):
+        activity = HookActivity()
+        self.assertFalse(activity.ran('a/0', 'config-changed'))
+        activity.observe(model(
+            {'a/0': ('executing', 'running config-changed hook', 's0')}))
+        activity.observe(model({'a/0': ('idle', '', 's1')}))
+        self.assertTrue(activity.ran('a/0', 'config-changed'))
+        self.assertFalse(activity.ran('a/0', 'install'))
+        self.assertFalse(activity.ran('a/1', 'config-changed'))
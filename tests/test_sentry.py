@@ -1,18 +1,38 @@
+import calendar
+import gc
+import io
+import json
+import os
 import re
+import resource
+import threading
+import time
 import unittest
 import yaml
 from datetime import datetime
 from copy import deepcopy
 
+from amulet import debuglog
+from amulet import helpers
 from amulet.sentry import (
+    IDLE_THRESHOLD,
+    AgentProbe,
     Talisman,
     UnitSentry,
     StatusMessageMatcher,
+    StatusTracker,
+    UnitIndex,
+    UnitState,
+    _agent_settled,
+    since_epoch,
+    wait_all,
 )
 from amulet.helpers import (
     TimeoutError,
+    UnitError,
     UnsupportedError,
 )
+from amulet.quiescence import HookActivity
 from mock import patch, Mock
 
 
@@ -256,7 +276,11 @@ class TalismanTest(unittest.TestCase):
         status.return_value = mock_status
         talisman = Talisman([], timeout=self.timeout)
 
-        talisman.wait_for_status('env', ['meteor'], self.timeout)
+        status.reset_mock()
+        self.assertIs(mock_status, talisman.wait_for_status(
+            'env', ['meteor'], self.timeout))
+        # the status the wait saw is returned, not fetched again
+        self.assertEqual(1, status.call_count)
         talisman.wait_for_status('env', ['old'], self.timeout)
         talisman.wait_for_status('env', ['sub'], self.timeout)
         talisman.wait_for_status('env', ['unsub'], self.timeout)
@@ -269,6 +293,14 @@ class TalismanTest(unittest.TestCase):
                                 talisman.wait_for_status, 'env', ['olderrord'], self.timeout)
         self.assertRaises(TimeoutError, talisman.wait_for_status, 'env', ['subpend'], self.timeout)
 
+        errored = deepcopy(mock_status)
+        errored['machines']['1']['juju-status']['current'] = 'error'
+        errored['machines']['1']['agent-state'] = 'error'
+        status.return_value = errored
+        self.assertRaisesRegexp(UnitError, 'meteor/0: machine failed',
+                                talisman.wait_for_status, 'env', ['meteor'],
+                                300)
+
     @patch.object(Talisman, '__init__', Mock(return_value=None))
     @patch('amulet.helpers.juju', Mock(return_value='status'))
     @patch('amulet.waiter.status')
@@ -356,6 +388,197 @@ class TalismanTest(unittest.TestCase):
         juju_agent.return_value = {}
         t.wait(self.timeout)
 
+    @patch('amulet.helpers.juju', Mock(return_value='status'))
+    @patch('amulet.helpers.default_environment', Mock())
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.waiter.status')
+    def test_wait_units(self, _status):
+        status = _status.return_value = deepcopy(mock_status)
+        t = Talisman(['meteor'], timeout=self.timeout)
+        status['services']['meteor']['units']['meteor/1']['juju-status'][
+            'current'] = 'executing'
+        self.assertRaises(TimeoutError, t.wait, self.timeout)
+        self.assertRaises(TimeoutError, t.wait, self.timeout,
+                          units=['meteor/1'])
+        t.wait(self.timeout, units=['meteor/0'])
+        # a unit which doesn't exist (yet) can't have settled
+        self.assertRaises(TimeoutError, t.wait, self.timeout,
+                          units=['meteor/0', 'meteor/2'])
+
+    @patch('amulet.helpers.juju', Mock(return_value='status'))
+    @patch('amulet.helpers.default_environment', Mock())
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.waiter.status')
+    def test_wait_hook(self, _status):
+        _status.return_value = deepcopy(mock_status)
+        t = Talisman(['meteor'], timeout=self.timeout)
+        since = time.time()
+        self.assertRaises(TimeoutError, t.wait, self.timeout,
+                          units=['meteor/0'], hook='config-changed')
+
+        watcher = debuglog.DebugLogWatcher(io.BytesIO(b''), t.juju_env)
+        debuglog.watch(t.juju_env, watcher)
+        self.addCleanup(debuglog.unwatch, t.juju_env)
+        watcher.feed('unit-meteor-0: 10:41:30 INFO '
+                     'juju.worker.uniter.operation ran "config-changed" hook')
+        t.wait(self.timeout, units=['meteor/0'], hook='config-changed',
+               since=since)
+        self.assertRaises(TimeoutError, t.wait, self.timeout,
+                          units=['meteor/0'], hook='config-changed',
+                          since=time.time() + 1)
+        self.assertRaises(TimeoutError, t.wait, self.timeout,
+                          units=['meteor'], hook='config-changed',
+                          since=since)
+
+    @patch('amulet.helpers.juju', Mock(return_value='status'))
+    @patch('amulet.helpers.default_environment', Mock())
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.sentry._hook_activity',
+           Mock(side_effect=lambda idle_floor: HookActivity(latency=0)))
+    @patch('amulet.waiter.status')
+    def test_wait_hook_missed(self, _status):
+        status = _status.return_value = deepcopy(mock_status)
+        t = Talisman(['meteor'], timeout=self.timeout)
+        since = time.time()
+        agent = status['services']['meteor']['units']['meteor/0'][
+            'juju-status']
+        agent['since'] = time.strftime(
+            '%d %b %Y %H:%M:%SZ', time.gmtime(since))
+        t.wait(self.timeout, units=['meteor/0'], hook='config-changed',
+               since=since)
+        self.assertRaises(TimeoutError, t.wait, self.timeout,
+                          units=['meteor/0'], hook='config-changed',
+                          since=since + 5)
+
+    @patch('amulet.helpers.juju', Mock(return_value='status'))
+    @patch('amulet.helpers.default_environment', Mock())
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.waiter.status')
+    def test_wait_deadline(self, _status):
+        status = _status.return_value = deepcopy(mock_status)
+        t = Talisman(['meteor'], timeout=self.timeout)
+        status['services']['meteor']['units']['meteor/1']['juju-status'][
+            'current'] = 'executing'
+        start = time.time()
+
+        def wait_in_block():
+            with helpers.timeout(0.3):
+                t.wait(300)
+        self.assertRaises(TimeoutError, wait_in_block)
+        self.assertRaises(TimeoutError, t.wait, 300,
+                          deadline=helpers.Deadline(0.3))
+        self.assertLess(time.time() - start, 5)
+
+    @patch('amulet.helpers.report_timeout')
+    @patch('amulet.helpers.default_environment', Mock())
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.waiter.status')
+    def test_wait_deadline_slow_status(self, _status, report_timeout):
+        _status.return_value = mock_status
+        t = Talisman(['meteor'], timeout=self.timeout)
+        executing = deepcopy(mock_status)
+        executing['services']['meteor']['units']['meteor/1']['juju-status'][
+            'current'] = 'executing'
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        def slow_status(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                release.wait(5)  # still running at the deadline
+            return executing
+        _status.side_effect = slow_status
+
+        with self.assertRaises(TimeoutError) as cm:
+            t.wait(300, deadline=helpers.Deadline(0.3))
+        self.assertTrue(cm.exception.reported)
+        self.assertEqual(1, report_timeout.call_count)
+
+    @patch('amulet.helpers.default_environment', Mock(return_value='env'))
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.sentry.subprocess.Popen')
+    def test_run_deadline(self, popen):
+        unit = UnitSentry.fromunitdata(
+            'meteor/0', {'public-address': '10.0.0.1'})
+        popen.return_value.communicate.return_value = (b'ok\n', b'')
+        popen.return_value.returncode = 0
+        self.assertEqual(('ok', 0), unit.run(
+            'hostname', deadline=helpers.Deadline(30)))
+        cmd = popen.call_args[0][0]
+        # the unit is told to give up by the deadline, not after 300s
+        self.assertIn(cmd[cmd.index('--timeout') + 1], ('29s', '30s'))
+
+        killed = threading.Event()
+        popen.return_value.poll.return_value = None
+        popen.return_value.kill.side_effect = killed.set
+        popen.return_value.communicate.side_effect = lambda: (
+            killed.wait(5), (b'', b''))[1]
+        popen.return_value.returncode = -9
+        self.assertRaises(TimeoutError, unit.ssh, 'sleep 60',
+                          deadline=helpers.Deadline(0.1))
+        self.assertTrue(killed.is_set())
+
+    @patch('amulet.helpers.default_environment', Mock(return_value='env'))
+    @patch.object(UnitSentry, 'ssh', Mock(return_value=('', 0)))
+    @patch('amulet.sentry.subprocess.Popen')
+    def test_upload_scripts_deadline(self, popen):
+        unit = UnitSentry('10.0.0.1')
+        unit.info = {'unit_name': 'meteor/0'}
+        # a failing scp is retried, but not past the deadline
+        popen.return_value.communicate.return_value = (None, None)
+        popen.return_value.returncode = 1
+        start = time.time()
+        self.assertRaises(TimeoutError, unit.upload_scripts,
+                          helpers.Deadline(0.2))
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(1, popen.call_count)
+        self.assertEqual(helpers.Deadline, type(
+            UnitSentry.ssh.call_args[1]['deadline']))
+
+        # a hanging scp is killed by it
+        killed = threading.Event()
+        popen.return_value.poll.return_value = None
+        popen.return_value.kill.side_effect = killed.set
+        popen.return_value.communicate.side_effect = lambda: (
+            killed.wait(5), (None, None))[1]
+        popen.return_value.returncode = -9
+        self.assertRaises(TimeoutError, UnitSentry.fromunitdata,
+                          'meteor/0', {'public-address': '10.0.0.1'},
+                          helpers.Deadline(0.1))
+        self.assertTrue(killed.is_set())
+
+    @patch('amulet.helpers.juju', Mock(return_value='status'))
+    @patch('amulet.helpers.default_environment', Mock())
+    @patch.object(UnitSentry, 'upload_scripts', Mock())
+    @patch('amulet.waiter.status')
+    def test_wait_fails_fast(self, _status):
+        status = _status.return_value = deepcopy(mock_status)
+        t = Talisman(['meteor'], timeout=self.timeout)
+        units = status['services']['meteor']['units']
+        units['meteor/0']['workload-status'].update(
+            current='error', message='hook failed: "config-changed"')
+        units['meteor/1']['juju-status']['current'] = 'error'
+        with self.assertRaises(UnitError) as raised:
+            t.wait(300)
+        self.assertEqual([
+            ('meteor/0', 'config-changed', 'hook failed: "config-changed"'),
+            ('meteor/1', None, 'ready'),
+        ], raised.exception.failures)
+        self.assertEqual(['meteor/0', 'meteor/1'], raised.exception.units)
+        self.assertRaisesRegexp(UnitError, 'Error on unit meteor/1',
+                                t.wait_for_messages, {'meteor': 'x'}, 300)
+
+        self.assertRaises(TimeoutError, t.wait, self.timeout,
+                          fail_on_error=False)
+        self.assertRaises(TimeoutError, t.wait_for_messages,
+                          {'meteor': 'x'}, self.timeout, fail_on_error=False)
+        # units outside the scope of the wait don't matter
+        units['meteor/1']['juju-status']['current'] = 'idle'
+        self.assertRaisesRegexp(UnitError, 'meteor/0', t.wait, 300,
+                                units=['meteor/0'])
+        t.wait(self.timeout, units=['meteor/1'])
+
     @patch('amulet.helpers.juju', Mock(return_value='status'))
     @patch('amulet.helpers.default_environment', Mock())
     @patch('amulet.waiter.status')
@@ -466,3 +689,518 @@ class TestStatusMessageMatcher(unittest.TestCase):
         self.assertEqual(3, m.check_message(r('foo'), 'foobar'))
         self.assertEqual(3, m.check_message(r('f..'), 'foo'))
         self.assertEqual(0, m.check_message(r('b..'), 'foo'))
+
+
+class TestUnitIndex(unittest.TestCase):
+    def test_natural_order(self):
+        index = UnitIndex(('svc/{}'.format(n), n) for n in (10, 2, 9, 0))
+        index['other/1'] = 'o'
+        self.assertEqual([0, 2, 9, 10], index.service('svc'))
+        self.assertEqual(['o'], index.service('other'))
+        self.assertEqual([], index.service('missing'))
+
+    def test_maintained(self):
+        index = UnitIndex()
+        index['svc/1'] = 1
+        index['svc/1'] = 'one'
+        index.setdefault('svc/0', 0)
+        self.assertEqual([0, 'one'], index.service('svc'))
+        del index['svc/0']
+        self.assertEqual(['one'], index.service('svc'))
+        self.assertEqual('one', index.pop('svc/1'))
+        self.assertEqual(None, index.pop('svc/1', None))
+        self.assertRaises(KeyError, index.__delitem__, 'svc/1')
+        self.assertEqual([], index.service('svc'))
+        index.update({'a/0': 0, 'b/0': 0})
+        index.clear()
+        self.assertEqual([], index.service('a'))
+        self.assertEqual({}, index)
+
+
+class TestUnitState(unittest.TestCase):
+    @patch('amulet.sentry.JUJU_VERSION')
+    def test_normalize_status(self, version):
+        version.major = 2
+        talisman = Talisman.__new__(Talisman)
+        status = talisman._normalize_status(mock_status)
+
+        unit = status['meteor']['meteor/0']
+        self.assertIsInstance(unit, UnitState)
+        self.assertEqual('started', unit.machine_state)
+        self.assertEqual('active', unit.workload)
+        self.assertEqual('ready', unit.message)
+        self.assertEqual('idle', unit.agent)
+        self.assertIn('rsyslog-forwarder/0', status['rsyslog-forwarder'])
+        self.assertNotIn('unsub', status)
+        self.assertFalse(status['old']['old/0'].has_workload_status)
+
+    def test_dict_access(self):
+        unit = UnitState('a/0', 'started', '10.0.0.1', 'active', 'ready',
+                         'today', 'idle', 'today')
+        self.assertEqual('started', unit['machine-state'])
+        self.assertEqual('10.0.0.1', unit['public-address'])
+        self.assertEqual({'current': 'active', 'message': 'ready',
+                          'since': 'today'}, unit['workload-status'])
+        self.assertEqual({'current': 'idle', 'since': 'today'},
+                         unit['agent-status'])
+        self.assertIsNone(unit['agent-state'])
+        self.assertIsNone(unit.get('nope'))
+        self.assertRaises(KeyError, lambda: unit['nope'])
+        self.assertIn('agent-state-info', unit)
+        self.assertEqual({}, UnitState('a/0')['workload-status'])
+
+    def test_equality(self):
+        self.assertEqual(UnitState('a/0', 'started'),
+                         UnitState('a/0', 'started'))
+        self.assertNotEqual(UnitState('a/0', 'started'),
+                            UnitState('a/0', 'pending'))
+        self.assertFalse(UnitState('a/0') != UnitState('a/0'))
+
+
+class TestStatusTracker(unittest.TestCase):
+    def test_update(self):
+        check = Mock(side_effect=lambda name, unit: unit['ready'])
+        tracker = StatusTracker(check)
+        status = {
+            'a': {'a/0': {'ready': True}, 'a/1': {'ready': False}},
+            'b': {'b/0': {'ready': True}},
+        }
+
+        self.assertFalse(tracker.update(status, ['a', 'b']))
+        self.assertEqual(set(['a/0', 'a/1', 'b/0']), tracker.changed)
+        calls = check.call_count
+
+        self.assertFalse(tracker.update(deepcopy(status), ['a', 'b']))
+        self.assertEqual(set(), tracker.changed)
+        self.assertEqual(calls, check.call_count)
+
+        status['a']['a/1']['ready'] = True
+        self.assertTrue(tracker.update(deepcopy(status), ['a', 'b']))
+        self.assertEqual(set(['a/1']), tracker.changed)
+        check.assert_any_call('a/1', {'ready': True})
+
+        del status['b']
+        self.assertTrue(tracker.update(status, ['a', 'b']))
+        self.assertEqual(set(['b/0']), tracker.changed)
+
+    def test_update_expiring_verdict(self):
+        check = Mock(return_value=(False, 0))
+        tracker = StatusTracker(check)
+        status = {'a': {'a/0': {}}}
+
+        self.assertFalse(tracker.update(status, ['a']))
+        self.assertFalse(tracker.update(status, ['a']))
+        self.assertEqual(2, check.call_count)
+
+        check.return_value = (False, time.time() + 60)
+        tracker.update(status, ['a'])
+        tracker.update(status, ['a'])
+        self.assertEqual(3, check.call_count)
+
+    def test_ready_at(self):
+        now = time.time()
+        verdicts = {'a/0': True, 'a/1': (False, now + 20),
+                    'a/2': (False, now + 10)}
+        tracker = StatusTracker(lambda name, unit: verdicts[name])
+        status = {'a': {'a/0': {}, 'a/1': {}, 'a/2': {}}}
+
+        self.assertFalse(tracker.update(status, ['a']))
+        self.assertEqual(now + 20, tracker.ready_at)
+
+        verdicts['a/1'] = False
+        self.assertFalse(tracker.update({'a': {'a/1': {'busy': True}}},
+                                        ['a']))
+        self.assertIsNone(tracker.ready_at)
+
+    def test_report(self):
+        since = time.strftime('%d %b %Y %H:%M:%SZ',
+                              time.gmtime(time.time() - 125))
+        busy = UnitState('a/1', machine_state='started', agent='executing',
+                         agent_since=since, workload='maintenance',
+                         message='installing')
+        pending = UnitState('a/2', machine_state='pending')
+        status = {'a': {'a/0': UnitState('a/0'), 'a/1': busy,
+                        'a/2': pending}}
+        tracker = StatusTracker(lambda name, unit: name == 'a/0')
+        tracker.update(status, ['a'])
+        self.assertEqual(set(['a/1', 'a/2']), set(tracker.blocking()))
+        report = tracker.report().splitlines()
+        self.assertEqual('Units still being waited for:', report[0])
+        self.assertRegexpMatches(
+            report[1], r'^  a/1: agent executing, workload maintenance '
+            r'\(installing\) for 12[4-6]s$')
+        self.assertEqual('  a/2: machine pending', report[2])
+        self.assertEqual(3, len(report))
+
+
+class TestProgressive(unittest.TestCase):
+    def setUp(self):
+        for patcher in [
+                patch.object(UnitSentry, 'upload_scripts', Mock()),
+                patch('amulet.helpers.juju', Mock(return_value='status')),
+                patch('amulet.helpers.Backoff.delay',
+                      Mock(return_value=0.01))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.status = deepcopy(mock_status)
+        self.machine = self.status['machines']['2']
+        self.machine['agent-state'] = 'pending'
+        self.machine['juju-status']['current'] = 'pending'
+        patcher = patch('amulet.waiter.status',
+                        side_effect=lambda *args, **kw: deepcopy(self.status))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ready_units(self):
+        talisman = Talisman(['meteor'], juju_env='env', progressive=True)
+        units = talisman.ready_units(5)
+        name, sentry = next(units)
+        self.assertEqual('meteor/0', name)
+        self.assertIs(talisman['meteor/0'], sentry)
+        self.assertEqual(['meteor/0'], list(talisman.unit))
+
+        self.machine['agent-state'] = 'started'
+        self.machine['juju-status']['current'] = 'started'
+        self.assertEqual(['meteor/1'], [name for name, sentry in units])
+        self.assertEqual(2, len(talisman['meteor']))
+        talisman.wait_loaded()
+
+    def test_timeout(self):
+        talisman = Talisman(['meteor'], juju_env='env', timeout=1,
+                            progressive=True)
+        units = talisman.ready_units(0.2)
+        next(units)
+        self.assertRaisesRegexp(TimeoutError, 'meteor/1', next, units)
+        # the loading thread gives up on its own timeout
+        self.assertRaises(TimeoutError, talisman.wait_loaded)
+
+    def test_error(self):
+        unit = self.status['services']['meteor']['units']['meteor/1']
+        unit['workload-status']['current'] = 'error'
+        talisman = Talisman(['meteor'], juju_env='env', progressive=True)
+        self.assertRaisesRegexp(Exception, 'Error on unit meteor/1',
+                                talisman.wait_loaded, 5)
+
+    def test_refresh(self):
+        talisman = Talisman(['meteor'], juju_env='env', progressive=True)
+        next(talisman.ready_units(5))
+        # still setting up meteor/1 by the time refresh sees it up
+        UnitSentry.upload_scripts.side_effect = (
+            lambda deadline=None: time.sleep(0.5))
+        refreshed = threading.Thread(target=talisman.refresh, args=(5,))
+        refreshed.start()
+        time.sleep(0.2)
+        # still waiting for the loader, which is waiting for meteor/1
+        self.assertTrue(refreshed.is_alive())
+        self.machine['agent-state'] = 'started'
+        self.machine['juju-status']['current'] = 'started'
+        refreshed.join(5)
+        self.assertFalse(refreshed.is_alive())
+        self.assertEqual(['meteor/0', 'meteor/1'], talisman._loaded)
+        self.assertEqual(2, UnitSentry.upload_scripts.call_count)
+
+    def test_not_progressive(self):
+        self.machine['agent-state'] = 'started'
+        self.machine['juju-status']['current'] = 'started'
+        talisman = Talisman(['meteor'], juju_env='env')
+        self.assertEqual(['meteor/0', 'meteor/1'],
+                         sorted(name for name, unit in talisman.ready_units()))
+
+
+class TestAgentProbe(unittest.TestCase):
+    def setUp(self):
+        self.talisman = Mock(unit={})
+        self.status = {}
+        for name, address in [('a/0', '10.0.0.1'), ('b/0', '10.0.0.1'),
+                              ('a/1', '10.0.0.2'), ('c/0', '10.0.0.3')]:
+            sentry = Mock(info={'public-address': address})
+            sentry.juju_agent.return_value = {
+                'units': {'unit-b-0': 'install', 'unit-c-0': 'start'}}
+            self.talisman.unit[name] = sentry
+            self.status.setdefault(name.split('/')[0], {})[name] = \
+                UnitState(name, 'started')
+
+    def probes(self):
+        return sum(sentry.juju_agent.call_count
+                   for sentry in self.talisman.unit.values())
+
+    def test_batched(self):
+        probe = AgentProbe(self.talisman, workers=2)
+        probe.update(self.status)
+        self.assertEqual([False, True, False, True],
+                         [probe.running(name)
+                          for name in ('a/0', 'b/0', 'a/1', 'c/0')])
+        # one probe per machine
+        self.assertEqual(3, self.probes())
+
+        probe.update(self.status)
+        probe.running('a/0')
+        self.assertEqual(3, self.probes())
+
+        probe.update(deepcopy(self.status))
+        probe.running('a/0')
+        self.assertEqual(6, self.probes())
+
+    def test_old_script(self):
+        probe = AgentProbe(self.talisman)
+        self.talisman.unit['a/1'].juju_agent.return_value = {'hook': 'x'}
+        self.talisman.unit['c/0'].juju_agent.return_value = None
+        self.assertTrue(probe.running('a/1'))
+        self.assertTrue(probe.running('c/0'))
+        self.assertEqual(2, self.probes())
+
+
+class TestSinceEpoch(unittest.TestCase):
+    def test_offsets(self):
+        utc = calendar.timegm((2015, 9, 24, 20, 44, 44, 0, 0, 0))
+        self.assertEqual(utc, since_epoch('24 Sep 2015 20:44:44Z'))
+        self.assertEqual(utc, since_epoch('24 Sep 2015 16:44:44-04:00'))
+        self.assertEqual(utc, since_epoch('24 Sep 2015 22:44:44+0200'))
+        self.assertEqual(time.mktime((2015, 9, 24, 20, 44, 44, 0, 0, -1)),
+                         since_epoch('24 Sep 2015 20:44:44'))
+
+    def test_cached(self):
+        with patch('amulet.sentry._parse_since',
+                   Mock(return_value=1.0)) as parse, \
+                patch.dict('amulet.sentry._SINCES', clear=True):
+            since = '01 Jan 2000 00:00:00Z'
+            self.assertEqual(1.0, since_epoch(since))
+            self.assertEqual(1.0, since_epoch(since))
+            self.assertEqual(1, parse.call_count)
+
+    def test_agent_settled(self):
+        unit = UnitState('a/0', agent='idle', agent_since=time.strftime(
+            '%d %b %Y %H:%M:%SZ', time.gmtime(time.time() - 10)))
+        settled, ready_at = _agent_settled(
+            'a/0', unit, HookActivity(min_idle=IDLE_THRESHOLD))
+        self.assertFalse(settled)
+        self.assertAlmostEqual(time.time() + IDLE_THRESHOLD - 10, ready_at,
+                               delta=2)
+
+
+class TestSubscribe(unittest.TestCase):
+    def setUp(self):
+        for patcher in [
+                patch.object(Talisman, 'wait_for_status',
+                             Mock(return_value=mock_status)),
+                patch.object(UnitSentry, 'upload_scripts', Mock()),
+                patch('amulet.helpers.Backoff.delay',
+                      Mock(return_value=0.01))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.status = deepcopy(mock_status)
+        self.unit = self.status['services']['meteor']['units']['meteor/0']
+        self.unit['workload-status']['current'] = 'maintenance'
+        self.unit['workload-status']['message'] = 'installing'
+        patcher = patch('amulet.waiter.status',
+                        side_effect=lambda *args, **kw: deepcopy(self.status))
+        self.waiter_status = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.talisman = Talisman(['meteor'], juju_env='env')
+
+    def test_on_unit_state(self):
+        called = threading.Event()
+        ready = self.talisman.on_unit_state(
+            'meteor/0', 'ready', lambda status: called.set())
+        active = self.talisman.on_unit_state('meteor/0', re.compile('act'))
+        self.assertFalse(ready.wait(0.1))
+
+        self.unit['workload-status']['current'] = 'active'
+        self.unit['workload-status']['message'] = 'ready'
+        self.assertTrue(ready.wait(5))
+        self.assertTrue(active.wait(5))
+        self.assertTrue(called.wait(5))
+        self.assertEqual(1, ready.fired)
+        self.assertEqual([], self.talisman._subscriptions)
+
+    def test_edge_triggered(self):
+        calls = []
+        subscription = self.talisman.subscribe(
+            lambda status: status['meteor']['meteor/0'].workload == 'active',
+            calls.append)
+        self.unit['workload-status']['current'] = 'active'
+        self.assertTrue(subscription.wait(5))
+        time.sleep(0.1)
+        self.assertEqual(1, subscription.fired)
+
+        self.unit['workload-status']['current'] = 'blocked'
+        time.sleep(0.1)
+        self.unit['workload-status']['current'] = 'active'
+        for i in range(50):
+            if subscription.fired == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(2, subscription.fired)
+
+        subscription.cancel()
+        stream = self.talisman._stream
+        if stream is not None:
+            stream.join(5)
+        self.assertIsNone(self.talisman._stream)
+        for i in range(50):
+            if len(calls) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(2, len(calls))
+
+    def test_shared_stream(self):
+        release = threading.Event()
+        subscriptions = [
+            self.talisman.subscribe(lambda status: True,
+                                    lambda status: release.wait(5))
+            for i in range(10)]
+        for subscription in subscriptions:
+            self.assertTrue(subscription.wait(5))
+        # the stream keeps running while callbacks are blocked
+        calls = self.waiter_status.call_count
+        time.sleep(0.2)
+        self.assertGreater(self.waiter_status.call_count, calls)
+        self.assertLess(self.waiter_status.call_count, 100)
+        release.set()
+        for subscription in subscriptions:
+            subscription.cancel()
+
+
+class TestWaitAll(unittest.TestCase):
+    def setUp(self):
+        self.executing = deepcopy(mock_status)
+        unit = self.executing['services']['meteor']['units']['meteor/0']
+        unit['juju-status']['current'] = 'executing'
+        self.errored = deepcopy(mock_status)
+        unit = self.errored['services']['meteor']['units']['meteor/1']
+        unit['workload-status'] = {'current': 'error',
+                                   'message': 'hook failed: "install"'}
+        patcher = patch('amulet.helpers.Backoff.delay', return_value=0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('amulet.waiter.status')
+    def test_settles(self, status):
+        statuses = {'a': [mock_status],
+                    'b': [self.executing, self.executing, mock_status]}
+
+        def fake_status(juju_env, services, projected=False):
+            if len(statuses[juju_env]) > 1:
+                return statuses[juju_env].pop(0)
+            return statuses[juju_env][0]
+        status.side_effect = fake_status
+
+        timings = wait_all([('a', ['meteor']), ('b', ['meteor'])], 5)
+        self.assertEqual(set(['a', 'b']), set(timings))
+        self.assertLess(timings['a'], timings['b'])
+
+    @patch('amulet.waiter.status')
+    def test_fails_fast(self, status):
+        status.side_effect = lambda juju_env, services, projected: {
+            'a': self.executing, 'b': self.errored}[juju_env]
+
+        start = time.time()
+        self.assertRaisesRegexp(
+            Exception, r'Error on unit meteor/1: hook failed', wait_all,
+            [('a', ['meteor']), ('b', ['meteor'])], 5)
+        self.assertLess(time.time() - start, 1)
+
+    @patch('amulet.waiter.status')
+    def test_timeout(self, status):
+        status.side_effect = lambda juju_env, services, projected: {
+            'a': mock_status, 'b': self.executing}[juju_env]
+
+        try:
+            wait_all([('a', ['meteor']), ('b', ['meteor'])], 0.2)
+        except TimeoutError as e:
+            self.assertEqual('Models not settled after 0.2s: b', e.value)
+            self.assertTrue(e.reported)
+        else:
+            self.fail('TimeoutError not raised')
+
+    @patch('amulet.waiter.status')
+    def test_deadline(self, status):
+        status.side_effect = lambda juju_env, services, projected: {
+            'a': mock_status, 'b': self.executing}[juju_env]
+        models = [('a', ['meteor']), ('b', ['meteor'])]
+
+        start = time.time()
+        self.assertRaises(TimeoutError, wait_all, models, 300,
+                          deadline=helpers.Deadline(0.2))
+        self.assertLess(time.time() - start, 1)
+
+        start = time.time()
+        with self.assertRaises(TimeoutError):
+            with helpers.timeout(0.2):
+                wait_all(models, 300)
+        self.assertLess(time.time() - start, 1)
+
+    @patch('amulet.waiter.status')
+    def test_parallel_status(self, status):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_status(juju_env, services, projected):
+            with lock:
+                active.append(juju_env)
+                peak.append(len(active))
+            time.sleep(0.2)
+            with lock:
+                active.remove(juju_env)
+            return mock_status
+        status.side_effect = slow_status
+
+        models = [(str(n), ['meteor']) for n in range(4)]
+        start = time.time()
+        self.assertEqual(4, len(wait_all(models, 5, workers=2)))
+        self.assertEqual(2, max(peak))
+        self.assertLess(time.time() - start, 0.7)
+
+
+class TestPollingMemory(unittest.TestCase):
+    iterations = 3000
+
+    @staticmethod
+    def rss():
+        """Current resident set size, in kB"""
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), 'needs procfs')
+    @patch('amulet.sentry.JUJU_VERSION')
+    def test_bounded_memory(self, version):
+        version.major = 2
+        raw = json.dumps(mock_status)
+        polls = []
+
+        def fake_status(juju_env, services=None, projected=False):
+            polls.append(1)
+            status = json.loads(raw)
+            unit = status['services']['meteor']['units']['meteor/0']
+            unit['juju-status']['since'] = str(len(polls))  # always changes
+            return status
+
+        talisman = Talisman.__new__(Talisman)
+        talisman.juju_env = 'env'
+        talisman.service_names = ['meteor']
+        tracker = StatusTracker(lambda name, unit: False)
+
+        def poll(subscription, n):
+            for i in range(n):
+                status = talisman._normalize_status(subscription.next())
+                tracker.update(status, talisman.service_names)
+
+        gc.collect()
+        gc.disable()
+        try:
+            with patch('amulet.waiter.status', fake_status):
+                with talisman._subscribe() as subscription:
+                    poll(subscription, 100)  # warm up
+                    before = self.rss()
+                    poll(subscription, self.iterations)
+                    after = self.rss()
+            garbage = gc.collect()
+        finally:
+            gc.enable()
+
+        self.assertEqual(self.iterations + 100, len(polls))
+        self.assertLess(after - before, 2048)
+        # nothing in the polling path should need the cycle collector
+        self.assertLess(garbage, 100)
@@ -1,6 +1,8 @@
 """Unit test for amulet.wait"""
 
 import os
+import threading
+import time
 import unittest
 import yaml
 from amulet import wait
@@ -17,14 +19,68 @@ class WaiterTest(unittest.TestCase):
     @patch('amulet.waiter.juju')
     def test_get_pyjuju_status(self, mock_check_output, version):
         version.major = 1
-        mstatus = JujuStatus('juju')
+        mstatus = JujuStatus('juju-core')
         mstatus.add('wordpress')
         mstatus.add('mysql', state='pending')
+        mock_check_output.return_value = mstatus.to_json()
+
+        status = waiter._get_pyjuju_status('dummy')
+        self.assertEqual(yaml.safe_load(str(mstatus)), status)
+        mock_check_output.assert_called_with(
+            ['status', '--format', 'json', '-e', 'dummy'])
+
+    @patch('amulet.waiter.STATUS_FORMAT', 'yaml')
+    @patch('amulet.waiter.JUJU_VERSION')
+    @patch('amulet.waiter.juju')
+    def test_get_pyjuju_status_yaml(self, mock_check_output, version):
+        version.major = 2
+        mstatus = JujuStatus('juju')
+        mstatus.add('wordpress')
         mock_check_output.return_value = str(mstatus)
 
         status = waiter._get_pyjuju_status('dummy')
         self.assertEqual(yaml.safe_load(str(mstatus)), status)
         mock_check_output.assert_called_with(
+            ['status', '--format', 'yaml', '-m', 'dummy'])
+
+    def test_parse_status(self):
+        mstatus = JujuStatus()
+        mstatus.add('wordpress')
+        expected = yaml.safe_load(str(mstatus))
+        self.assertEqual(expected, waiter.parse_status(mstatus.to_json()))
+        self.assertEqual(expected, waiter.parse_status(str(mstatus)))
+
+    @patch('amulet.waiter.JUJU_VERSION')
+    @patch('amulet.waiter.juju')
+    def test_get_pyjuju_status_services(self, mock_check_output, version):
+        version.major = 2
+        mock_check_output.return_value = '{"machines": {}, "applications": {}}'
+
+        waiter._get_pyjuju_status('dummy', ['wordpress', 'mysql', 'mysql'])
+        mock_check_output.assert_called_with(
+            ['status', '--format', 'json', '-m', 'dummy', 'mysql', 'wordpress'])
+
+    @patch('amulet.waiter.JUJU_VERSION')
+    @patch('amulet.waiter.juju')
+    def test_get_pyjuju_status_yaml_fallback(self, mock_juju, version):
+        self.addCleanup(setattr, waiter, 'STATUS_FORMAT',
+                        waiter.STATUS_FORMAT)
+        version.major = 1
+        mstatus = JujuStatus('juju-core')
+        mstatus.add('wordpress')
+
+        def juju(args):
+            if 'json' in args:
+                raise IOError('invalid value "json" for flag --format')
+            return str(mstatus)
+        mock_juju.side_effect = juju
+
+        status = waiter._get_pyjuju_status('dummy')
+        self.assertEqual(yaml.safe_load(str(mstatus)), status)
+        # later queries go straight to yaml
+        mock_juju.reset_mock()
+        waiter._get_pyjuju_status('dummy')
+        mock_juju.assert_called_once_with(
             ['status', '--format', 'yaml', '-e', 'dummy'])
 
     @patch('amulet.waiter.juju')
@@ -40,7 +96,7 @@ class WaiterTest(unittest.TestCase):
     @patch.object(waiter, '_get_pyjuju_status')
     def test_get_gojuju_status(self, mock_pyjuju_status):
         waiter._get_gojuju_status('dummy')
-        mock_pyjuju_status.assert_called_with('dummy')
+        mock_pyjuju_status.assert_called_with('dummy', None, None)
 
     def test_parse_unit_state(self):
         data = [{'life': 'dying'},
@@ -91,6 +147,8 @@ class WaiterTest(unittest.TestCase):
                   'test-charm-b': {'0': 'started', '1': 'started'}}
         self.assertEqual(output, waiter.state('test-charm/1', 'test-charm-b',
                                               juju_env='test'))
+        pyjuju_status.assert_called_with(
+            'test', ['test-charm', 'test-charm-b'], projected=True)
 
     @patch.object(waiter, 'status')
     @patch('amulet.helpers.JujuVersion')
@@ -207,17 +265,20 @@ class WaitTest(unittest.TestCase):
 
 
 class StatusTest(unittest.TestCase):
+    def setUp(self):
+        waiter.invalidate_status()
+
     @patch('amulet.waiter._get_gojuju_status')
     def test_status_go(self, mpy):
         waiter.status('gojuju')
-        mpy.assert_called_with('gojuju')
+        mpy.assert_called_with('gojuju', None, None)
 
     @patch('amulet.waiter._get_pyjuju_status')
     @patch('amulet.waiter.JujuVersion')
     def test_status_py(self, mj, mpy):
         mj.side_effect = [JujuVersion(0, 7, 0, False)]
         waiter.status('pyjuju')
-        mpy.assert_called_with('pyjuju')
+        mpy.assert_called_with('pyjuju', None, None)
 
     def test_status_noenv(self):
         self.assertRaises(Exception, waiter.status)
@@ -231,3 +292,181 @@ class StatusTest(unittest.TestCase):
     def test_wait_exception(self, mpy):
         mpy.side_effect = [Exception]
         self.assertRaises(Exception, waiter.status, 'godummy')
+
+    @patch('amulet.waiter._get_gojuju_status')
+    def test_status_cached(self, mpy):
+        mpy.side_effect = [{'n': 1}, {'n': 2}, {'n': 3}]
+        self.assertEqual({'n': 1}, waiter.status('gojuju'))
+        self.assertEqual({'n': 1}, waiter.status('gojuju'))
+        self.assertEqual({'n': 2}, waiter.status('gojuju', ['a']))
+        self.assertEqual({'n': 3}, waiter.status('gojuju', max_age=0))
+        self.assertEqual(3, mpy.call_count)
+
+    @patch('amulet.waiter._get_gojuju_status')
+    def test_status_projected_shares_json(self, mpy):
+        mpy.side_effect = [{'n': 1}, {'n': 2}]
+        self.assertEqual({'n': 1}, waiter.status('gojuju', projected=True))
+        self.assertEqual({'n': 1}, waiter.status('gojuju'))
+        mpy.assert_called_once_with('gojuju', None, None)
+
+        waiter.invalidate_status()
+        mpy.side_effect = [{'n': 1}, {'n': 2}]
+        with patch('amulet.waiter.STATUS_FORMAT', 'yaml'):
+            waiter.status('gojuju', projected=True)
+            self.assertEqual({'n': 2}, waiter.status('gojuju'))
+        mpy.assert_any_call('gojuju', None, waiter.STATUS_PROJECTION)
+
+    @patch('amulet.waiter.JUJU_VERSION')
+    @patch('amulet.waiter.juju')
+    def test_status_projected_yaml_fallback(self, mock_juju, version):
+        self.addCleanup(setattr, waiter, 'STATUS_FORMAT',
+                        waiter.STATUS_FORMAT)
+        version.major = 2
+
+        def juju(args):
+            if 'json' in args:
+                raise IOError('invalid value "json" for flag --format')
+            return PROJECTION_STATUS
+        mock_juju.side_effect = juju
+
+        # the query which finds out that JSON is rejected loads it all
+        status = waiter.status('gojuju', projected=True)
+        self.assertIn('charm', status['applications']['mysql'])
+        # later ones only parse the projection out of the YAML
+        status = waiter.status('gojuju', projected=True, max_age=0)
+        self.assertEqual(
+            waiter.project_yaml(PROJECTION_STATUS)['applications'],
+            status['applications'])
+        self.assertIn('charm', waiter.status('gojuju')['applications'][
+            'mysql'])
+        self.assertEqual(['json', 'yaml', 'yaml'],
+                         [c[0][0][2] for c in mock_juju.call_args_list])
+
+
+class StatusCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        cache = waiter.StatusCache(ttl=0.05)
+        fetch = Mock(side_effect=[1, 2])
+        self.assertEqual(1, cache.get('key', fetch))
+        self.assertEqual(1, cache.get('key', fetch))
+        time.sleep(0.1)
+        self.assertEqual(2, cache.get('key', fetch))
+
+    def test_invalidate(self):
+        cache = waiter.StatusCache(ttl=60)
+        fetch = Mock(side_effect=[1, 2])
+        self.assertEqual(1, cache.get('key', fetch))
+        cache.invalidate()
+        self.assertEqual(2, cache.get('key', fetch))
+
+    def test_errors_not_cached(self):
+        cache = waiter.StatusCache(ttl=60)
+        fetch = Mock(side_effect=[OSError, 1])
+        self.assertRaises(OSError, cache.get, 'key', fetch)
+        self.assertEqual(1, cache.get('key', fetch))
+
+    def test_coalescing(self):
+        cache = waiter.StatusCache(ttl=60)
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'status'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.get('key', fetch)))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(['status'] * 5, results)
+        self.assertEqual(1, len(calls))
+
+
+PROJECTION_STATUS = """\
+model:
+  name: default
+machines:
+  "0":
+    juju-status:
+      current: started
+      since: 24 Sep 2015 16:44:44-04:00
+      version: 2.0.0
+    hardware: arch=amd64 cpu-cores=2
+    containers:
+      0/lxd/0:
+        juju-status: {current: pending, message: "", since: null}
+        series: xenial
+applications:
+  mysql:
+    charm: cs:mysql-1
+    exposed: false
+    relations:
+      cluster: [mysql]
+    units:
+      mysql/0:
+        machine: "0"
+        public-address: 10.0.0.1
+        open-ports: [3306/tcp]
+        workload-status: {current: active, message: ready}
+        juju-status: {current: idle, since: 24 Sep 2015 16:44:44-04:00}
+        subordinates:
+          rsyslog/0:
+            workload-status: {current: active}
+            public-address: 10.0.0.1
+  rsyslog:
+    charm: cs:rsyslog-1
+    subordinate-to: [mysql]
+"""
+
+
+class ProjectYamlTest(unittest.TestCase):
+    def test_status_projection(self):
+        status = waiter.project_yaml(PROJECTION_STATUS)
+        self.assertEqual({
+            'machines': {'0': {
+                'juju-status': {'current': 'started',
+                                'since': '24 Sep 2015 16:44:44-04:00'},
+                'containers': {'0/lxd/0': {
+                    'juju-status': {'current': 'pending', 'message': '',
+                                    'since': None}}}}},
+            'applications': {
+                'mysql': {
+                    'relations': {'cluster': ['mysql']},
+                    'units': {'mysql/0': {
+                        'machine': '0',
+                        'public-address': '10.0.0.1',
+                        'workload-status': {'current': 'active',
+                                            'message': 'ready'},
+                        'juju-status': {
+                            'current': 'idle',
+                            'since': '24 Sep 2015 16:44:44-04:00'},
+                        'subordinates': {'rsyslog/0': {
+                            'workload-status': {'current': 'active'},
+                            'public-address': '10.0.0.1'}}}}},
+                'rsyslog': {'subordinate-to': ['mysql']}}}, status)
+
+    def test_keep_whole(self):
+        raw = 'a: {b: [1, true, ~, "2"], c: 1.5}\nd: x\n'
+        self.assertEqual(yaml.safe_load(raw),
+                         waiter.project_yaml(raw, {'a': True, 'd': True}))
+        self.assertEqual({'a': {'c': 1.5}},
+                         waiter.project_yaml(raw, {'a': {'c': True}}))
+        self.assertIsNone(waiter.project_yaml(''))
+
+    def test_parse_status_projection(self):
+        mstatus = JujuStatus()
+        mstatus.add('wordpress')
+        expected = yaml.safe_load(str(mstatus))
+        projection = {'machines': True}
+        self.assertEqual(
+            expected, waiter.parse_status(mstatus.to_json(), projection))
+        self.assertEqual(
+            {'machines': expected['machines']},
+            waiter.parse_status(str(mstatus), projection))